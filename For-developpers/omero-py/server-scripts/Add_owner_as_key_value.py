@@ -20,167 +20,345 @@ Created by Rémy Dornier, based on Christian Evenhuis work.
 
 import omero
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
+from omero.rtypes import rstring, rtime, unwrap
 import omero.scripts as scripts
 from datetime import date
-import copy
 from collections import OrderedDict
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 
 P_DATA_TYPE = "Data_Type"
 P_IDS = "IDs"
-
-
-def get_existing_map_annotations(obj, namespace):
-    """Get all Map Annotations linked to the object"""
-
-    ord_dict = OrderedDict()
-    for ann in obj.listAnnotations(ns=namespace):
-        if isinstance(ann, omero.gateway.MapAnnotationWrapper):
-            kvs = ann.getValue()
-            for k, v in kvs:
-                if k not in ord_dict:
-                    ord_dict[k] = set()
-                ord_dict[k].add(v)
-    return ord_dict
-
-
-def annotate_object(conn, obj, key):
+P_INCREMENTAL = "Only new images"
+P_GROUP_WORKERS = "Parallel groups"
+
+NAMESPACE = "data.ownership"
+# number of images loaded in one query
+QUERY_BATCH_SIZE = 1000
+# number of objects saved in one call
+SAVE_BATCH_SIZE = 1000
+# maximum number of queries / saves per second sent to the server, all groups together
+MAX_CALLS_PER_SECOND = 10
+
+# local store of the last processed creation time, per user/group or per object
+STATE_FILE = os.path.join(tempfile.gettempdir(), "omero_owner_kv_state.json")
+# time (in ms) subtracted from the last processed creation time, so that images committed late are not missed
+STATE_SAFETY_MARGIN = 10 * 60 * 1000
+
+# query to get all images within an object, with their creation time
+IMAGE_QUERIES = {
+    "Image": "select i.id, i.details.creationEvent.time from Image i where i.id in (:ids)",
+    "Dataset": "select i.id, i.details.creationEvent.time from Image i, DatasetImageLink l "
+               "where l.child.id = i.id and l.parent.id in (:ids)",
+    "Project": "select i.id, i.details.creationEvent.time from Image i, DatasetImageLink dl, ProjectDatasetLink pl "
+               "where dl.child.id = i.id and dl.parent.id = pl.child.id and pl.parent.id in (:ids)",
+    "Well": "select i.id, i.details.creationEvent.time from Image i, WellSample ws "
+            "where ws.image.id = i.id and ws.well.id in (:ids)",
+    "Plate": "select i.id, i.details.creationEvent.time from Image i, WellSample ws "
+             "where ws.image.id = i.id and ws.well.plate.id in (:ids)",
+    "Screen": "select i.id, i.details.creationEvent.time from Image i, WellSample ws, ScreenPlateLink sl "
+              "where ws.image.id = i.id and ws.well.plate.id = sl.child.id and sl.parent.id in (:ids)",
+}
+
+# queries to get all images owned by a user, or contained in one of his/her containers, with their creation time
+USER_IMAGE_QUERIES = [
+    "select i.id, i.details.creationEvent.time from Image i where i.details.owner.id = :uid",
+    "select i.id, i.details.creationEvent.time from Image i, DatasetImageLink l "
+    "where l.child.id = i.id and l.parent.details.owner.id = :uid",
+    "select i.id, i.details.creationEvent.time from Image i, DatasetImageLink dl, ProjectDatasetLink pl "
+    "where dl.child.id = i.id and dl.parent.id = pl.child.id and pl.parent.details.owner.id = :uid",
+    "select i.id, i.details.creationEvent.time from Image i, WellSample ws "
+    "where ws.image.id = i.id and ws.well.plate.details.owner.id = :uid",
+    "select i.id, i.details.creationEvent.time from Image i, WellSample ws, ScreenPlateLink sl "
+    "where ws.image.id = i.id and ws.well.plate.id = sl.child.id and sl.parent.details.owner.id = :uid",
+]
+# restriction to the images created after the last run
+SINCE_CLAUSE = " and i.details.creationEvent.time > :since"
+
+
+class RateLimiter:
+    """Space the calls to the server, shared between all workers"""
+
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second if calls_per_second > 0 else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def throttle(rate_limiter):
+    """Wait for the next call slot, if a rate limit is set"""
+
+    if rate_limiter is not None:
+        rate_limiter.wait()
+
+
+def read_state(state_path):
+    """Read the last processed creation times (in ms) of the previous incremental runs"""
+
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def write_state(state_path, state):
+    """Save the last processed creation times (in ms) for the next incremental runs"""
+
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def advance_state(state, state_key, last_time):
+    """Move the last processed creation time (in ms) forward, minus the safety margin, never backward"""
+
+    if last_time is not None:
+        state[state_key] = max(state.get(state_key, 0), last_time - STATE_SAFETY_MARGIN)
+
+
+def get_since_params(params, since):
+    """Add the creation time restriction to the query parameters, if any"""
+
+    if since is None:
+        return ""
+    params.add("since", rtime(since))
+    return SINCE_CLAUSE
+
+
+def get_image_ids(conn, object_type, object_ids, since=None):
     """
-    Add a key value pair to the object
-    Code taken and adapted from Christian Evenhuis,
-    https://github.com/ome/omero-scripts/blob/develop/omero/annotation_scripts/KeyVal_from_csv.py
+    Get the IDs of all images within the given objects, created after 'since' (in ms) if given.
+    Returns the sorted image IDs and the latest creation time
     """
 
-    obj_updated = False
-    namespace = "data.ownership"
-    existing_kv = get_existing_map_annotations(obj, namespace)
-    updated_kv = copy.deepcopy(existing_kv)
-
-    owner = ""
-    owner += obj.getDetails().getOwner().getFullName()
-    owner += f" ({obj.getDetails().getOwner().getOmeName()})"
+    params = omero.sys.ParametersI()
+    params.addIds(object_ids)
+    query = IMAGE_QUERIES[object_type] + get_since_params(params, since)
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    creation_times = {row[0].getValue(): row[1].getValue() for row in rows}
+    return sorted(creation_times), max(creation_times.values(), default=since)
 
-    print("Existing kv:")
-    for k, vset in existing_kv.items():
-        for v in vset:
-            print("   ", k, v)
 
-    print("Adding kv:")
+def get_user_image_ids(conn, user_id, since=None, rate_limiter=None):
+    """
+    Get the IDs of all images owned by the user, or contained in one of his/her containers, in the current group,
+    created after 'since' (in ms) if given.
+    Returns the sorted image IDs and the latest creation time
+    """
 
-    if key not in updated_kv:
-        updated_kv[key] = set()
-    print("   ", key, owner)
-    updated_kv[key].add(owner)
+    params = omero.sys.ParametersI()
+    params.addLong("uid", user_id)
+    since_clause = get_since_params(params, since)
+    query_service = conn.getQueryService()
+    creation_times = {}
+    for query in USER_IMAGE_QUERIES:
+        throttle(rate_limiter)
+        rows = query_service.projection(query + since_clause, params, conn.SERVICE_OPTS)
+        creation_times.update((row[0].getValue(), row[1].getValue()) for row in rows)
+    return sorted(creation_times), max(creation_times.values(), default=since)
 
-    if existing_kv != updated_kv:
-        try:
-            # convert the ordered dict to a list of lists
-            kv_list = []
 
-            for k, vset in updated_kv.items():
-                for v in vset:
-                    kv_list.append([k, v])
+def get_owner_name(owner):
+    """
+    Format the owner name as 'Firstname Lastname (username)', with the same full name as
+    ExperimenterWrapper.getFullName(), so that the values match the ones of previous runs
+    """
 
-            print("The key-values pairs are different")
-            anns = list(obj.listAnnotations(ns=namespace))
-            map_anns = [ann for ann in anns if isinstance(ann, omero.gateway.MapAnnotationWrapper)]
-            print(map_anns)
+    first_name = unwrap(owner.getFirstName())
+    middle_name = unwrap(owner.getMiddleName())
+    last_name = unwrap(owner.getLastName())
+    ome_name = unwrap(owner.getOmeName())
 
-            if len(map_anns) > 0:
-                map_ann = map_anns[0]
-                map_ann.setValue(kv_list)
-                map_ann.save()
-            else:
-                map_ann = omero.gateway.MapAnnotationWrapper(conn)
-                map_ann.setNs(namespace)
-                map_ann.setValue(kv_list)
-                map_ann.save()
-                obj.linkAnnotation(map_ann)
+    if middle_name is not None and middle_name != '':
+        full_name = "%s %s. %s" % (first_name, middle_name, last_name)
+    elif first_name == "" and last_name == "":
+        full_name = ome_name
+    else:
+        full_name = "%s %s" % (first_name, last_name)
+    return f"{full_name} ({ome_name})"
 
-            print("Map Annotation created", map_ann.id)
-            obj_updated = True
 
-        except omero.SecurityViolation:
-            print("You do not have the right to write annotations for ", obj.OMERO_CLASS, "", obj.getId())
-    else:
-        print("No change change in kv")
+def get_images_with_owner(conn, image_ids):
+    """Load the images together with their owner, in one query"""
 
-    return obj_updated
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    query = "select i from Image i join fetch i.details.owner where i.id in (:ids)"
+    return conn.getQueryService().findAllByQuery(query, params, conn.SERVICE_OPTS)
 
 
-def process_image(conn, image, key):
+def get_existing_map_annotations(conn, image_ids, namespace):
     """
-    Add the owner as key value pair to an image
-    return 1 if owner has been added, 0 otherwise
+    Get the Map Annotations with the given namespace linked to the images, in one query.
+    Returns a dict image id -> list of annotations
     """
 
-    return 1 if annotate_object(conn, image, key) is True else 0
-
-
-def process_dataset(conn, dataset, key):
+    params = omero.sys.ParametersI()
+    params.addIds(image_ids)
+    params.addString("ns", namespace)
+    query = ("select l from ImageAnnotationLink l join fetch l.child a "
+             "where a.ns = :ns and l.parent.id in (:ids) order by a.id")
+    links = conn.getQueryService().findAllByQuery(query, params, conn.SERVICE_OPTS)
+
+    # the same annotation can be linked to several images; keep one object per annotation
+    annotations = {}
+    image_map_anns = {}
+    for link in links:
+        ann = link.getChild()
+        if isinstance(ann, omero.model.MapAnnotationI):
+            ann = annotations.setdefault(ann.getId().getValue(), ann)
+            image_map_anns.setdefault(link.getParent().getId().getValue(), []).append(ann)
+    return image_map_anns
+
+
+def annotate_images(conn, image_ids, key, rate_limiter=None):
     """
-    Add the owner as key value pair to a dataset and its children
-    return the number of processed images
+    Add the owner as key value pair to a batch of images.
+    Images and existing key-value pairs are loaded with a few grouped queries and
+    only the new or changed Map Annotations are saved, by batches.
+    return the number of images that have been updated and whether all of them were saved
     """
 
+    to_save = []
+    updated_anns = set()
     n_image = 0
-    for image in dataset.listChildren():
-        n_image += process_image(conn, image, key)
-
-    return n_image
 
+    for i in range(0, len(image_ids), QUERY_BATCH_SIZE):
+        batch = image_ids[i:i + QUERY_BATCH_SIZE]
+        throttle(rate_limiter)
+        images = get_images_with_owner(conn, batch)
+        throttle(rate_limiter)
+        existing_map_anns = get_existing_map_annotations(conn, batch, NAMESPACE)
 
-def process_project(conn, project, key):
-    """
-    Add the owner as key value pair to a project and its children
-    return the number of processed images & datasets
-    """
+        for image in images:
+            image_id = image.getId().getValue()
+            if not image.getDetails().getPermissions().canAnnotate():
+                print("You do not have the right to write annotations for Image", image_id)
+                continue
 
-    n_image = 0
-    for dataset in project.listChildren():
-        n_image += process_dataset(conn, dataset, key)
+            owner = get_owner_name(image.getDetails().getOwner())
+            map_anns = existing_map_anns.get(image_id, [])
 
-    return n_image
+            existing_kv = OrderedDict()
+            for ann in map_anns:
+                for nv in ann.getMapValue():
+                    existing_kv.setdefault(nv.name, set()).add(nv.value)
 
+            if owner in existing_kv.get(key, set()):
+                continue
 
-def process_well(conn, well, key):
-    """
-    Add the owner as key value pair to a well and its children
-    return the number of processed images
-    """
+            existing_kv.setdefault(key, set()).add(owner)
+            kv_list = [omero.model.NamedValue(k, v) for k, vset in existing_kv.items() for v in vset]
 
-    n_image = 0
-    for wellSample in well.listChildren():
-        n_image += process_image(conn, wellSample.getImage(), key)
-
-    return n_image
+            if len(map_anns) > 0:
+                map_ann = map_anns[0]
+                map_ann.setMapValue(kv_list)
+                if map_ann.getId().getValue() not in updated_anns:
+                    updated_anns.add(map_ann.getId().getValue())
+                    to_save.append(map_ann)
+            else:
+                map_ann = omero.model.MapAnnotationI()
+                map_ann.setNs(rstring(NAMESPACE))
+                map_ann.setMapValue(kv_list)
+                link = omero.model.ImageAnnotationLinkI()
+                link.setParent(omero.model.ImageI(image_id, False))
+                link.setChild(map_ann)
+                to_save.append(link)
+            n_image += 1
+
+    saved = save_in_batches(conn, to_save, rate_limiter)
+    return n_image, saved
+
+
+def save_in_batches(conn, objects, rate_limiter=None):
+    """Save objects on OMERO, by batches of SAVE_BATCH_SIZE objects. Return False if a batch could not be saved"""
+
+    update_service = conn.getUpdateService()
+    saved = True
+    for i in range(0, len(objects), SAVE_BATCH_SIZE):
+        throttle(rate_limiter)
+        try:
+            update_service.saveArray(objects[i:i + SAVE_BATCH_SIZE], conn.SERVICE_OPTS)
+        except omero.SecurityViolation as e:
+            print(f"You do not have the right to write some of the annotations {i} to "
+                  f"{i + len(objects[i:i + SAVE_BATCH_SIZE]) - 1}: {e}")
+            saved = False
+    return saved
 
 
-def process_plate(conn, plate, key):
+def process_group(user_conn, user_id, group_id, key, since=None, rate_limiter=None):
     """
-    Add the owner as key value pair to a plate and its children
-    return the number of processed images & wells
+    Add the owner as key value pair to all images of the user within one group
+    return the number of processed images and the latest creation time, None if some images could not be saved
     """
 
-    n_image = 0
-    for well in plate.listChildren():
-        n_image += process_well(conn, well, key)
+    # set the group
+    user_conn.SERVICE_OPTS.setOmeroGroup(group_id)
 
-    return n_image
+    # list all images belonging to the user or to his/her containers
+    image_ids, last_time = get_user_image_ids(user_conn, user_id, since, rate_limiter)
+    n_image, saved = annotate_images(user_conn, image_ids, key, rate_limiter)
+    return n_image, last_time if saved else None
 
 
-def process_screen(conn, screen, key):
+def process_groups_in_parallel(conn, user_name, user_id, group_list, key, since_dict, n_workers):
     """
-    Add the owner as key value pair to a screen and its children
-    return the number of processed images, wells & plates
+    Process the groups of one user concurrently, with one sudo connection per worker
+    and a rate limit shared by all workers.
+    return a dict group id -> (number of processed images, latest creation time), None for the groups that failed
     """
 
-    n_image = 0
-    for plate in screen.listChildren():
-        n_image += process_plate(conn, plate, key)
+    if len(group_list) == 0:
+        return {}
+
+    rate_limiter = RateLimiter(MAX_CALLS_PER_SECOND)
+    n_workers = max(1, min(n_workers, len(group_list)))
+
+    # sudo connections are opened upfront and handed over from one group to the next
+    connections = queue.Queue()
+    opened = []
+    try:
+        for _ in range(n_workers):
+            user_conn = conn.suConn(user_name, ttl=600000)
+            opened.append(user_conn)
+            connections.put(user_conn)
+
+        def process(g_id):
+            user_conn = connections.get()
+            try:
+                return process_group(user_conn, user_id, g_id, key, since_dict.get(g_id), rate_limiter)
+            except Exception:
+                print(f"ERROR: cannot process group {g_id} of user {user_name}")
+                traceback.print_exc()
+                return None
+            finally:
+                connections.put(user_conn)
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(process, group_list))
+    finally:
+        for user_conn in opened:
+            user_conn.close()
 
-    return n_image
+    return dict(zip(group_list, results))
 
 
 def add_owner_as_keyval(conn, script_params):
@@ -195,10 +373,19 @@ def add_owner_as_keyval(conn, script_params):
     # enter its corresponding ID (except for 'user' : enter the username)
     object_id_list = script_params[P_IDS]
 
+    # only process the images created since the last run
+    incremental = script_params.get(P_INCREMENTAL, False)
+    state = read_state(STATE_FILE) if incremental else {}
+
     today = date.today().strftime("%Y%m%d")
     key = "owner_" + today
 
+    # number of groups processed at the same time for admin runs on users
+    n_workers = script_params.get(P_GROUP_WORKERS, 1)
+
     n_image = 0
+    n_failed_groups = 0
+    report = []
 
     for object_id in object_id_list:
         """ add owner to all objects owned by the specified user"""
@@ -212,52 +399,36 @@ def add_owner_as_keyval(conn, script_params):
             if user is not None:
                 # get the list of groups to search in
                 group_list = []
+                state_keys = {}
                 if conn.getUser().isAdmin():
                     for gem in user.copyGroupExperimenterMap():
                         group_list.append(gem.getParent().getId().getValue())
-
-                    # get sudo connection
-                    user_name = user.getName()
-                    user_conn = conn.suConn(user_name, ttl=600000)
-                    user_id = user_conn.getUser().getId()
                 else:
                     for g in conn.getGroupsMemberOf():
                         group_list.append(g.getId())
-                    user_conn = conn
-                    user_id = user.getId()
-
                 for g_id in group_list:
-                    # set the group
-                    user_conn.SERVICE_OPTS.setOmeroGroup(g_id)
-
-                    # list all user's projects
-                    projects = user_conn.getObjects("Project", opts={'owner': user_id})
-                    for project in projects:
-                        n_image += process_project(user_conn, project, key)
-
-                    # lists all user's screens
-                    screens = user_conn.getObjects("screen", opts={'owner': user_id})
-                    for screen in screens:
-                        n_image += process_screen(user_conn, screen, key)
-
-                    # lists all user's orphaned dataset
-                    orphaned_datasets = user_conn.getObjects("dataset", opts={'owner': user_id, 'orphaned': True})
-                    for orphaned_dataset in orphaned_datasets:
-                        n_image += process_dataset(user_conn, orphaned_dataset, key)
-
-                    # lists all user's orphaned plates
-                    orphaned_plates = user_conn.getObjects("plate", opts={'owner': user_id, 'orphaned': True})
-                    for orphaned_plate in orphaned_plates:
-                        n_image += process_plate(user_conn, orphaned_plate, key)
-
-                    # lists all user's orphaned images
-                    orphaned_images = user_conn.getObjects("image", opts={'owner': user_id, 'orphaned': True})
-                    for orphaned_image in orphaned_images:
-                        n_image += process_image(user_conn, orphaned_image, key)
+                    state_keys[g_id] = f"user/{user.getId()}/group/{g_id}"
+                since_dict = {g_id: state.get(state_key) for g_id, state_key in state_keys.items()}
 
-                # close the user connection
                 if conn.getUser().isAdmin():
-                    user_conn.close()
+                    # process the groups concurrently, with sudo connections
+                    group_results = process_groups_in_parallel(conn, user.getName(), user.getId(), group_list,
+                                                               key, since_dict, n_workers)
+                else:
+                    group_results = {}
+                    for g_id in group_list:
+                        group_results[g_id] = process_group(conn, user.getId(), g_id, key, since_dict[g_id])
+
+                # merge the results of all groups
+                for g_id, group_result in group_results.items():
+                    if group_result is None:
+                        report.append(f"{object_id} - group {g_id}: failed")
+                        n_failed_groups += 1
+                        continue
+                    n_group_image, last_time = group_result
+                    report.append(f"{object_id} - group {g_id}: {n_group_image} image(s)")
+                    n_image += n_group_image
+                    advance_state(state, state_keys[g_id], last_time)
 
             else:
                 print("The user", object_id, "does not exists or you do not have access to his/her data")
@@ -287,19 +458,13 @@ def add_owner_as_keyval(conn, script_params):
                 # set the correct group Id
                 user_conn.SERVICE_OPTS.setOmeroGroup(omero_object.getDetails().getGroup().getId())
 
-                # select object type and add owner as key-value pair
-                if object_type == 'Image':
-                    n_image += process_image(user_conn, omero_object, key)
-                if object_type == 'Dataset':
-                    n_image += process_dataset(user_conn, omero_object, key)
-                if object_type == 'Project':
-                    n_image += process_project(user_conn, omero_object, key)
-                if object_type == 'Well':
-                    n_image += process_well(user_conn, omero_object, key)
-                if object_type == 'Plate':
-                    n_image += process_plate(user_conn, omero_object, key)
-                if object_type == 'Screen':
-                    n_image += process_screen(user_conn, omero_object, key)
+                # list all images within the object and add owner as key-value pair
+                state_key = f"{object_type.lower()}/{object_id}"
+                image_ids, last_time = get_image_ids(user_conn, object_type, [object_id], state.get(state_key))
+                n_object_image, saved = annotate_images(user_conn, image_ids, key)
+                n_image += n_object_image
+                if saved:
+                    advance_state(state, state_key, last_time)
 
                 # close the user connection
                 if conn.getUser().isAdmin():
@@ -308,8 +473,15 @@ def add_owner_as_keyval(conn, script_params):
             else:
                 print(object_type, object_id, "does not exist or you do not have access to it")
 
+    if incremental:
+        write_state(STATE_FILE, state)
+
     # build summary message
     message = f"Image owner was added to {n_image} image(s)"
+    if n_failed_groups > 0:
+        message += f", {n_failed_groups} group(s) failed"
+    for line in report:
+        print(line)
     print(message)
 
     return message
@@ -332,10 +504,20 @@ def run_script():
             P_IDS, optional=False, grouping="2",
             description="Object ID(s) or username(s).").ofType(rstring('')),
 
+        scripts.Bool(
+            P_INCREMENTAL, optional=True, grouping="3",
+            description="Only process the images created since the last run on the same object(s) or user(s)",
+            default=False),
+
+        scripts.Int(
+            P_GROUP_WORKERS, optional=True, grouping="4",
+            description="For admins running on users only: number of groups processed at the same time",
+            default=1, min=1),
+
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch",
-        version="2.0.0"
+        version="2.3.0"
     )
 
     try:
@@ -32,8 +32,10 @@ import omero.scripts as scripts
 from omero.gateway import BlitzGateway, PlateWrapper
 import omero
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from omero.rtypes import rint, rlong, rstring, robject, unwrap
+from omero.rtypes import rint, rlist, rlong, rstring, robject, unwrap
 
 P_DATA_TYPE = "Data_Type"
 P_IDS = "IDs"
@@ -47,62 +49,106 @@ P_COLUMN_NAME = "Column_Names"
 P_ROW_NAME = "Row_Names"
 P_SCREEN = "Screen"
 P_REMOVE_FROM_DATASET = "Remove_From_Dataset"
+P_WARM_THUMBNAILS = "Generate_Thumbnails"
 
 DEFAULT_PATTERN = "<select>"
 EVOS_TEMPLATE = "EVOS <..._Plate_<RunId>_p00_0_<wellA00>f00d0.tif>"
 VDG_TEMPLATE = "VDG-CREST-ORGANOIDS <<EDF_sigma-_?>000_<wellA00>_<runId>_....ome.tif>"
 CENFIND_TEMPLATE = "UPGON-CENFIND-SCREENS <wellA00>_<field00>_<runId>....tif>"
 
+# maximum number of wells saved in one call
+WELL_BATCH_SIZE = 200
+# maximum number of datasets converted at the same time
+CONVERSION_WORKERS = 4
+
+# script run on the new plates to generate their thumbnails, uploaded on the server with this one
+WARM_THUMBNAILS_SCRIPT = "Warm_Thumbnails.py"
+
 position_template_map = {
     EVOS_TEMPLATE : r".*_Plate_(?P<run>\w*)_p\d*_\d*_(?P<wellRow>\w)(?P<wellColumn>\d*)f(?P<field>\d*)d\d*.(TIF|tif|TIFF|tiff)",
     VDG_TEMPLATE : r"(?P<edf>EDF_sigma-\d*_)?\d*_(?P<wellRow>[a-zA-Z])(?P<wellColumn>\d*)_(?P<run>[a-zA-Z]*[\d])?_?.*",
     CENFIND_TEMPLATE : r"(?P<wellRow>[a-zA-Z])(?P<wellColumn>[0-9]*)_fld(?P<field>[0-9]*)_(?P<run>[a-zA-Z0-9]*).*"}
 
 
-def add_images_to_plate(conn, run_map, created_runs_map, plate_id, column, row, remove_from=None):
+def create_plate_acquisitions(conn, plate_id, run_keys):
     """
-    Add the Images to a Plate, creating a new well at the specified column and
-    row
-    NB - This will fail if there is already a well at that point
+    Create all the plate acquisitions (runs) of a Plate in one call
     """
-    update_service = conn.getUpdateService()
-    run_images = []
+    plate_acquisitions = []
+    for run_key in run_keys:
+        plate_acquisition = omero.model.PlateAcquisitionI()
+        plate_acquisition.name = omero.rtypes.RStringI(run_key)
+        plate_acquisition.plate = omero.model.PlateI(plate_id, False)
+        plate_acquisitions.append(plate_acquisition)
+    saved = conn.getUpdateService().saveAndReturnArray(plate_acquisitions, conn.SERVICE_OPTS)
+    return {run_key: run for run_key, run in zip(run_keys, saved)}
+
 
+def build_well(run_map, created_runs_map, plate_id, column, row):
+    """
+    Build, without saving it, a new well at the specified column and row, with
+    one well sample per Image
+    NB - Saving will fail if there is already a well at that point
+    """
     well = omero.model.WellI()
     well.plate = omero.model.PlateI(plate_id, False)
     well.column = rint(column)
     well.row = rint(row)
 
-    try:
-        # create wells with multiple images
-        for run_key in run_map.keys():
-            if created_runs_map.get(run_key) is None:
-                # create plate acquisition
-                plate_acquisition = omero.model.PlateAcquisitionI()
-                plate_acquisition.name = omero.rtypes.RStringI(run_key)
-                plate_acquisition.plate = omero.model.PlateI(plate_id, False)
-                plate_acquisition = update_service.saveAndReturnObject(plate_acquisition)
-                created_runs_map[run_key] = plate_acquisition
-            run_images = run_map[run_key]
-            run = created_runs_map[run_key]
-
-            for image in run_images:
-                ws = omero.model.WellSampleI()
-                ws.image = omero.model.ImageI(image.id, False)
-                ws.well = well
-                ws.plateAcquisition = omero.model.PlateAcquisitionI(run.id, False)
-                well.addWellSample(ws)
-        update_service.saveObject(well)
-    except Exception:
-        return False
+    # create wells with multiple images
+    for run_key, run_images in run_map.items():
+        run = created_runs_map[run_key]
+        for image in run_images:
+            ws = omero.model.WellSampleI()
+            ws.image = omero.model.ImageI(image.id, False)
+            ws.well = well
+            ws.plateAcquisition = omero.model.PlateAcquisitionI(run.id.val, False)
+            well.addWellSample(ws)
+    return well
+
+
+def add_images_to_plate(conn, well_map, plate_id, remove_from=None):
+    """
+    Add the Images to a Plate, creating all wells, well samples and plate
+    acquisitions in memory and saving them by batches of WELL_BATCH_SIZE wells.
+    Images are then removed from the Dataset in one delete request.
+    Returns the number of Images added to the Plate
+    """
+    update_service = conn.getUpdateService()
+    run_keys = sorted({run_key for run_map in well_map.values() for run_key in run_map.keys()})
+    created_runs_map = create_plate_acquisitions(conn, plate_id, run_keys)
+
+    wells = []
+    well_image_ids = []
+    for well_key, run_map in well_map.items():
+        row, col = well_key.split("_")
+        wells.append(build_well(run_map, created_runs_map, plate_id, int(col), int(row)))
+        well_image_ids.append([image.id for run_images in run_map.values() for image in run_images])
+
+    added_image_ids = []
+    for i in range(0, len(wells), WELL_BATCH_SIZE):
+        try:
+            update_service.saveArray(wells[i:i + WELL_BATCH_SIZE], conn.SERVICE_OPTS)
+        except Exception as e:
+            print(f"Cannot save wells {i} to {i + WELL_BATCH_SIZE}: {e}")
+            continue
+        for image_ids in well_image_ids[i:i + WELL_BATCH_SIZE]:
+            added_image_ids.extend(image_ids)
 
     # remove from Dataset
-    for image in run_images:
-        if remove_from is not None:
-            links = list(image.getParentLinks(remove_from.id))
-            link_ids = [link.id for link in links]
-            conn.deleteObjects('DatasetImageLink', link_ids)
-    return True
+    if remove_from is not None and len(added_image_ids) > 0:
+        # the saved well samples select the images, so the query does not bind one parameter per image
+        params = omero.sys.ParametersI()
+        params.addId(remove_from.id)
+        params.addLong("plate_id", plate_id)
+        query = "select link.id from DatasetImageLink link " \
+                "where link.parent.id = :id and link.child.id in " \
+                "(select ws.image.id from WellSample ws where ws.well.plate.id = :plate_id)"
+        link_ids = [unwrap(row[0]) for row in conn.getQueryService().projection(
+            query, params, conn.SERVICE_OPTS)]
+        if len(link_ids) > 0:
+            conn.deleteObjects('DatasetImageLink', link_ids, wait=True)
+    return len(added_image_ids)
 
 
 def dataset_to_plate(conn, script_params, dataset_id, screen):
@@ -147,19 +193,7 @@ def dataset_to_plate(conn, script_params, dataset_id, screen):
 
     # sort images in the right well, either by default layout or by reading image name
     well_map = sort_by_well(images, images_per_well, script_params)
-    created_runs_map = {}
-
-    for well_key in well_map.keys():
-        position = well_key.split("_")
-        row = position[0]
-        col = position[1]
-        run_map = well_map.get(well_key)
-        added_count = add_images_to_plate(conn, run_map, created_runs_map,
-                                          plate.getId().getValue(),
-                                          col, row, remove_from)
-    for run in created_runs_map.keys():
-        plate.addPlateAcquisition(created_runs_map[run])
-    update_service.saveObject(omero.model.PlateI(plate.id, False))
+    added_count = add_images_to_plate(conn, well_map, plate.getId().getValue(), remove_from)
 
     # if user wanted to delete dataset, AND it's empty we can delete dataset
     delete_dataset = False  # Turning this functionality off for now.
@@ -241,6 +275,39 @@ def convert_letter_to_number(letter):
     return ord(letter.upper()) - 65
 
 
+def launch_warm_thumbnails(conn, plate_ids):
+    """
+    Run the Warm_Thumbnails script on the plates and wait for it to finish
+
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    plate_ids: list
+        IDs of the plates
+
+    Returns
+    -------
+    message: str
+        output message of the script
+    """
+    script_service = conn.getScriptService()
+    script_files = [f for f in script_service.getScripts() if unwrap(f.name) == WARM_THUMBNAILS_SCRIPT]
+    if not script_files:
+        return "%s is not available on the server" % WARM_THUMBNAILS_SCRIPT
+
+    inputs = {"Data_Type": rstring("Plate"), "IDs": rlist([rlong(plate_id) for plate_id in plate_ids])}
+    process = script_service.runScript(script_files[0].id.val, inputs, None, conn.SERVICE_OPTS)
+    cb = scripts.ProcessCallbackI(conn.c, process)
+    try:
+        while process.poll() is None:
+            cb.block(1000)
+        results = process.getResults(0, conn.SERVICE_OPTS)
+    finally:
+        cb.close()
+    return unwrap(results["Message"]) if "Message" in results else "%s did not finish" % WARM_THUMBNAILS_SCRIPT
+
+
 def datasets_to_plates(conn, script_params):
     update_service = conn.getUpdateService()
 
@@ -251,23 +318,21 @@ def datasets_to_plates(conn, script_params):
     ids = script_params[P_IDS]
     datasets = list(conn.getObjects(dtype, ids))
 
-    def has_images_linked_to_well(dataset):
+    def get_datasets_linked_to_well(dataset_ids):
+        # one grouped query for all datasets
         params = omero.sys.ParametersI()
-        query = "select count(well) from Well as well " \
-                "left outer join well.wellSamples as ws " \
-                "left outer join ws.image as img " \
-                "where img.id in (:ids)"
-        params.addIds([i.getId() for i in dataset.listChildren()])
-        n_wells = unwrap(conn.getQueryService().projection(
-            query, params, conn.SERVICE_OPTS)[0])[0]
-        if n_wells > 0:
-            return True
-        else:
-            return False
+        query = "select link.parent.id, count(ws.id) from DatasetImageLink as link, " \
+                "WellSample as ws " \
+                "where ws.image.id = link.child.id and link.parent.id in (:ids) " \
+                "group by link.parent.id"
+        params.addIds(dataset_ids)
+        rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+        return {unwrap(row[0]) for row in rows if unwrap(row[1]) > 0}
 
     # Exclude datasets containing images already linked to a well
     n_datasets = len(datasets)
-    datasets = [x for x in datasets if not has_images_linked_to_well(x)]
+    linked_to_well = get_datasets_linked_to_well([x.getId() for x in datasets]) if datasets else set()
+    datasets = [x for x in datasets if x.getId() not in linked_to_well]
     if len(datasets) < n_datasets:
         message += "Excluded %s out of %s dataset(s). " \
                    % (n_datasets - len(datasets), n_datasets)
@@ -303,12 +368,22 @@ def datasets_to_plates(conn, script_params):
             newscreen = update_service.saveAndReturnObject(newscreen)
             screen = conn.getObject("Screen", newscreen.getId().getValue())
 
+    def convert(dataset_id):
+        start = time.time()
+        result = dataset_to_plate(conn, script_params, dataset_id, screen)
+        if result is not None:
+            print("Dataset %s converted to plate %s in %.1f s"
+                  % (dataset_id, result[0].getId().getValue(), time.time() - start))
+        return result
+
+    # convert independent datasets concurrently
+    with ThreadPoolExecutor(max_workers=CONVERSION_WORKERS) as executor:
+        results = [r for r in executor.map(convert, ids) if r is not None]
+
     plates = []
     links = []
     deletes = []
-    for dataset_id in ids:
-        plate, link, delete_handle = dataset_to_plate(conn, script_params,
-                                                      dataset_id, screen)
+    for plate, link, delete_handle in results:
         if plate is not None:
             plates.append(plate)
         if link is not None:
@@ -316,6 +391,12 @@ def datasets_to_plates(conn, script_params):
         if delete_handle is not None:
             deletes.append(delete_handle)
 
+    # pre-generate the thumbnails of the new plates
+    if plates and script_params.get(P_WARM_THUMBNAILS, False):
+        start = time.time()
+        thumbnails_message = launch_warm_thumbnails(conn, [plate.getId().getValue() for plate in plates])
+        print("Thumbnails: %s in %.1f s" % (thumbnails_message, time.time() - start))
+
     # wait for any deletes to finish
     for handle in deletes:
         cb = omero.callbacks.DeleteCallbackI(conn.c, handle)
@@ -429,7 +510,12 @@ See http://help.openmicroscopy.org/scripts.html""",
             description="Remove Images from Dataset as they are added to"
                         " Plate"),
 
-        version="4.3.2",
+        scripts.Bool(
+            P_WARM_THUMBNAILS, grouping="7", default=False,
+            description="Generate the thumbnails of the new Plate(s), so"
+                        " that they are ready when the Plate is opened"),
+
+        version="4.5.0",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
@@ -29,11 +29,20 @@
 """
 
 import shutil
-import pyminizip
+import pyzipper
 import omero.scripts as scripts
 from omero.gateway import BlitzGateway
-from omero.rtypes import rlong, rstring
+from omero.rtypes import rlong, rstring, unwrap
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import math
 import os
+import queue
+import threading
+import time
 import omero
 
 # constants for the UI
@@ -42,6 +51,8 @@ P_IDS = "IDs"
 P_ZIP_NAME = "Zip name"
 P_PASSWORD = "Password"
 P_ATT = "Download attachments for all objects"
+P_VOLUME_SIZE = "Maximum zip size (GB)"
+P_INCREMENTAL = "Only add new or changed files"
 
 # root SV-OPEN path
 root = "/mnt/svopen"
@@ -50,8 +61,265 @@ root = "/mnt/svopen"
 # need to be in the destination folder because permission denied on the server itself
 tmp_path = f"{root}/tmpDownloads/"
 
+# maximum number of IDs passed to one query
+QUERY_BATCH_SIZE = 1000
+# number of attachments downloaded at the same time
+ATTACHMENT_WORKERS = 4
+# size of the chunks read from OMERO when downloading attachments
+ATTACHMENT_CHUNK_SIZE = 16 * 1024 * 1024
+# name of the OMERO checksum algorithm computed by copy_attachment
+SHA1_HASHER = "SHA1-160"
+
+# (parent type, child type, query) to get the names of the selected containers and of their sub-containers
+CONTAINER_QUERIES = {
+    "Project": ("Project", "Dataset", "select p.id, p.name, d.id, d.name from Project p "
+                                      "left outer join p.datasetLinks l left outer join l.child d where p.id in (:ids)"),
+    "Dataset": ("Dataset", None, "select d.id, d.name from Dataset d where d.id in (:ids)"),
+    "Screen": ("Screen", "Plate", "select s.id, s.name, p.id, p.name from Screen s "
+                                  "left outer join s.plateLinks l left outer join l.child p where s.id in (:ids)"),
+    "Plate": ("Plate", None, "select p.id, p.name from Plate p where p.id in (:ids)"),
+}
+
+# (direct container type, query) to get the filesets of all images within the selected objects
+FILESET_QUERIES = {
+    "Image": (None, "select i.id, i.fileset.id from Image i where i.id in (:ids) and i.fileset is not null"),
+    "Dataset": ("Dataset", "select l.parent.id, i.fileset.id from DatasetImageLink l join l.child i "
+                           "where l.parent.id in (:ids) and i.fileset is not null"),
+    "Project": ("Dataset", "select dl.parent.id, i.fileset.id from ProjectDatasetLink pl, DatasetImageLink dl "
+                           "join dl.child i where dl.parent.id = pl.child.id and pl.parent.id in (:ids) "
+                           "and i.fileset is not null"),
+    "Plate": ("Plate", "select w.plate.id, i.fileset.id from WellSample ws join ws.well w join ws.image i "
+                       "where w.plate.id in (:ids) and i.fileset is not null"),
+    "Screen": ("Plate", "select w.plate.id, i.fileset.id from ScreenPlateLink sl, WellSample ws join ws.well w "
+                        "join ws.image i where w.plate.id = sl.child.id and sl.parent.id in (:ids) "
+                        "and i.fileset is not null"),
+}
+
+# prefix of the attachment ids of each container type
+ATTACHMENT_KEYS = {"Project": "p", "Dataset": "d", "Screen": "s", "Plate": "pl"}
+
+# number of workers used to prepare the files to zip
+ZIP_WORKERS = 8
+# maximum number of zip volumes written at the same time
+VOLUME_WORKERS = 4
+# size of the chunks streamed into the zip file
+ZIP_CHUNK_SIZE = 8 * 1024 * 1024
+# deflate level of the compressed entries: fastest
+ZIP_COMPRESS_LEVEL = 1
+# number of chunks read ahead of the compression
+READ_AHEAD_CHUNKS = 8
+# interval, in seconds, between two progress reports
+PROGRESS_INTERVAL = 30
+
+# file formats that are already compressed, and are stored as is in the zip
+STORED_EXTENSIONS = {".czi", ".nd2", ".svs", ".ndpi", ".scn", ".vsi", ".ets", ".mrxs", ".jp2",
+                     ".jpg", ".jpeg", ".png", ".gif", ".webp", ".zip", ".gz", ".bz2", ".xz", ".7z",
+                     ".zst", ".rar", ".mp4", ".avi", ".mov", ".mkv"}
+# number of bytes read at the beginning of a file to estimate its entropy
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+# entropy (bits per byte) above which a file is considered as already compressed
+ENTROPY_THRESHOLD = 7.5
+
+
+class ProgressReporter:
+    """
+    Report the number of bytes written in the zip file and the current throughput
+    """
+    def __init__(self, total_bytes, label="Zipped"):
+        self.total_bytes = total_bytes
+        self.label = label
+        self.written_bytes = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def update(self, n_bytes):
+        self.written_bytes += n_bytes
+        now = time.time()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        percent = 100 * self.written_bytes / self.total_bytes if self.total_bytes > 0 else 100
+        print(f"{self.label} {self.written_bytes / 1024 ** 3:.2f} / {self.total_bytes / 1024 ** 3:.2f} GB "
+              f"({percent:.1f}%) at {self.written_bytes / 1024 ** 2 / elapsed:.1f} MB/s")
+
+
+def is_already_compressed(file_path):
+    """
+    Check if a file is already compressed, based on its extension or,
+    for unknown extensions, on the entropy of its first bytes
+
+    Parameters
+    ----------
+    file_path: str
+        absolute path of the file
+
+    Returns
+    -------
+    compressed: bool
+        True if compressing the file again would not reduce its size
+    """
+    if os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS:
+        return True
+
+    with open(file_path, 'rb') as f:
+        sample = f.read(ENTROPY_SAMPLE_SIZE)
+    if len(sample) == 0:
+        return False
+    entropy = 0
+    for count in Counter(sample).values():
+        frequency = count / len(sample)
+        entropy -= frequency * math.log2(frequency)
+    return entropy >= ENTROPY_THRESHOLD
+
+
+def get_arcname(file_path, prefix):
+    """
+    Get the name of a file inside the zip
+
+    Parameters
+    ----------
+    file_path: str
+        absolute path of the file to zip
+    prefix: str
+        inner zip hierarchy path
+
+    Returns
+    -------
+    arcname: str
+        path of the file inside the zip
+    """
+    return f"{prefix}/{os.path.basename(file_path)}" if prefix else os.path.basename(file_path)
+
+
+def get_zip_entry(file_path, prefix):
+    """
+    Prepare the zip entry of a file
+
+    Parameters
+    ----------
+    file_path: str
+        absolute path of the file to zip
+    prefix: str
+        inner zip hierarchy path
+
+    Returns
+    -------
+    entry: tuple
+        (file_path, name in the zip, compression type, file size)
+    """
+    arcname = get_arcname(file_path, prefix)
+    compress_type = pyzipper.ZIP_STORED if is_already_compressed(file_path) else pyzipper.ZIP_DEFLATED
+    return file_path, arcname, compress_type, os.path.getsize(file_path)
+
+
+def write_protected_zip(zip_path, fs_path_list, fs_prefix_list, password, label="Zipped"):
+    """
+    Stream all files in an AES-encrypted zip file (Zip64).
+    Already compressed files are stored without compression.
+
+    Parameters
+    ----------
+    zip_path: str
+        absolute path of the zip file to create
+    fs_path_list: list
+        all file paths, images and attachments
+    fs_prefix_list: list
+        all inner zip hierarchy path, corresponding one by one to the file paths
+    password: str
+        password of the zip file
+    label: str
+        prefix of the progress messages
+
+    Returns
+    -------
 
-def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict):
+    """
+    # sniff the files in parallel to choose the compression of each of them
+    with ThreadPoolExecutor(max_workers=ZIP_WORKERS) as executor:
+        entries = list(executor.map(get_zip_entry, fs_path_list, fs_prefix_list))
+
+    n_stored = sum(1 for entry in entries if entry[2] == pyzipper.ZIP_STORED)
+    print(f"{os.path.basename(zip_path)}: {len(entries)} files to zip, {n_stored} of them already compressed and stored as is")
+
+    progress = ProgressReporter(sum(entry[3] for entry in entries), label)
+
+    # the files are read by a separate thread, so that disk reads overlap with compression & encryption
+    chunks = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_entries, args=(entries, chunks, stop), daemon=True)
+    reader.start()
+    try:
+        with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED,
+                                 compresslevel=ZIP_COMPRESS_LEVEL, encryption=pyzipper.WZ_AES,
+                                 allowZip64=True) as zf:
+            zf.setpassword(password.encode("utf-8"))
+            for file_path, arcname, compress_type, _ in entries:
+                zinfo = zf.zipinfo_cls.from_file(file_path, arcname)
+                zinfo.compress_type = compress_type
+                # the level given to the zip file is not applied to entries opened with an explicit ZipInfo
+                zinfo._compresslevel = ZIP_COMPRESS_LEVEL
+                with zf.open(zinfo, 'w', force_zip64=True) as dst:
+                    while True:
+                        chunk = chunks.get()
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        if chunk is None:
+                            break
+                        dst.write(chunk)
+                        progress.update(len(chunk))
+    finally:
+        stop.set()
+        reader.join()
+    progress.report()
+
+
+def read_entries(entries, chunks, stop):
+    """
+    Read the files to zip, one after the other, and put their chunks in the queue.
+    The end of each file is marked with None; a read error is put in the queue and stops the reading.
+
+    Parameters
+    ----------
+    entries: list
+        (file_path, name in the zip, compression type, file size) of the files to zip
+    chunks: queue.Queue
+        bounded queue of the chunks
+    stop: threading.Event
+        set by the writer to stop reading
+
+    Returns
+    -------
+
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for file_path, _, _, _ in entries:
+            with open(file_path, 'rb') as src:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not put(chunk):
+                        return
+            if not put(None):
+                return
+    except Exception as e:
+        put(e)
+
+
+def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, fs_size_dict,
+                     fs_hash_dict, att_hash_dict):
     """
     Get the full list of file (images + attachments) path
 
@@ -67,6 +335,12 @@ def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_pref
         Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
     att_prefix_dict: dict
         Dictionary of [att_id]:[inner_zip_hierarchy_path]
+    fs_size_dict: dict
+        Dictionary of [fileset_id]:[fileset_file_sizes]
+    fs_hash_dict: dict
+        Dictionary of [fileset_id]:[fileset_file_sha1]
+    att_hash_dict: dict
+        Dictionary of [attachment_path]:[attachment_sha1]
 
     Returns
     -------
@@ -74,9 +348,18 @@ def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_pref
         all file paths, images and attachments
     fs_prefix_list: list
         all inner zip hierarchy path, corresponding one by one to the file paths
+    fs_group_list: list
+        fileset or attachment id each file belongs to, corresponding one by one to the file paths
+    fs_file_size_list: list
+        size of each file, corresponding one by one to the file paths
+    fs_hash_list: list
+        SHA1 of each file, as stored on OMERO, corresponding one by one to the file paths
     """
     fs_path_list = []
     fs_prefix_list = []
+    fs_group_list = []
+    fs_file_size_list = []
+    fs_hash_list = []
 
     # get the managedRepository
     resources = conn.c.sf.sharedResources()
@@ -90,9 +373,12 @@ def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_pref
         # adding images
         for fs_id, fs_paths in fs_path_dict.items():
             fs_prefix = fs_prefix_dict[fs_id]
-            for fs_path in fs_paths:
+            for fs_path, fs_size, fs_hash in zip(fs_paths, fs_size_dict[fs_id], fs_hash_dict[fs_id]):
                 fs_path_list.append(managed_repo_dir + "/" + fs_path)
                 fs_prefix_list.append(fs_prefix)
+                fs_group_list.append(fs_id)
+                fs_file_size_list.append(fs_size)
+                fs_hash_list.append(fs_hash)
 
         # adding attachments
         for fs_id, att_paths in att_path_dict.items():
@@ -100,276 +386,540 @@ def prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_pref
             for att_path in att_paths:
                 fs_path_list.append(att_path)
                 fs_prefix_list.append(att_prefix)
+                fs_group_list.append(fs_id)
+                fs_file_size_list.append(os.path.getsize(att_path))
+                fs_hash_list.append(att_hash_dict.get(att_path))
     else:
         print("No managed repository found. Cannot create the zip file.")
 
-    return fs_path_list, fs_prefix_list
+    return fs_path_list, fs_prefix_list, fs_group_list, fs_file_size_list, fs_hash_list
 
 
-def copy_attachment(file_path, ann):
+def read_checksums(checksums_path):
     """
-    Do a hard copy of the current file
+    Read the checksum manifest of a previous incremental download
 
     Parameters
     ----------
-    file_path: str
-        absolute path of the annotation file to copy
-    ann: omero.model.Annotation
-        file to copy
+    checksums_path: str
+        absolute path of the checksum manifest
 
     Returns
     -------
-
+    checksums: dict
+        {"archives": [zip names], "files": {[name in the zip]: {"size": size, "sha1": sha1}}}
     """
-    with open(str(file_path), 'wb') as f:
-        print("Copying file to", file_path, "...")
-        for chunk in ann.getFileInChunks():
-            f.write(chunk)
+    if not os.path.exists(checksums_path):
+        return {"archives": [], "files": {}}
+    with open(checksums_path, 'r') as f:
+        return json.load(f)
 
 
-def process_attachment(container, att_path_dict, att_id):
+def previous_archives_exist(zip_dir, checksums):
     """
-    Do a hard copy of all the attachments linked to the current object
+    Check that all the archives of the previous incremental downloads are still available
 
     Parameters
     ----------
-    container: omero.model.Object
-        The object to get attachments from
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
-    att_id: int or str
-        attachment id linked to the current fileset
+    zip_dir: str
+        folder of the zip files
+    checksums: dict
+        checksum manifest of the previous downloads
 
     Returns
     -------
-
+    exist: bool
+        True if there was a previous download and all its archives still exist
     """
-    for ann in container.listAnnotations():
-        # only process attachments, not other types of annotations
-        if ann.OMERO_TYPE == omero.model.FileAnnotationI:
-            file_path = os.path.join(tmp_path, f"{ann.getFile().getId()}_{ann.getFile().getName()}")
-            if not os.path.exists(file_path):
-                try:
-                    # do a hard copy of the attachment, with right name & extension
-                    # i.e. human-readable
-                    copy_attachment(file_path, ann)
-                    att_path_dict[att_id].append(file_path)
-                except Exception as e:
-                    print(f"ERROR: cannot copy attachment for {container.OMERO_CLASS} {container.getId()}: {e}")
+    return len(checksums["archives"]) > 0 and \
+        all(os.path.exists(os.path.join(zip_dir, name)) for name in checksums["archives"])
 
 
-def process_image(image, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments):
+def get_changed_files(checksums, fs_path_list, fs_prefix_list, fs_file_size_list, fs_hash_list):
     """
-    get the all image(s) server path coming from the same current fileset, including attachments
+    Compare the files to download with the checksum manifest of the previous downloads
 
     Parameters
     ----------
-    image: omero.model.Image object
-        The image to process
-    parent_prefix: list
-        folder names under which the images will be downloaded (inner zip hierarchy)
-    fs_path_dict: dict
-        Dictionary of [fileset_id]:[fileset_server_path]
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
-    fs_prefix_dict: dict
-        Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
-    att_prefix_dict: dict
-        Dictionary of [att_id]:[inner_zip_hierarchy_path]
-    download_attachments: bool
-        True to download attachments
+    checksums: dict
+        checksum manifest of the previous downloads
+    fs_path_list: list
+        all file paths, images and attachments
+    fs_prefix_list: list
+        all inner zip hierarchy path, corresponding one by one to the file paths
+    fs_file_size_list: list
+        size of each file
+    fs_hash_list: list
+        SHA1 of each file
 
     Returns
     -------
-
+    indices: list
+        indices of the new or changed files
     """
+    indices = []
+    for idx, (fs_path, fs_prefix) in enumerate(zip(fs_path_list, fs_prefix_list)):
+        previous = checksums["files"].get(get_arcname(fs_path, fs_prefix))
+        if previous is None or previous["size"] != fs_file_size_list[idx] or previous["sha1"] != fs_hash_list[idx]:
+            indices.append(idx)
+    return indices
 
-    # get the current fileset
-    fs = image.getFileset()
-
-    if not fs:
-        print("ERROR", f"ERROR: no original file(s) for [%s] found!" % image.getId())
 
-    # only get image paths if the fileset has not been processed yet
-    fs_id = fs.getId()
-    if fs_id in fs_path_dict:
-        print("WARNING", f"Image {image.getId()} part of the same fileset {fs_id}! Skipping...")
-    else:
-        print(f"Getting server path(s) for fileset {fs_id}...")
-        fs_path_dict[fs_id] = []
-        fileset_prefix = parent_prefix[:]
-        fileset_prefix.append(f"Fileset_{fs_id}")
-        fs_prefix_dict[fs_id] = "/".join(fileset_prefix)
+def write_checksums(checksums_path, checksums, archive_names, fs_path_list, fs_prefix_list, fs_file_size_list,
+                    fs_hash_list):
+    """
+    Add the newly zipped files to the checksum manifest
 
-        # get paths for all images within the fileset
-        for file_wrapper in fs.listFiles():
-            fs_path_dict[fs_id].append(file_wrapper.getPath() + file_wrapper.getName())
+    Parameters
+    ----------
+    checksums_path: str
+        absolute path of the checksum manifest
+    checksums: dict
+        checksum manifest of the previous downloads
+    archive_names: list
+        names of the zip files created by this download
+    fs_path_list: list
+        paths of the zipped files
+    fs_prefix_list: list
+        inner zip hierarchy path, corresponding one by one to the file paths
+    fs_file_size_list: list
+        size of each file
+    fs_hash_list: list
+        SHA1 of each file
 
-        if download_attachments:
-            att_path_dict[fs_id] = []
-            att_prefix_dict[fs_id] = "/".join(fileset_prefix)
+    Returns
+    -------
 
-            # get all attachments from the entire fileset i.e. all images linked to the current fileset
-            for linked_image in fs.copyImages():
-                process_attachment(linked_image, att_path_dict, fs_id)
+    """
+    checksums["archives"].extend(archive_names)
+    for fs_path, fs_prefix, fs_size, fs_hash in zip(fs_path_list, fs_prefix_list, fs_file_size_list, fs_hash_list):
+        checksums["files"][get_arcname(fs_path, fs_prefix)] = {"size": fs_size, "sha1": fs_hash}
+    with open(checksums_path, 'w') as f:
+        json.dump(checksums, f, indent=2)
 
 
-def process_dataset(dataset, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments):
+def pack_volumes(fs_group_list, fs_file_size_list, max_volume_size):
     """
-    Loop over all images within the current dataset and get their server path, including attachments
+    Distribute the filesets into volumes of limited size (first-fit decreasing bin-packing).
+    A fileset is never split across two volumes ; a fileset bigger than the maximum size
+    gets its own volume.
 
     Parameters
     ----------
-    dataset: omero.model.Dataset object
-        The dataset to process
-    parent_prefix: list
-        folder names under which the images will be downloaded (inner zip hierarchy)
-    fs_path_dict: dict
-        Dictionary of [fileset_id]:[fileset_server_path]
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
-    fs_prefix_dict: dict
-        Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
-    att_prefix_dict: dict
-        Dictionary of [att_id]:[inner_zip_hierarchy_path]
-    download_attachments: bool
-        True to download attachments
+    fs_group_list: list
+        fileset or attachment id each file belongs to
+    fs_file_size_list: list
+        size of each file, corresponding one by one to fs_group_list
+    max_volume_size: int
+        maximum size of a volume, in bytes
 
     Returns
     -------
+    volumes: list of list
+        for each volume, the indices of the files it contains
+    """
+    group_files = {}
+    group_sizes = {}
+    for idx, (group, size) in enumerate(zip(fs_group_list, fs_file_size_list)):
+        group_files.setdefault(group, []).append(idx)
+        group_sizes[group] = group_sizes.get(group, 0) + size
+
+    volumes = []
+    volume_sizes = []
+    for group in sorted(group_sizes, key=group_sizes.get, reverse=True):
+        size = group_sizes[group]
+        for i, volume_size in enumerate(volume_sizes):
+            if volume_size + size <= max_volume_size:
+                volumes[i].extend(group_files[group])
+                volume_sizes[i] += size
+                break
+        else:
+            if size > max_volume_size:
+                print(f"WARNING: {group} is bigger than the maximum zip size ; it gets its own zip file")
+            volumes.append(list(group_files[group]))
+            volume_sizes.append(size)
+
+    return volumes
+
+
+def write_protected_volumes(zip_path, fs_path_list, fs_prefix_list, fs_group_list, fs_file_size_list,
+                            password, max_volume_size):
+    """
+    Split the files in several password-protected zip files, written in parallel,
+    and write a manifest listing the volumes and their content
 
+    Parameters
+    ----------
+    zip_path: str
+        absolute path of the zip file, without volume number
+    fs_path_list: list
+        all file paths, images and attachments
+    fs_prefix_list: list
+        all inner zip hierarchy path, corresponding one by one to the file paths
+    fs_group_list: list
+        fileset or attachment id each file belongs to
+    fs_file_size_list: list
+        size of each file
+    password: str
+        password of the zip files
+    max_volume_size: int
+        maximum size of a volume, in bytes
+
+    Returns
+    -------
+    manifest_path: str
+        absolute path of the manifest
+    volume_paths: list
+        absolute path of each volume
     """
-    dataset_prefix = parent_prefix[:]
-    dataset_prefix.append(f"Dataset_{dataset.getName()}_{dataset.getId()}")
+    volumes = pack_volumes(fs_group_list, fs_file_size_list, max_volume_size)
+    zip_root = zip_path[:-len(".zip")]
+    volume_paths = [f"{zip_root}.part{i + 1:03d}.zip" for i in range(len(volumes))]
+    print(f"Splitting {len(fs_path_list)} files into {len(volumes)} zip files")
+
+    def write_volume(i):
+        indices = volumes[i]
+        write_protected_zip(volume_paths[i], [fs_path_list[idx] for idx in indices],
+                            [fs_prefix_list[idx] for idx in indices], password,
+                            label=f"[{i + 1}/{len(volumes)}] Zipped")
+
+    with ThreadPoolExecutor(max_workers=VOLUME_WORKERS) as executor:
+        # list() to propagate the errors raised in the workers
+        list(executor.map(write_volume, range(len(volumes))))
+
+    manifest = {"volumes": []}
+    for volume_path, indices in zip(volume_paths, volumes):
+        manifest["volumes"].append({
+            "name": os.path.basename(volume_path),
+            "size": os.path.getsize(volume_path),
+            "files": [get_arcname(fs_path_list[idx], fs_prefix_list[idx]) for idx in indices]
+        })
+    manifest_path = f"{zip_root}_manifest.json"
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest_path, volume_paths
+
+
+def get_file_sha1(file_path, chunk_size):
+    """
+    Compute the SHA1 of a local file
 
-    # get attachments paths
-    if download_attachments:
-        att_id = f"d{dataset.getId()}"
-        att_path_dict[att_id] = []
-        att_prefix_dict[att_id] = "/".join(dataset_prefix)
-        process_attachment(dataset, att_path_dict, att_id)
+    Parameters
+    ----------
+    file_path: str
+        absolute path of the file
+    chunk_size: int
+        number of bytes read at once
 
-    for image in dataset.listChildren():
-       process_image(image, dataset_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments)
+    Returns
+    -------
+    sha1: str
+        hexadecimal SHA1 of the file
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
 
-def process_project(project, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments):
+def copy_attachment(conn, store, file_path, file_id, file_hash, chunk_size):
     """
-    Loop over all datasets within the current project and get their server path, including attachments
+    Do a hard copy of the current file, unless an identical copy already exists.
+    The file is downloaded to a temporary file, verified against the OMERO SHA1 and then renamed.
 
     Parameters
     ----------
-    project: omero.model.Project object
-        The project to process
-    parent_prefix: list
-        folder names under which the images will be downloaded (inner zip hierarchy)
-    fs_path_dict: dict
-        Dictionary of [fileset_id]:[fileset_server_path]
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
-    fs_prefix_dict: dict
-        Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
-    att_prefix_dict: dict
-        Dictionary of [att_id]:[inner_zip_hierarchy_path]
-    download_attachments: bool
-        True to download attachments
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    store: omero.api.RawFileStorePrx
+        raw file store used to read the file
+    file_path: str
+        absolute path of the annotation file to copy
+    file_id: int
+        ID of the original file to copy
+    file_hash: str
+        SHA1 of the original file on OMERO ; None to skip the verification (e.g. file hashed with another algorithm)
+    chunk_size: int
+        number of bytes read at once
 
     Returns
     -------
+    copied: bool
+        True if the file was copied, False if an identical copy already exists
+    """
+    if os.path.exists(file_path) and file_hash is not None and get_file_sha1(file_path, chunk_size) == file_hash:
+        print("Skipping", file_path, ": already downloaded")
+        return False
+
+    print("Copying file to", file_path, "...")
+    store.setFileId(file_id, conn.SERVICE_OPTS)
+    size = store.size(conn.SERVICE_OPTS)
+    sha1 = hashlib.sha1()
+    tmp_file_path = f"{file_path}.part"
+    with open(tmp_file_path, 'wb') as f:
+        offset = 0
+        while offset < size:
+            chunk = store.read(offset, min(chunk_size, size - offset), conn.SERVICE_OPTS)
+            f.write(chunk)
+            sha1.update(chunk)
+            offset += len(chunk)
+
+    if file_hash is not None and sha1.hexdigest() != file_hash:
+        os.remove(tmp_file_path)
+        raise IOError(f"SHA1 of the downloaded file {file_id} does not match the one on OMERO")
+    os.replace(tmp_file_path, file_path)
+    return True
+
 
+def download_attachments(conn, attachments, chunk_size=ATTACHMENT_CHUNK_SIZE, n_workers=ATTACHMENT_WORKERS):
     """
-    project_prefix = parent_prefix[:]
-    project_prefix.append(f"Project_{project.getName()}_{project.getId()}")
+    Download attachments in parallel, each worker reading through its own raw file store
+
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    attachments: list of tuple
+        (file_path, original_file_id, original_file_sha1) of each attachment to download
+    chunk_size: int
+        number of bytes read at once
+    n_workers: int
+        maximum number of files downloaded at the same time
 
-    # get attachments paths
-    if download_attachments:
-        att_id = f"p{project.getId()}"
-        att_path_dict[att_id] = []
-        att_prefix_dict[att_id] = "/".join(project_prefix)
-        process_attachment(project, att_path_dict, att_id)
+    Returns
+    -------
+    downloaded_paths: set
+        paths of the attachments available locally, either copied or already present
+    """
+    local = threading.local()
+    stores = []
+    stores_lock = threading.Lock()
+
+    def download(attachment):
+        file_path, file_id, file_hash = attachment
+        if not hasattr(local, "store"):
+            local.store = conn.c.sf.createRawFileStore()
+            with stores_lock:
+                stores.append(local.store)
+        try:
+            copy_attachment(conn, local.store, file_path, file_id, file_hash, chunk_size)
+            return file_path
+        except Exception as e:
+            print(f"ERROR: cannot copy attachment {file_id}: {e}")
+            return None
 
-    for dataset in project.listChildren():
-        process_dataset(dataset, project_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments)
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            downloaded_paths = {path for path in executor.map(download, attachments) if path is not None}
+    finally:
+        for store in stores:
+            store.close()
+    return downloaded_paths
 
 
-def process_screen(screen, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments):
+def query_in_batches(conn, query, ids):
     """
-    Loop over all screens within the current project and get their server path, including attachments
+    Run an HQL projection on a list of IDs, by batches of QUERY_BATCH_SIZE IDs
 
     Parameters
     ----------
-    screen: omero.model.Screen object
-        The screen to process
-    parent_prefix: list
-        folder names under which the images will be downloaded (inner zip hierarchy)
-    fs_path_dict: dict
-        Dictionary of [fileset_id]:[fileset_server_path]
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
-    fs_prefix_dict: dict
-        Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
-    att_prefix_dict: dict
-        Dictionary of [att_id]:[inner_zip_hierarchy_path]
-    download_attachments: bool
-        True to download attachments
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    query: str
+        HQL query, with a `:ids` parameter
+    ids: list
+        IDs to pass to the query
 
     Returns
     -------
+    rows: list of list
+        unwrapped rows of all batches
+    """
+    qs = conn.getQueryService()
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), QUERY_BATCH_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(ids[i:i + QUERY_BATCH_SIZE])
+        for row in qs.projection(query, params, conn.SERVICE_OPTS):
+            rows.append([unwrap(value) for value in row])
+    return rows
+
+
+def get_container_prefixes(conn, object_type, object_ids):
+    """
+    Get the inner zip hierarchy path of the selected containers and of their sub-containers
 
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    object_type: str
+        type of the selected objects
+    object_ids: list
+        IDs of the selected objects
+
+    Returns
+    -------
+    container_prefix_dict: dict
+        Dictionary of [(container_type, container_id)]:[inner_zip_hierarchy_path]
     """
-    screen_prefix = parent_prefix[:]
-    screen_prefix.append(f"Screen_{screen.getName()}_{screen.getId()}")
+    container_prefix_dict = {}
+    if object_type not in CONTAINER_QUERIES:
+        return container_prefix_dict
 
-    # get attachments paths
-    if download_attachments:
-        att_id = f"s{screen.getId()}"
-        att_path_dict[att_id] = []
-        att_prefix_dict[att_id] = "/".join(screen_prefix)
-        process_attachment(screen, att_path_dict, att_id)
+    parent_type, child_type, query = CONTAINER_QUERIES[object_type]
+    for row in query_in_batches(conn, query, object_ids):
+        parent_prefix = f"{parent_type}_{row[1]}_{row[0]}"
+        container_prefix_dict[(parent_type, row[0])] = parent_prefix
+        if child_type is not None and row[2] is not None:
+            container_prefix_dict[(child_type, row[2])] = f"{parent_prefix}/{child_type}_{row[3]}_{row[2]}"
+    return container_prefix_dict
 
-    for plate in screen.listChildren():
-        process_plate(plate, screen_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments)
 
+def get_fileset_prefixes(conn, object_type, object_ids, container_prefix_dict):
+    """
+    Get the filesets of all images within the selected objects, with their inner zip hierarchy path.
+    A fileset shared by several containers is only kept once, under the first container.
 
-def process_plate(plate, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments):
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    object_type: str
+        type of the selected objects
+    object_ids: list
+        IDs of the selected objects
+    container_prefix_dict: dict
+        Dictionary of [(container_type, container_id)]:[inner_zip_hierarchy_path]
+
+    Returns
+    -------
+    fs_prefix_dict: dict
+        Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
+    image_ids: set
+        IDs of the selected images having a fileset ; empty if the selected objects are containers
     """
-    Loop over all plates within the current project and get their server path, including attachments
+    fs_prefix_dict = {}
+    image_ids = set()
+    container_type, query = FILESET_QUERIES[object_type]
+    for container_id, fs_id in sorted(query_in_batches(conn, query, object_ids)):
+        if container_type is None:
+            image_ids.add(container_id)
+        if fs_id in fs_prefix_dict:
+            continue
+        if container_type is None:
+            fs_prefix_dict[fs_id] = f"Fileset_{fs_id}"
+        else:
+            fs_prefix_dict[fs_id] = f"{container_prefix_dict[(container_type, container_id)]}/Fileset_{fs_id}"
+    return fs_prefix_dict, image_ids
+
+
+def get_fileset_files(conn, fs_ids):
+    """
+    Get the server path and size of all files of the filesets
 
     Parameters
     ----------
-    plate: omero.model.Plate object
-        The plate to process
-    parent_prefix: list
-        folder names under which the images will be downloaded (inner zip hierarchy)
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    fs_ids: list
+        IDs of the filesets
+
+    Returns
+    -------
     fs_path_dict: dict
         Dictionary of [fileset_id]:[fileset_server_path]
-    att_path_dict: dict
-        Dictionary of [att_id]:[attachment_path]
+    fs_size_dict: dict
+        Dictionary of [fileset_id]:[fileset_file_sizes]
+    fs_hash_dict: dict
+        Dictionary of [fileset_id]:[fileset_file_sha1]
+    """
+    query = "select fe.fileset.id, f.path, f.name, f.size, f.hash from FilesetEntry fe join fe.originalFile f " \
+            "where fe.fileset.id in (:ids) order by fe.fileset.id, fe.id"
+    fs_path_dict = {fs_id: [] for fs_id in fs_ids}
+    fs_size_dict = {fs_id: [] for fs_id in fs_ids}
+    fs_hash_dict = {fs_id: [] for fs_id in fs_ids}
+    for fs_id, path, name, size, sha1 in query_in_batches(conn, query, fs_ids):
+        fs_path_dict[fs_id].append(path + name)
+        fs_size_dict[fs_id].append(size or 0)
+        fs_hash_dict[fs_id].append(sha1)
+    return fs_path_dict, fs_size_dict, fs_hash_dict
+
+
+def get_attachments(conn, container_prefix_dict, fs_prefix_dict, att_path_dict, att_prefix_dict, att_hash_dict):
+    """
+    Do a hard copy of all the attachments linked to the containers and to the images of the filesets
+
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    container_prefix_dict: dict
+        Dictionary of [(container_type, container_id)]:[inner_zip_hierarchy_path]
     fs_prefix_dict: dict
         Dictionary of [fileset_id]:[inner_zip_hierarchy_path]
+    att_path_dict: dict
+        Dictionary of [att_id]:[attachment_path]
     att_prefix_dict: dict
         Dictionary of [att_id]:[inner_zip_hierarchy_path]
-    download_attachments: bool
-        True to download attachments
+    att_hash_dict: dict
+        Dictionary of [attachment_path]:[attachment_sha1]
 
     Returns
     -------
 
     """
-    plate_prefix = parent_prefix[:]
-    plate_prefix.append(f"Plate_{plate.getName()}_{plate.getId()}")
-
-    # get attachments paths
-    if download_attachments:
-        att_id = f"pl{plate.getId()}"
-        att_path_dict[att_id] = []
-        att_prefix_dict[att_id] = "/".join(plate_prefix)
-        process_attachment(plate, att_path_dict, att_id)
-
-    for well in plate.listChildren():
-        index = well.countWellSample()
-        for idx in range(0, index):
-            process_image(well.getImage(idx), plate_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, download_attachments)
+    # (annotation_id, att_id) of all attachments to copy
+    ann_att_ids = []
+
+    # attachments of the containers
+    for container_type, att_key in ATTACHMENT_KEYS.items():
+        container_ids = [c_id for c_type, c_id in container_prefix_dict if c_type == container_type]
+        if len(container_ids) == 0:
+            continue
+        query = f"select l.parent.id, a.id from {container_type}AnnotationLink l, FileAnnotation a " \
+                f"where a.id = l.child.id and l.parent.id in (:ids)"
+        for container_id in container_ids:
+            att_id = f"{att_key}{container_id}"
+            att_path_dict[att_id] = []
+            att_prefix_dict[att_id] = container_prefix_dict[(container_type, container_id)]
+        for container_id, ann_id in query_in_batches(conn, query, container_ids):
+            ann_att_ids.append((ann_id, f"{att_key}{container_id}"))
+
+    # attachments of all images linked to the filesets
+    query = "select i.fileset.id, a.id from ImageAnnotationLink l join l.parent i, FileAnnotation a " \
+            "where a.id = l.child.id and i.fileset.id in (:ids)"
+    for fs_id, fs_prefix in fs_prefix_dict.items():
+        att_path_dict[fs_id] = []
+        att_prefix_dict[fs_id] = fs_prefix
+    for fs_id, ann_id in query_in_batches(conn, query, fs_prefix_dict.keys()):
+        ann_att_ids.append((ann_id, fs_id))
+
+    # copy each attachment once, even if linked to several objects,
+    # with right name & extension i.e. human-readable
+    query = "select a.id, f.id, f.name, f.hash, h.value from FileAnnotation a join a.file f " \
+            "left outer join f.hasher h where a.id in (:ids)"
+    ann_paths = {}
+    attachments = {}
+    for ann_id, file_id, file_name, file_hash, hasher in query_in_batches(conn, query,
+                                                                         {ann_id for ann_id, _ in ann_att_ids}):
+        file_path = os.path.join(tmp_path, f"{file_id}_{file_name}")
+        ann_paths[ann_id] = file_path
+        att_hash_dict[file_path] = file_hash
+        # only SHA1 hashes can be checked against the downloaded file
+        attachments[file_path] = (file_path, file_id, file_hash if hasher == SHA1_HASHER else None)
+    downloaded_paths = download_attachments(conn, list(attachments.values()))
+
+    for ann_id, att_id in ann_att_ids:
+        file_path = ann_paths.get(ann_id)
+        if file_path in downloaded_paths and file_path not in att_path_dict[att_id]:
+            att_path_dict[att_id].append(file_path)
 
 
 def download_and_zip_images(conn, script_params):
@@ -400,7 +950,11 @@ def download_and_zip_images(conn, script_params):
     # password
     password = script_params[P_PASSWORD]
     # download attachments for all images
-    dwnld_atts = script_params[P_ATT]
+    dwnld_atts = script_params.get(P_ATT, False)
+    # maximum size of each zip file ; 0 for a single zip file
+    max_volume_size = int(script_params.get(P_VOLUME_SIZE, 0) * 1024 ** 3)
+    # only zip the files that are new or changed since the previous download with the same name
+    incremental = script_params.get(P_INCREMENTAL, False)
 
     # check for valid password
     if password is None or password == "" or password.strip() == "":
@@ -408,10 +962,9 @@ def download_and_zip_images(conn, script_params):
         print(message)
         return "", message
 
-    fs_path_dict = {}
-    fs_prefix_dict = {}
     att_path_dict = {}
     att_prefix_dict = {}
+    att_hash_dict = {}
     message = ""
     err = None
 
@@ -425,58 +978,91 @@ def download_and_zip_images(conn, script_params):
         if not os.path.exists(zip_path):
             os.makedirs(zip_path)
 
-        # check that the zip file doesn't already exist
-        # in case it exists, simple add _id
-        zip_name_tmp = zip_name
-        i = 1
-        while os.path.exists(f"{zip_path}/{zip_name_tmp}.zip"):
-            zip_name_tmp = f"{zip_name}_{i}"
-            i = i + 1
-        zip_path = f"{zip_path}/{zip_name_tmp}.zip"
+        # list of the files zipped by the previous incremental downloads with the same name
+        checksums_path = f"{zip_path}/{zip_name}_checksums.json"
+        checksums = read_checksums(checksums_path)
+        zip_exists = os.path.exists(f"{zip_path}/{zip_name}.zip") or \
+            os.path.exists(f"{zip_path}/{zip_name}_manifest.json")
+        if incremental and not (zip_exists and previous_archives_exist(zip_path, checksums)):
+            # the previous archives were removed: the delta would be incomplete, so zip everything again
+            if checksums["archives"]:
+                print("Some archives of the previous downloads do not exist anymore. All files are zipped again.")
+            checksums = {"archives": [], "files": {}}
+            zip_exists = False
+        if incremental and zip_exists:
+            # only the new or changed files go into a delta zip, next to the previous ones
+            zip_path = f"{zip_path}/{zip_name}_delta_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        else:
+            # check that the zip file doesn't already exist
+            # in case it exists, simple add _id
+            zip_name_tmp = zip_name
+            i = 1
+            while os.path.exists(f"{zip_path}/{zip_name_tmp}.zip") or \
+                    os.path.exists(f"{zip_path}/{zip_name_tmp}_manifest.json"):
+                zip_name_tmp = f"{zip_name}_{i}"
+                i = i + 1
+            zip_path = f"{zip_path}/{zip_name_tmp}.zip"
         print(f"Zip file will be created under '{zip_path}'")
 
         # create tmp folder
         if not os.path.exists(tmp_path):
             os.makedirs(tmp_path)
 
-        for object_id in object_id_list:
+        # resolve the hierarchy and the filesets of all selected objects with a few queries
+        print("Getting server path(s) of the filesets...")
+        container_prefix_dict = get_container_prefixes(conn, object_type, object_id_list)
+        fs_prefix_dict, image_ids = get_fileset_prefixes(conn, object_type, object_id_list, container_prefix_dict)
+        fs_path_dict, fs_size_dict, fs_hash_dict = get_fileset_files(conn, fs_prefix_dict.keys())
+        print(f"Found {len(fs_prefix_dict)} fileset(s)")
 
-            # search in all the user's group
-            # conn.SERVICE_OPTS.setOmeroGroup('-1')
-
-            # get the object
-            omero_object = conn.getObject(object_type, object_id)
-
-            # check if that object exists
-            if omero_object is not None:
-                # set the correct group id
-                # conn.SERVICE_OPTS.setOmeroGroup(omero_object.getDetails().getGroup().getId())
-
-                parent_prefix = []
-                if object_type == 'Image':
-                    process_image(omero_object, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, dwnld_atts)
-                if object_type == 'Dataset':
-                    process_dataset(omero_object, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, dwnld_atts)
-                if object_type == 'Project':
-                    process_project(omero_object, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, dwnld_atts)
-                if object_type == 'Screen':
-                    process_screen(omero_object, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, dwnld_atts)
-                if object_type == 'Plate':
-                    process_plate(omero_object, parent_prefix, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, dwnld_atts)
-            else:
+        for object_id in object_id_list:
+            if object_type == "Image" and object_id not in image_ids:
+                print(object_type, object_id, "does not exist, has no original file(s) or you do not have access to it")
+            elif object_type != "Image" and (object_type, object_id) not in container_prefix_dict:
                 print(object_type, object_id, "does not exist or you do not have access to it")
 
+        if dwnld_atts:
+            print("Copying attachments...")
+            get_attachments(conn, container_prefix_dict, fs_prefix_dict, att_path_dict, att_prefix_dict, att_hash_dict)
+
         # only creates zip if there is at least one image
         if len(fs_path_dict) > 0 and len(fs_prefix_dict) > 0:
             # get the full list of file (images + attachments) path
             print("Preparing download...")
-            fs_path_list, fs_prefix_list = prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict)
+            fs_path_list, fs_prefix_list, fs_group_list, fs_file_size_list, fs_hash_list = \
+                prepare_download(conn, fs_path_dict, att_path_dict, fs_prefix_dict, att_prefix_dict, fs_size_dict,
+                                 fs_hash_dict, att_hash_dict)
+
+            if incremental:
+                indices = get_changed_files(checksums, fs_path_list, fs_prefix_list, fs_file_size_list, fs_hash_list)
+                print(f"{len(indices)} / {len(fs_path_list)} files are new or changed since the previous download")
+                fs_path_list = [fs_path_list[idx] for idx in indices]
+                fs_prefix_list = [fs_prefix_list[idx] for idx in indices]
+                fs_group_list = [fs_group_list[idx] for idx in indices]
+                fs_file_size_list = [fs_file_size_list[idx] for idx in indices]
+                fs_hash_list = [fs_hash_list[idx] for idx in indices]
 
             try:
                 # zip it
-                print("Creating zip...")
-                pyminizip.compress_multiple(fs_path_list, fs_prefix_list, f"{zip_path}", password, 1)
-                message = f"Zip file created and accessible under https://sv-open.epfl.ch/ptbiop-public{zip_path.replace(root, '')}"
+                if len(fs_path_list) == 0:
+                    message = "No new or changed files since the previous download. No zip file created."
+                elif 0 < max_volume_size < sum(fs_file_size_list):
+                    print("Creating zip volumes...")
+                    manifest_path, volume_paths = write_protected_volumes(zip_path, fs_path_list, fs_prefix_list,
+                                                                          fs_group_list, fs_file_size_list,
+                                                                          password, max_volume_size)
+                    message = f"{len(volume_paths)} zip files created. The list is accessible under " \
+                              f"https://sv-open.epfl.ch/ptbiop-public{manifest_path.replace(root, '')}"
+                    if incremental:
+                        write_checksums(checksums_path, checksums, [os.path.basename(p) for p in volume_paths],
+                                        fs_path_list, fs_prefix_list, fs_file_size_list, fs_hash_list)
+                else:
+                    print("Creating zip...")
+                    write_protected_zip(zip_path, fs_path_list, fs_prefix_list, password)
+                    message = f"Zip file created and accessible under https://sv-open.epfl.ch/ptbiop-public{zip_path.replace(root, '')}"
+                    if incremental:
+                        write_checksums(checksums_path, checksums, [os.path.basename(zip_path)],
+                                        fs_path_list, fs_prefix_list, fs_file_size_list, fs_hash_list)
                 print(message)
             except Exception as e:
                 message = "ERROR: cannot zip the files"
@@ -509,6 +1095,11 @@ def run_script():
     any data leak issues. Downloaded data are kept during one week before being automatically deleted.
     \t
     If downloading attachments is selected, all attachments will be downloaded, whatever their extension.
+    \t
+    If a maximum zip size is given, the download is split into several zip files, listed in a manifest file.
+    \t
+    If only new or changed files are added, downloading again the same objects with the same zip name
+    creates a delta zip with the files that were added or modified since the previous download.
         """,
         scripts.String(
             P_DATA_TYPE, optional=False, grouping="1",
@@ -527,11 +1118,21 @@ def run_script():
             P_ATT, optional=True, grouping="5",
             description="Download all attachments linked to selected objects",
             default=False),
+        scripts.Float(
+            P_VOLUME_SIZE, optional=True, grouping="6",
+            description="Split the download into several zip files of at most this size. "
+                        "Images of the same fileset are always in the same zip file. 0 for a single zip file",
+            default=0, min=0),
+        scripts.Bool(
+            P_INCREMENTAL, optional=True, grouping="7",
+            description="Keep a list of the zipped files next to the zip. If a zip with the same name was already "
+                        "created with this option, only new or changed files are added, in a new delta zip",
+            default=False),
 
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch",
-        version="1.0.0"
+        version="1.5.0"
     )
 
     try:
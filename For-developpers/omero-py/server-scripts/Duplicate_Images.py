@@ -25,73 +25,94 @@ import omero.model as model
 from omero.gateway import BlitzGateway
 from omero.gateway import DatasetWrapper
 from omero.gateway import MapAnnotationWrapper
-from omero.plugins.sessions import SessionsControl
-from omero.plugins.duplicate import DuplicateControl
-from omero.cli import CLI
+from omero.cmd import Duplicate, DuplicateResponse, DoAll, DoAllRsp
+from omero.callbacks import CmdCallbackI
 from omero.rtypes import rlong, rstring, robject
 from datetime import datetime
-from io import StringIO
-import sys
 
 P_DATA_TYPE = "Data_Type"
 P_IDS = "IDs"
 P_DUP_NUM = "Number of duplicate to create"
 
-OMERO_SERVER = "omero-server.epfl.ch"
 OMERO_WEBSERVER = "omero.epfl.ch"
-PORT = "4064"
 
+# maximum number of copies requested in one server-side DoAll
+COPIES_PER_REQUEST = 10
+# maximum number of links saved in one call
+SAVE_BATCH_SIZE = 1000
+# time to wait for a request before checking it again, in ms
+POLL_INTERVAL_MS = 1000
 
-class Capturing(list):
-    """
-    Class to read the stdout of the command line
-    Here, to read the --report output by the omero.cmd.duplicate
-    """
-    def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
-        return self
-
-    def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio    # free up some memory
-        sys.stdout = self._stdout
 
-
-def add_annotation_key_value(conn, target_obj, annotations):
-    """Add a key-value "map" annotation to an OMERO object.
+def create_annotation_links(conn, object_type, object_ids, annotations):
+    """Create one key-value "map" annotation and the links to attach it to all given objects.
+    The links are not saved.
     Parameters
     ----------
     conn : omero.gateway.BlitzGateway
         The OMERO connection object.
-    target_obj : omero.gateway.BlitzObjectWrapper
-        The image to attach the KVP to
+    object_type : str
+        Type of the objects to attach the KVP to
+    object_ids : list[int]
+        IDs of the objects to attach the KVP to
     annotations : list[list]
         A dictionary of the duplicate information
     Returns
     -------
-    bool
-        True in case of success, False otherwise.
-    Raises
-    ------
-    RuntimeError
-        Raised in case re-establishing the OMERO connection fails.
+    links : list[omero.model.IObject]
+        The unsaved annotation links
     """
-
-    if target_obj is None:
-        print("ERROR", f"Unable to identify target object in OMERO!")
-        return False
-
-    namespace = f"omero.duplicate"
+    namespace = "omero.duplicate"
     map_ann = MapAnnotationWrapper(conn)
     map_ann.setValue(annotations)
     map_ann.setNs(namespace)
     map_ann.save()
-    target_obj.linkAnnotation(map_ann)
 
-    print("SUCCESS", f"Added annotation to {target_obj.getId()} : {annotations}")
+    links = []
+    for object_id in object_ids:
+        link = getattr(omero.model, f"{object_type}AnnotationLinkI")()
+        link.setParent(getattr(omero.model, f"{object_type}I")(object_id, False))
+        link.setChild(omero.model.MapAnnotationI(map_ann.getId(), False))
+        links.append(link)
+
+    print("SUCCESS", f"Added annotation to {len(object_ids)} {object_type}(s) : {annotations}")
+    return links
+
+
+def create_dataset_links(dataset_id, image_ids):
+    """Create the links to put images in a dataset. The links are not saved.
+    Parameters
+    ----------
+    dataset_id : int
+        ID of the dataset
+    image_ids : list[int]
+        IDs of the images
+    Returns
+    -------
+    links : list[omero.model.DatasetImageLinkI]
+        The unsaved links
+    """
+    links = []
+    for image_id in image_ids:
+        link = omero.model.DatasetImageLinkI()
+        link.setChild(omero.model.ImageI(image_id, False))
+        link.setParent(omero.model.DatasetI(dataset_id, False))
+        links.append(link)
+    return links
+
 
-    return True
+def save_in_batches(conn, objects):
+    """Save objects on OMERO, by batches of SAVE_BATCH_SIZE objects
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        The OMERO connection object.
+    objects : list[omero.model.IObject]
+        Objects to save
+    """
+    update_service = conn.getUpdateService()
+    for i in range(0, len(objects), SAVE_BATCH_SIZE):
+        update_service.saveArray(objects[i:i + SAVE_BATCH_SIZE], conn.SERVICE_OPTS)
 
 
 # This method is taken from ezomero project :
@@ -158,110 +179,123 @@ def duplicate_images(conn: BlitzGateway, script_params):
 
     # Type of object to duplicate
     data_type = script_params[P_DATA_TYPE]
-    parent_objs = [None]
 
     # Number of image copy
     n_iter = script_params[P_DUP_NUM]
 
-    # Build the duplicate command
     str_ids = [str(img_id) for img_id in raw_input_ids]
-    import_args = ["duplicate",
-                   f"{data_type}:{','.join(str_ids)}", "--report"
-                   ]
-
-    for copy_id in range(n_iter):
-        # open cli connection
-        with omero.cli.cli_login("-k", "%s" % conn.c.getSessionId(), "-s", OMERO_SERVER, "-p", PORT) as cli:
-            cli.register('duplicate', DuplicateControl, '_')
-            cli.register('sessions', SessionsControl, '_')
-            # launch duplication
-            try:
-                with Capturing() as output:
-                    cli.invoke(import_args, strict=True)
-                print("SUCCESS", f"Duplicated images {str_ids}")
-            except PermissionError as err:
-                message = f"Error during duplication of images {str_ids}: {err}"
-                cli.get_client().closeSession()
-                cli.close()
-                return message, None, err
-    
-            cli.get_client().closeSession()
 
+    # submit all copies as native Duplicate requests, several of them in one DoAll
+    duplicate_responses = []
+    for first_copy in range(0, n_iter, COPIES_PER_REQUEST):
+        n_copies = min(COPIES_PER_REQUEST, n_iter - first_copy)
+        requests = [Duplicate(targetObjects={data_type: raw_input_ids}, typesToDuplicate=[],
+                              typesToReference=[], typesToIgnore=[]) for _ in range(n_copies)]
+        try:
+            rsp = submit(conn, DoAll(requests=requests), DoAllRsp)
+        except Exception as err:
+            message = f"Error during duplication of {data_type} {str_ids}: {err}"
+            return message, None, err
+        duplicate_responses.extend(rsp.responses)
+        print("SUCCESS", f"Duplicated {data_type} {str_ids} {first_copy + n_copies} / {n_iter} times")
+
+    parent_type = "Dataset" if data_type == "Image" else data_type
+    parent_ids = []
+    image_ids = []
+    links = []
+    for copy_id, duplicate_response in enumerate(duplicate_responses):
         # extract ids of duplicated images
-        print(output)
-        duplicated_images_ids = extract_duplicate_image_ids(output, "Image")
+        duplicated_images_ids = get_duplicated_ids(duplicate_response, "Image")
         print(f"Duplicated images : {duplicated_images_ids}")
+        image_ids.extend(duplicated_images_ids)
 
         # create a target dataset for orphaned images or get the duplicated parent containers
-        dataset_id = -1
         if data_type == "Image":
             dataset_name = f"Duplicated_images_{copy_id + 1}"
             dataset_id = create_dataset(conn, dataset_name)
-            parent_objs = [conn.getObject("Dataset", dataset_id)]
+            parent_ids.append(dataset_id)
+            # move orphaned images to the right dataset
+            links.extend(create_dataset_links(dataset_id, duplicated_images_ids))
         else:
-            duplicated_parent_ids = extract_duplicate_image_ids(output, data_type)
-            if len(duplicated_parent_ids) > 0:
-                parent_objs = [p_obj for p_obj in conn.getObjects(data_type, duplicated_parent_ids)]
-            else:
-                parent_objs = []
-
-        if len(parent_objs) > 0 and parent_objs[0] is not None:
-            # create and add the KVP on parent container
-            parent_kvps = [
-                [f"Source {data_type.lower()}",
-                 f"https://{OMERO_WEBSERVER}/webclient/?show={'|'.join([f'{data_type.lower()}-{im_id}' for im_id in str_ids])}"]
-            ]
-
-            for parent_obj in parent_objs:
-                add_annotation_key_value(conn, parent_obj, parent_kvps)
-
-            # get the duplicated images
-            if len(duplicated_images_ids) > 0:
-                duplicated_images = conn.getObjects("Image", duplicated_images_ids)
-                img_kvps = [
-                    ["Duplicated by", conn.getUser().getFullName()],
-                    ["Duplication date", datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S")]]
-
-                # add kvps to duplicated & move orphaned images to the right dataset
-                for dup_img in duplicated_images:
-                    add_annotation_key_value(conn, dup_img, img_kvps)
-                    if data_type == "Image" and dataset_id > 0:
-                        link = omero.model.DatasetImageLinkI()
-                        link.setChild(omero.model.ImageI(dup_img.id, False))
-                        link.setParent(omero.model.DatasetI(dataset_id, False))
-                        conn.getUpdateService().saveObject(link)
-
-    return f"Successful duplication of {data_type} : {str_ids} ", parent_objs[0], None
-
-
-def extract_duplicate_image_ids(report_list, d_type):
+            parent_ids.extend(get_duplicated_ids(duplicate_response, data_type))
+
+    # one KVP shared by all duplicated parent containers, and one shared by all duplicated images
+    if len(parent_ids) > 0:
+        parent_kvps = [
+            [f"Source {data_type.lower()}",
+             f"https://{OMERO_WEBSERVER}/webclient/?show={'|'.join([f'{data_type.lower()}-{im_id}' for im_id in str_ids])}"]
+        ]
+        links.extend(create_annotation_links(conn, parent_type, parent_ids, parent_kvps))
+
+    if len(image_ids) > 0:
+        img_kvps = [
+            ["Duplicated by", conn.getUser().getFullName()],
+            ["Duplication date", datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S")]]
+        links.extend(create_annotation_links(conn, "Image", image_ids, img_kvps))
+
+    save_in_batches(conn, links)
+
+    parent_obj = conn.getObject(parent_type, parent_ids[0]) if len(parent_ids) > 0 else None
+    return f"Successful duplication of {data_type} : {str_ids} ", parent_obj, None
+
+
+def get_duplicated_ids(duplicate_response, d_type):
     """
-    Parse the report generated by omero.cmd.duplicate and extract OMERO IDs
-    of the specified type
+    Extract the OMERO IDs of the specified type from the response of a Duplicate request
 
     Parameters
     ----------
-    report_list: List of str
-        report generated by omero.cmd.duplicate
+    duplicate_response: omero.cmd.DuplicateResponse
+        response of the Duplicate request
     d_type: str
         container type
 
     Returns
     -------
+    omero_ids: List of int
+        IDs of the duplicated objects of this type
+    """
+    if not isinstance(duplicate_response, DuplicateResponse):
+        return []
+    omero_ids = []
+    for class_name, ids in duplicate_response.duplicates.items():
+        # class names are fully qualified, e.g. ome.model.core.Image
+        if class_name.split(".")[-1] == d_type:
+            omero_ids.extend(ids)
+    return sorted(omero_ids)
+
+
+def submit(conn, request, expected):
+    """
+    Submit a request to the server and wait for it to complete, however long it takes,
+    so that the work is never reported as failed while it still runs on the server
 
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    request: omero.cmd.Request
+        request to submit
+    expected: type
+        expected type of the response
 
+    Returns
+    -------
+    rsp: omero.cmd.Response
+        response of the request
     """
-    to_search = f"{d_type}:"
-    for line in report_list:
-        if line.strip().startswith(to_search):
-            ids = line.strip().replace(to_search, "")
-            omero_ids = []
-            for group_ids in ids.split(","):
-                start_end_ids = group_ids.split("-")
-                for i in range(int(start_end_ids[0]), int(start_end_ids[-1]) + 1):
-                    omero_ids.append(i)
-            return omero_ids
-    return []
+    handle = conn.c.sf.submit(request, conn.SERVICE_OPTS)
+    cb = CmdCallbackI(conn.c, handle)
+    try:
+        while not cb.block(POLL_INTERVAL_MS):
+            pass
+        rsp = cb.getResponse()
+    finally:
+        cb.close(True)
+
+    if not isinstance(rsp, expected):
+        raise RuntimeError(f"unexpected response: {rsp}")
+    return rsp
 
 
 def run_script():
@@ -289,7 +323,7 @@ def run_script():
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch",
-        version="2.0.0"
+        version="2.2.0"
     )
 
     try:
@@ -12,7 +12,11 @@ from omero.gateway import BlitzGateway
 import numpy as np
 import omero.scripts as scripts
 from omero.rtypes import rstring, rlong, robject
+from collections import OrderedDict
 import omero
+import os
+import shutil
+import tempfile
 
 
 P_DATA_TYPE = "Data_Type"
@@ -22,10 +26,224 @@ P_PROJ_TYPE = "Projection type"
 P_START_Z = "Starting Z position"
 P_END_Z = "Ending Z position"
 P_TRANSFER_ANN = "Transfer annotations to projection image (ROIs excluded)"
+P_USE_CACHE = "Use local plane cache"
+P_CACHE_SIZE = "Plane cache size (MB)"
 
 MAX_PROJ = "max"
 MIN_PROJ = "min"
 
+# Local folder where the planes are cached, if the cache is enabled.
+# Only readable by the user running the scripts, as planes may come from private data
+PLANE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "omero_plane_cache")
+DEFAULT_CACHE_SIZE_MB = 2048
+
+
+class PlaneCache:
+    """
+    On-disk cache of pixel planes, stored as numpy.memmap (.npy) files.
+
+    Planes are keyed by (pixelsId, z, c, t, tile, updateEvent) and laid out as
+    <cache_dir>/<pixelsId>/<updateEventId>/z<z>_c<c>_t<t>_<tile>.npy
+    When the pixels are updated on OMERO, the updateEvent changes and all the
+    planes cached for a previous event are deleted.
+    The least recently used planes are evicted once the total size exceeds max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # path -> size, ordered from the least to the most recently used plane
+        self._index = OrderedDict()
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if os.stat(cache_dir).st_uid != os.getuid():
+            raise PermissionError(f"The plane cache {cache_dir} belongs to another user")
+        os.chmod(cache_dir, 0o700)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    # plane being written by another process, not part of the cache yet
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._index[path] = size
+            self.total_bytes += size
+
+    def _plane_path(self, pixels_id, update_event, z, c, t, tile):
+        tile_key = "full" if tile is None else "-".join(str(v) for v in tile)
+        return os.path.join(self.cache_dir, str(pixels_id), str(update_event), f"z{z}_c{c}_t{t}_{tile_key}.npy")
+
+    def _remove(self, path):
+        self.total_bytes -= self._index.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # already evicted by another process
+            pass
+
+    def invalidate(self, pixels_id, update_event):
+        """
+        Delete all planes cached for an older version of the pixels
+
+        Parameters
+        ----------
+        pixels_id: int
+            ID of the pixels object
+        update_event: int
+            ID of the current update event of the pixels
+        """
+        pixels_dir = os.path.join(self.cache_dir, str(pixels_id))
+        if not os.path.isdir(pixels_dir):
+            return
+        for event_dir in os.listdir(pixels_dir):
+            if event_dir == str(update_event):
+                continue
+            outdated_dir = os.path.join(pixels_dir, event_dir)
+            for path in [p for p in self._index if p.startswith(outdated_dir + os.sep)]:
+                self.total_bytes -= self._index.pop(path)
+            shutil.rmtree(outdated_dir, ignore_errors=True)
+
+    def get(self, pixels_id, update_event, z, c, t, tile=None):
+        """
+        Read a plane from the cache
+
+        Returns
+        -------
+        plane: numpy.memmap
+            The cached plane, read-only, or None if the plane is not cached
+        """
+        path = self._plane_path(pixels_id, update_event, z, c, t, tile)
+        if path not in self._index:
+            return None
+        try:
+            plane = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            # the file was removed or truncated by another process
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            self._remove(path)
+            return None
+        self._index.move_to_end(path)
+        return plane
+
+    def put(self, pixels_id, update_event, z, c, t, plane, tile=None):
+        """
+        Write a plane in the cache and evict the least recently used planes if needed
+
+        Returns
+        -------
+        plane: numpy.memmap
+            The cached plane
+        """
+        path = self._plane_path(pixels_id, update_event, z, c, t, tile)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        mmap = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=plane.dtype, shape=plane.shape)
+        mmap[:] = plane
+        mmap.flush()
+        del mmap
+        os.replace(tmp_path, path)
+
+        self.total_bytes -= self._index.pop(path, 0)
+        size = os.path.getsize(path)
+        self._index[path] = size
+        self.total_bytes += size
+        self._evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def _evict(self, keep=None):
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            path = next(iter(self._index))
+            if path == keep:
+                self._index.move_to_end(path)
+                continue
+            self._remove(path)
+
+    def get_planes(self, pixels, zct_list, tile=None):
+        """
+        Generator of planes going through the cache.
+        Missing planes are fetched from OMERO in a single call, then cached.
+
+        Parameters
+        ----------
+        pixels: omero.gateway.PixelsWrapper
+            Pixels to read the planes from
+        zct_list: List of tuple
+            (z, c, t) indices of the planes to read
+        tile: tuple
+            (x, y, width, height) of the tile to read, or None for the full plane
+
+        Returns
+        -------
+        planes: generator of numpy.ndarray
+            The planes, in the order of zct_list
+        """
+        pixels_id = pixels.getId()
+        update_event = get_update_event_id(pixels._conn, pixels_id)
+        if update_event is None:
+            # without update event, outdated planes could not be detected: bypass the cache
+            if tile is None:
+                yield from pixels.getPlanes(zct_list)
+            else:
+                yield from pixels.getTiles([(z, c, t, tile) for z, c, t in zct_list])
+            return
+        self.invalidate(pixels_id, update_event)
+
+        planes = {}
+        missing = []
+        for zct in zct_list:
+            plane = self.get(pixels_id, update_event, *zct, tile=tile)
+            if plane is None:
+                missing.append(zct)
+            else:
+                planes[zct] = plane
+
+        if missing:
+            if tile is None:
+                fetched = pixels.getPlanes(missing)
+            else:
+                fetched = pixels.getTiles([(z, c, t, tile) for z, c, t in missing])
+            for zct, plane in zip(missing, fetched):
+                planes[zct] = self.put(pixels_id, update_event, *zct, plane, tile=tile)
+
+        for zct in zct_list:
+            yield planes[zct]
+
+
+def get_update_event_id(conn, pixels_id):
+    """
+    Return the ID of the last update event of the pixels, used to invalidate the cache.
+    The event is queried explicitly as it is not always loaded with the pixels.
+
+    Parameters
+    ----------
+    conn: omero.gateway.BlitzGateway
+        OMERO connection
+    pixels_id: int
+        ID of the pixels object
+
+    Returns
+    -------
+    event_id: int
+        ID of the update event, or None if it cannot be read
+    """
+    params = omero.sys.ParametersI()
+    params.addId(pixels_id)
+    rows = conn.getQueryService().projection(
+        "select p.details.updateEvent.id from Pixels p where p.id = :id", params, conn.SERVICE_OPTS)
+    if not rows or rows[0][0] is None:
+        return None
+    return rows[0][0].val
+
 
 def do_max_intensity_projection(conn, script_params):
     """
@@ -50,6 +268,11 @@ def do_max_intensity_projection(conn, script_params):
     object_id_list = script_params[P_IDS]
     proj_type = script_params[P_PROJ_TYPE]
     is_full_stack = bool(script_params[P_FULL_STACK])
+    plane_cache = None
+    if script_params.get(P_USE_CACHE, False):
+        cache_size_mb = script_params.get(P_CACHE_SIZE, DEFAULT_CACHE_SIZE_MB)
+        plane_cache = PlaneCache(PLANE_CACHE_DIR, cache_size_mb * 1024 * 1024)
+        print(f"Using local plane cache in {PLANE_CACHE_DIR} ({cache_size_mb} MB)")
     if not is_full_stack:
         start_z = int(script_params[P_START_Z])
         end_z = int(script_params[P_END_Z])
@@ -101,7 +324,10 @@ def do_max_intensity_projection(conn, script_params):
                     # get Z-stack...
                     zct_list = [(z + start - 1, c, t) for z in range(end-start+1)]
                     # planes is a generator - no data loaded yet...
-                    planes = pixels.getPlanes(zct_list)
+                    if plane_cache is not None:
+                        planes = plane_cache.get_planes(pixels, zct_list)
+                    else:
+                        planes = pixels.getPlanes(zct_list)
                     data = []
                     for p in planes:
                         # could add a sleep here if you want to reduce load on server?
@@ -220,10 +446,22 @@ def run_script():
                         "\nROIs and image description are NOT transferred.",
             default=False),
 
+        scripts.Bool(
+            P_USE_CACHE, grouping="5",
+            description="Keep a local copy of the planes on the server disk, so that "
+                        "repeated projections of the same image do not fetch the planes again",
+            default=False),
+
+        scripts.Int(
+            P_CACHE_SIZE, grouping="5.1",
+            description="Maximum size of the local plane cache. "
+                        "Least recently used planes are removed first",
+            default=DEFAULT_CACHE_SIZE_MB, min=1),
+
         authors=["William Moore, Rémy Dornier"],
         institutions=["University of Dundee, EPFL - BIOP"],
         contact="omero@groupes.epfl.ch",
-        version="1.1.0"
+        version="1.2.0"
     )
 
     try:
@@ -25,10 +25,9 @@ import omero.model as model
 from omero.gateway import BlitzGateway
 from omero.gateway import DatasetWrapper
 from omero.gateway import MapAnnotationWrapper
-from omero.plugins.sessions import SessionsControl
-from omero.plugins.duplicate import DuplicateControl
-from omero.plugins.chgrp import ChgrpControl
-from omero.cli import CLI
+from omero.cmd import Duplicate, DuplicateResponse, Chgrp2, OK
+from omero.cmd.graphs import ChildOption
+from omero.callbacks import CmdCallbackI
 from omero.rtypes import rlong, rstring, robject
 from datetime import datetime
 
@@ -38,45 +37,83 @@ P_GROUP = "Target group"
 P_PROJECT = "Target project"
 P_DATASET = "Dataset"
 
-OMERO_SERVER = "omero-server.epfl.ch"
 OMERO_WEBSERVER = "omero.epfl.ch"
-PORT = "4064"
 
+# maximum number of links saved in one call
+SAVE_BATCH_SIZE = 1000
+# time to wait for a request before checking it again, in ms
+POLL_INTERVAL_MS = 1000
 
-def add_annotation_key_value(conn, target_obj, annotations):
-    """Add a key-value "map" annotation to an OMERO object.
+
+def create_annotation_links(conn, object_type, object_ids, annotations):
+    """Create one key-value "map" annotation and the links to attach it to all given objects.
+    The links are not saved.
     Parameters
     ----------
     conn : omero.gateway.BlitzGateway
         The OMERO connection object.
-    target_obj : omero.gateway.BlitzObjectWrapper
-        The image to attach the KVP to
+    object_type : str
+        Type of the objects to attach the KVP to
+    object_ids : list[int]
+        IDs of the objects to attach the KVP to
     annotations : list[list]
         A dictionary of the duplicate information
     Returns
     -------
-    bool
-        True in case of success, False otherwise.
-    Raises
-    ------
-    RuntimeError
-        Raised in case re-establishing the OMERO connection fails.
+    links : list[omero.model.IObject]
+        The unsaved annotation links
     """
-
-    if target_obj is None:
-        print("ERROR", f"Unable to identify target object in OMERO!")
-        return False
-
-    namespace = f"omero.duplicate"
+    namespace = "omero.duplicate"
     map_ann = MapAnnotationWrapper(conn)
     map_ann.setValue(annotations)
     map_ann.setNs(namespace)
     map_ann.save()
-    target_obj.linkAnnotation(map_ann)
 
-    print("SUCCESS", f"Added annotation to {target_obj.getId()} : {annotations}")
+    links = []
+    for object_id in object_ids:
+        link = getattr(omero.model, f"{object_type}AnnotationLinkI")()
+        link.setParent(getattr(omero.model, f"{object_type}I")(object_id, False))
+        link.setChild(omero.model.MapAnnotationI(map_ann.getId(), False))
+        links.append(link)
+
+    print("SUCCESS", f"Added annotation to {len(object_ids)} {object_type}(s) : {annotations}")
+    return links
+
+
+def create_dataset_links(dataset_id, image_ids):
+    """Create the links to put images in a dataset. The links are not saved.
+    Parameters
+    ----------
+    dataset_id : int
+        ID of the dataset
+    image_ids : list[int]
+        IDs of the images
+    Returns
+    -------
+    links : list[omero.model.DatasetImageLinkI]
+        The unsaved links
+    """
+    links = []
+    for image_id in image_ids:
+        link = omero.model.DatasetImageLinkI()
+        link.setChild(omero.model.ImageI(image_id, False))
+        link.setParent(omero.model.DatasetI(dataset_id, False))
+        links.append(link)
+    return links
+
 
-    return True
+def save_in_batches(conn, objects):
+    """Save objects on OMERO, by batches of SAVE_BATCH_SIZE objects
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+        The OMERO connection object.
+    objects : list[omero.model.IObject]
+        Objects to save
+    """
+    update_service = conn.getUpdateService()
+    for i in range(0, len(objects), SAVE_BATCH_SIZE):
+        update_service.saveArray(objects[i:i + SAVE_BATCH_SIZE], conn.SERVICE_OPTS)
 
 
 # This method is taken from ezomero project :
@@ -153,8 +190,8 @@ def duplicate_and_move_to_group(conn: BlitzGateway, script_params):
     current_group = conn.getGroupFromContext()
     excluded_groups = [0, 1, 2]
 
-    # target dataset
-    dataset = script_params[P_DATASET]
+    # target dataset ; no dataset if left blank
+    dataset_name = script_params.get(P_DATASET, "").strip()
 
     # check if the connected user is part of the target group
     available_groups = [g.name.lower() for g in conn.listGroups() if g.id not in excluded_groups]
@@ -163,39 +200,17 @@ def duplicate_and_move_to_group(conn: BlitzGateway, script_params):
         message = f"ERROR : You are not part of the group {target_group_name}. You cannot transfer images to that group"
         return message, None, None
 
-    # Build the duplicate command
     str_ids = [str(img_id) for img_id in image_ids]
-    import_args = ["duplicate",
-                   f"Image:{','.join(str_ids)}"
-                   ]
-
-    # open cli connection
-    with omero.cli.cli_login("-k", "%s" % conn.c.getSessionId(), "-s", OMERO_SERVER, "-p", PORT) as cli:
-        cli.register('duplicate', DuplicateControl, '_')
-        cli.register('sessions', SessionsControl, '_')
-        # launch duplication
-        try:
-            cli.invoke(import_args, strict=True)
-            print("SUCCESS", f"Duplicated images {str_ids}")
-        except PermissionError as err:
-            message = f"Error during duplication of images {str_ids}: {err}"
-            cli.get_client().closeSession()
-            cli.close()
-            return message, None, err
-
-        cli.get_client().closeSession()
-
-    # create the target dataset
-    dataset_id = create_dataset(conn, dataset)
-    dataset = conn.getObject("Dataset", dataset_id)
-    dataset_kvps = [
-        ["Source images",
-         f"https://{OMERO_WEBSERVER}/webclient/?show={'|'.join([f'image-{im_id}' for im_id in str_ids])}"]
-    ]
-    add_annotation_key_value(conn, dataset, dataset_kvps)
-
-    # get the duplicated images from the orphaned folder
-    duplicated_images = conn.getObjects("Image", opts={'orphaned': True, 'owner': conn.getUser().getId()})
+
+    # duplicate the images ; the IDs of the copies are read from the server response
+    try:
+        rsp = submit(conn, Duplicate(targetObjects={"Image": image_ids}, typesToDuplicate=[],
+                                     typesToReference=[], typesToIgnore=[]), DuplicateResponse)
+    except Exception as err:
+        message = f"Error during duplication of images {str_ids}: {err}"
+        return message, None, err
+    duplicated_image_ids = get_duplicated_ids(rsp, "Image")
+    print("SUCCESS", f"Duplicated images {str_ids} into {duplicated_image_ids}")
 
     # get the target group
     target_group = [g for g in conn.listGroups()
@@ -208,40 +223,96 @@ def duplicate_and_move_to_group(conn: BlitzGateway, script_params):
         ["Base group", current_group.getName()],
         ["Target group", target_group_name]]
 
-    # add kvps & move orphaned images to the right dataset
-    for dup_img in duplicated_images:
-        add_annotation_key_value(conn, dup_img, img_kvps)
-        link = omero.model.DatasetImageLinkI()
-        link.setChild(omero.model.ImageI(dup_img.id, False))
-        link.setParent(omero.model.DatasetI(dataset_id, False))
-        conn.getUpdateService().saveObject(link)
-
-    # Build the chgrp command only of the 2 groups are different
+    # add kvps to the duplicated images only
+    links = create_annotation_links(conn, "Image", duplicated_image_ids, img_kvps)
+
+    # create the target dataset & move the duplicated images in it
+    dataset = None
+    target_objects = {"Image": duplicated_image_ids}
+    if dataset_name:
+        dataset_id = create_dataset(conn, dataset_name)
+        dataset = conn.getObject("Dataset", dataset_id)
+        dataset_kvps = [
+            ["Source images",
+             f"https://{OMERO_WEBSERVER}/webclient/?show={'|'.join([f'image-{im_id}' for im_id in str_ids])}"]
+        ]
+        links.extend(create_annotation_links(conn, "Dataset", [dataset_id], dataset_kvps))
+        links.extend(create_dataset_links(dataset_id, duplicated_image_ids))
+        target_objects["Dataset"] = [dataset_id]
+    save_in_batches(conn, links)
+
+    # move the dataset and the duplicated images, with their annotations, only if the 2 groups are different
     if current_group.getId() != target_group.getId():
-        import_args = ["chgrp",
-                       "Group:%s" % target_group.getId(),
-                       "Dataset:%s" % dataset_id,
-                       "--include", "Image", "Annotation"
-                      ]
-        # open cli connection
-        with omero.cli.cli_login("-k", "%s" % conn.c.getSessionId(), "-s", OMERO_SERVER, "-p", PORT) as cli:
-            cli.register('chgrp', ChgrpControl, '_')
-            cli.register('sessions', SessionsControl, '_')
-            # launch duplication
-            try:
-                cli.invoke(import_args, strict=True)
-                print("SUCCESS", f"Moved from group {current_group.getName()} to group {target_group_name}")
-            except PermissionError as err:
-                message = f"Error during moving dataset {dataset}:{dataset_id} " \
-                          f"from group {current_group.getName()} to group {target_group_name} : {err}"
-                cli.get_client().closeSession()
-                cli.close()
-                return message, dataset, err
-            cli.get_client().closeSession()
+        chgrp = Chgrp2(targetObjects=target_objects, groupId=target_group.getId(),
+                       childOptions=[ChildOption(includeType=["Image", "Annotation"])])
+        try:
+            submit(conn, chgrp, OK)
+            print("SUCCESS", f"Moved from group {current_group.getName()} to group {target_group_name}")
+        except Exception as err:
+            message = f"Error during moving images {duplicated_image_ids} " \
+                      f"from group {current_group.getName()} to group {target_group_name} : {err}"
+            return message, dataset, err
 
     return f"Successful transfer of images {str_ids} to group {target_group_name}", dataset, None
 
 
+def get_duplicated_ids(duplicate_response, d_type):
+    """
+    Extract the OMERO IDs of the specified type from the response of a Duplicate request
+
+    Parameters
+    ----------
+    duplicate_response: omero.cmd.DuplicateResponse
+        response of the Duplicate request
+    d_type: str
+        container type
+
+    Returns
+    -------
+    omero_ids: List of int
+        IDs of the duplicated objects of this type
+    """
+    omero_ids = []
+    for class_name, ids in duplicate_response.duplicates.items():
+        # class names are fully qualified, e.g. ome.model.core.Image
+        if class_name.split(".")[-1] == d_type:
+            omero_ids.extend(ids)
+    return sorted(omero_ids)
+
+
+def submit(conn, request, expected):
+    """
+    Submit a request to the server and wait for it to complete, however long it takes,
+    so that the work is never reported as failed while it still runs on the server
+
+    Parameters
+    ----------
+    conn : ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    request: omero.cmd.Request
+        request to submit
+    expected: type
+        expected type of the response
+
+    Returns
+    -------
+    rsp: omero.cmd.Response
+        response of the request
+    """
+    handle = conn.c.sf.submit(request, conn.SERVICE_OPTS)
+    cb = CmdCallbackI(conn.c, handle)
+    try:
+        while not cb.block(POLL_INTERVAL_MS):
+            pass
+        rsp = cb.getResponse()
+    finally:
+        cb.close(True)
+
+    if not isinstance(rsp, expected):
+        raise RuntimeError(f"unexpected response: {rsp}")
+    return rsp
+
+
 def run_script():
     data_types = [rstring('Image')]
 
@@ -271,7 +342,7 @@ def run_script():
         authors=["Rémy Dornier"],
         institutions=["EPFL - BIOP"],
         contact="omero@groupes.epfl.ch",
-        version="1.0.0"
+        version="1.2.0"
     )
 
     try:
@@ -0,0 +1,188 @@
+"""
+ Warm_Thumbnails.py
+ Pre-generate the thumbnails of all images within the selected objects
+ -----------------------------------------------------------------------------
+ MIT License
+
+ Copyright (c) 2026 ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, BioImaging And Optics Platform (BIOP)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all
+ copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+ SOFTWARE.
+ ------------------------------------------------------------------------------
+ Created by Rémy Dornier
+
+"""
+
+import omero
+import omero.scripts as scripts
+from omero.gateway import BlitzGateway
+from omero.rtypes import rint, rlong, rstring, unwrap
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# constants for the UI
+P_DATA_TYPE = "Data_Type"
+P_IDS = "IDs"
+P_SIZE = "Thumbnail size"
+
+# longest side of the thumbnails displayed by omero-web
+THUMBNAIL_SIZE = 96
+# number of thumbnails requested in one call
+THUMBNAIL_BATCH_SIZE = 50
+# number of calls running at the same time
+THUMBNAIL_WORKERS = 4
+
+# query to get the pixels of all images within an object
+PIXELS_QUERIES = {
+    "Image": "select p.id from Pixels p where p.image.id in (:ids)",
+    "Dataset": "select p.id from Pixels p, DatasetImageLink l where p.image.id = l.child.id "
+               "and l.parent.id in (:ids)",
+    "Project": "select p.id from Pixels p, DatasetImageLink dl, ProjectDatasetLink pl "
+               "where p.image.id = dl.child.id and dl.parent.id = pl.child.id and pl.parent.id in (:ids)",
+    "Well": "select p.id from Pixels p, WellSample ws where p.image.id = ws.image.id and ws.well.id in (:ids)",
+    "Plate": "select p.id from Pixels p, WellSample ws where p.image.id = ws.image.id "
+             "and ws.well.plate.id in (:ids)",
+    "Screen": "select p.id from Pixels p, WellSample ws, ScreenPlateLink sl where p.image.id = ws.image.id "
+              "and ws.well.plate.id = sl.child.id and sl.parent.id in (:ids)",
+}
+
+
+def get_pixels_ids(conn, object_type, object_ids):
+    """
+    Get the pixels IDs of all images within the given objects
+
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    object_type: str
+        type of the objects (Image, Dataset, Project, Well, Plate, Screen)
+    object_ids: list
+        IDs of the objects
+
+    Returns
+    -------
+    pixels_ids: list
+        pixels IDs, without duplicates
+    """
+    params = omero.sys.ParametersI()
+    params.addIds(object_ids)
+    rows = conn.getQueryService().projection(PIXELS_QUERIES[object_type], params, conn.SERVICE_OPTS)
+    return sorted({unwrap(row[0]) for row in rows})
+
+
+def warm_thumbnails(conn, pixels_ids, size=THUMBNAIL_SIZE):
+    """
+    Ask the server to generate the thumbnails of all pixels, by batches processed in parallel,
+    so that they are already in the cache when a user opens the images
+
+    Parameters
+    ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    pixels_ids: list
+        pixels IDs of the images
+    size: int
+        longest side of the thumbnails, in pixels
+
+    Returns
+    -------
+    n_thumbnails: int
+        number of thumbnails available in the cache
+    """
+    batches = [pixels_ids[i:i + THUMBNAIL_BATCH_SIZE] for i in range(0, len(pixels_ids), THUMBNAIL_BATCH_SIZE)]
+    local = threading.local()
+    stores = []
+    stores_lock = threading.Lock()
+
+    def warm(batch):
+        # one thumbnail store per worker; conn.createThumbnailStore() would return the shared gateway store
+        if not hasattr(local, "store"):
+            local.store = conn.c.sf.createThumbnailStore()
+            with stores_lock:
+                stores.append(local.store)
+        try:
+            thumbnails = local.store.getThumbnailByLongestSideSet(rint(size), batch, conn.SERVICE_OPTS)
+            return len(thumbnails)
+        except Exception as e:
+            print(f"ERROR: cannot generate thumbnails for pixels {batch[0]} to {batch[-1]}: {e}")
+            return 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+            n_thumbnails = sum(executor.map(warm, batches))
+    finally:
+        for store in stores:
+            store.close()
+    return n_thumbnails
+
+
+def run_script():
+    data_types = [rstring("Project"), rstring("Dataset"), rstring("Image"),
+                  rstring("Screen"), rstring("Plate"), rstring("Well")]
+
+    client = scripts.client(
+        'Warm thumbnails',
+        """
+    This script asks the server to generate the thumbnails of all images within the selected object(s), 
+    so that users do not wait for them when opening the object(s) for the first time.
+    It can be run on the outputs of other scripts (new plates, projections, duplicated images...).
+        """,
+        scripts.String(
+            P_DATA_TYPE, optional=False, grouping="1",
+            description="Type of the objects",
+            values=data_types, default="Plate"),
+        scripts.List(
+            P_IDS, optional=False, grouping="2",
+            description="Objects IDs").ofType(rlong(0)),
+        scripts.Int(
+            P_SIZE, optional=True, grouping="3",
+            description="Longest side of the thumbnails, in pixels",
+            default=THUMBNAIL_SIZE, min=16),
+
+        authors=["Rémy Dornier"],
+        institutions=["EPFL - BIOP"],
+        contact="omero@groupes.epfl.ch",
+        version="1.0.0"
+    )
+
+    try:
+        # process the list of args above.
+        script_params = {}
+        for key in client.getInputKeys():
+            if client.getInput(key):
+                script_params[key] = client.getInput(key, unwrap=True)
+
+        # wrap client to use the Blitz Gateway
+        conn = BlitzGateway(client_obj=client)
+        print("script params")
+        for k, v in script_params.items():
+            print(k, v)
+
+        pixels_ids = get_pixels_ids(conn, script_params[P_DATA_TYPE], script_params[P_IDS])
+        print(f"Generating thumbnails for {len(pixels_ids)} images...")
+        n_thumbnails = warm_thumbnails(conn, pixels_ids, script_params.get(P_SIZE, THUMBNAIL_SIZE))
+        message = f"{n_thumbnails} / {len(pixels_ids)} thumbnails generated"
+        print(message)
+        client.setOutput("Message", rstring(message))
+    finally:
+        client.closeSession()
+
+
+if __name__ == "__main__":
+    run_script()
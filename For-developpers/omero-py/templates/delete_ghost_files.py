@@ -1,33 +1,24 @@
 from omero.gateway import BlitzGateway
-from omero.cli import cli_login
-from omero.plugins.fs import FsControl
-from omero.plugins.delete import DeleteControl
+from omero.cmd import Delete2, DiskUsage2, DiskUsage2Response, ERR
+from filesets import scan_filesets, save_report
+from omero_commands import submit_all
 import traceback
-from io import StringIO
-import sys
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
     QWidget, QApplication, QHBoxLayout, QSpinBox, QCheckBox
-from pathlib import Path
-import os
-from datetime import datetime
-
-
-# Class to capture the output of the CLI command
-class Capturing(list):
-    def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
-        return self
-
-    def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio    # free up some memory
-        sys.stdout = self._stdout
 
 
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server.epfl.ch'
-DEFAULT_LIMIT = 200
+DEFAULT_PAGE_SIZE = 500
+
+# number of filesets deleted by one request
+DEFAULT_CHUNK_SIZE = 100
+# number of requests running at the same time on the server
+DEFAULT_IN_FLIGHT = 2
+
+# header of the deletion report
+CHUNK_COLUMNS = ["Chunk", "First fileset", "Last fileset", "Filesets", "Files", "Size (GB)", "Deleted objects",
+                 "Status"]
 
 
 class MainWindow(QMainWindow):
@@ -78,15 +69,15 @@ class MainWindow(QMainWindow):
         password_widget.setLayout(password_layout)
         widgets.append(password_widget)
         
-        # Query limit fields
+        # Page size fields
         query_limit_layout = QHBoxLayout()
-        query_limit_label = QLabel("Limit size of the query")
+        query_limit_label = QLabel("Filesets per query")
         query_limit_label.setStyleSheet(FONT_SIZE)
         self.query_limits = QSpinBox()
         self.query_limits.setStyleSheet(FONT_SIZE)
-        self.query_limits.setMinimum(0)
-        self.query_limits.setMaximum(10000000)
-        self.query_limits.setValue(DEFAULT_LIMIT)
+        self.query_limits.setMinimum(1)
+        self.query_limits.setMaximum(100000)
+        self.query_limits.setValue(DEFAULT_PAGE_SIZE)
         self.query_limits.setSingleStep(1)
         query_limit_widget = QWidget()
         query_limit_layout.addWidget(query_limit_label)
@@ -94,6 +85,36 @@ class MainWindow(QMainWindow):
         query_limit_widget.setLayout(query_limit_layout)
         widgets.append(query_limit_widget)
 
+        # Chunk size fields
+        chunk_size_layout = QHBoxLayout()
+        chunk_size_label = QLabel("Filesets per delete request")
+        chunk_size_label.setStyleSheet(FONT_SIZE)
+        self.chunk_size = QSpinBox()
+        self.chunk_size.setStyleSheet(FONT_SIZE)
+        self.chunk_size.setMinimum(1)
+        self.chunk_size.setMaximum(10000)
+        self.chunk_size.setValue(DEFAULT_CHUNK_SIZE)
+        chunk_size_widget = QWidget()
+        chunk_size_layout.addWidget(chunk_size_label)
+        chunk_size_layout.addWidget(self.chunk_size)
+        chunk_size_widget.setLayout(chunk_size_layout)
+        widgets.append(chunk_size_widget)
+
+        # In flight fields
+        in_flight_layout = QHBoxLayout()
+        in_flight_label = QLabel("Parallel requests")
+        in_flight_label.setStyleSheet(FONT_SIZE)
+        self.in_flight = QSpinBox()
+        self.in_flight.setStyleSheet(FONT_SIZE)
+        self.in_flight.setMinimum(1)
+        self.in_flight.setMaximum(16)
+        self.in_flight.setValue(DEFAULT_IN_FLIGHT)
+        in_flight_widget = QWidget()
+        in_flight_layout.addWidget(in_flight_label)
+        in_flight_layout.addWidget(self.in_flight)
+        in_flight_widget.setLayout(in_flight_layout)
+        widgets.append(in_flight_widget)
+
         # Dry run fields
         dry_run_layout = QHBoxLayout()
         self.dry_run = QCheckBox()
@@ -138,12 +159,15 @@ class MainWindow(QMainWindow):
         password = self.password.text()
         host = self.host.text()
         dry_run = self.dry_run.isChecked()
-        query_limit = self.query_limits.value()
+        page_size = self.query_limits.value()
+        chunk_size = self.chunk_size.value()
+        in_flight = self.in_flight.value()
         self.close()
-        run_script(host, username, password, query_limit, dry_run)
+        run_script(host, username, password, page_size, dry_run, chunk_size, in_flight)
 
 
-def run_script(host, username, password, query_limit, dry_run):
+def run_script(host, username, password, page_size, dry_run, chunk_size=DEFAULT_CHUNK_SIZE,
+               in_flight=DEFAULT_IN_FLIGHT):
     """
     Connect to OMERO, list the filesets not linked to any Image object and delete them if specified
 
@@ -152,138 +176,136 @@ def run_script(host, username, password, query_limit, dry_run):
     host            String: name of the OMERO server
     username        String: username of the OMERO user
     password        String: password of the OMERO user
-    query_limit     Integer: size of the filesets to retrieve from OMERO.
+    page_size       Integer: number of filesets retrieved from OMERO in one query.
                             Should not be too large to not overload the server
-    dry_run         Boolean: True to NOT delete files on the server
+    dry_run         Boolean: True to NOT delete files on the server, only estimate the freed space
+    chunk_size      Integer: number of filesets deleted by one request
+    in_flight       Integer: number of delete requests running at the same time on the server
 
     Returns
     -------
 
     """
-    with cli_login("-u", username, "-w", password, "-s", host, "-p", "4064") as cli:
-        # connect to OMERO server
-        conn = BlitzGateway(client_obj=cli.get_client())
-
-        if conn.isConnected():
-            print(f"Connected to {host}")
-            try:
-                print("Getting filesets not linked to any images...")
-                cli.register('fs', FsControl, '_')
-                cli.register('delete', DeleteControl, '_')
-
-                import_args = ["fs",
-                               "sets",
-                               "--without-images",
-                               "--limit",
-                               str(query_limit)]
-
-                try:
-                    with Capturing() as output:
-                        cli.invoke(import_args, strict=True)
-
-                    print("SUCCESS", f"Got all filesets not linked to any OMERO image object")
-                except PermissionError as err:
-                    print(f"Error during fs reading {err}")
-
-                # Prepare Delete command
-                print("Preparing the deletion of filesets not linked to any images...")
-                fs_ids = extract_fs_ids(output)
-                import_args = create_delete_command(fs_ids, dry_run)
-
-                try:
-                    # Run delete
-                    with Capturing() as output2:
-                        cli.invoke(import_args, strict=True)
-                    if not dry_run:
-                        print("SUCCESS", "Deleted all filesets not linked to any OMERO image object")
-                except PermissionError as err:
-                    print(f"Error during fs reading {err}")
-
-                print("Saving report in the Downloads...")
-                save_report(output2, "Delete-fileset-logs")
-                print("SUCCESS", "Report saved !")
-
-                # closing CLI session
-                cli.get_client().closeSession()
-
-                # delete variables to free some memory
-                del output
-                del output2
-            except Exception as e:
-                print(e)
-                traceback.print_exc()
-            finally:
-                conn.close()
-                print(f"Disconnected from {host}")
-
-
-def extract_fs_ids(output):
+    conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
+    conn.connect()
+
+    if conn.isConnected():
+        print(f"Connected to {host}")
+        try:
+            print("Getting filesets not linked to any images...")
+            conn.SERVICE_OPTS.setOmeroGroup(-1)
+
+            fs_ids = []
+
+            def keep_ids(rows):
+                # keep the fileset ids while streaming the rows to the report
+                for row in rows:
+                    fs_ids.append(row[0])
+                    yield row
+
+            rows = scan_filesets(conn, page_size, without_images=True)
+            path = save_report(keep_ids(rows), "Ghost filesets")
+            print("SUCCESS", f"Got {len(fs_ids)} filesets not linked to any OMERO image object, "
+                             f"listed in {path}")
+
+            chunks = [fs_ids[i:i + chunk_size] for i in range(0, len(fs_ids), chunk_size)]
+
+            # estimate the space freed by each chunk
+            print(f"Estimating the space used by {len(chunks)} chunks of filesets...")
+            usage = get_chunk_usage(conn, chunks, in_flight)
+            total_files = sum(n_files for n_files, _ in usage.values())
+            total_size = sum(size for _, size in usage.values())
+            print(f"Deleting the filesets would free {total_size / 1000000000} GB ({total_files} files)")
+
+            print("Saving report in the Downloads...")
+            if dry_run:
+                rows = ([idx, chunks[idx][0], chunks[idx][-1], len(chunks[idx]), *get_usage_columns(usage, idx),
+                         "", "Dry run"] for idx in range(len(chunks)))
+                path = save_report(rows, "Delete-fileset-logs", CHUNK_COLUMNS)
+            else:
+                path = save_report(delete_chunks(conn, chunks, usage, in_flight), "Delete-fileset-logs", CHUNK_COLUMNS)
+                print("SUCCESS", "Deleted all filesets not linked to any OMERO image object")
+            print("SUCCESS", f"Report saved in {path}")
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+        finally:
+            conn.close()
+            print(f"Disconnected from {host}")
+
+
+def get_chunk_usage(conn, chunks, in_flight):
     """
-    Read the Fileset IDs from the CLI output
+    Estimate the number of files and the space used by each chunk of filesets
 
     Parameters
     ----------
-    output: logs from the CLI output
+    conn: BlitzGateway connection
+    chunks: list of lists of fileset ids
+    in_flight: number of requests running at the same time on the server
 
     Returns
     -------
-    fs_ids: list of fileset ids
+    usage: dict chunk index -> (number of files, size in bytes)
 
     """
-    fs_ids = []
-    for i in range(2,len(output)-1):
-        line = output[i]
-        fs_ids.append(line.split("|")[1].strip())
-    return fs_ids
+    requests = {idx: DiskUsage2(targetObjects={"Fileset": chunk}) for idx, chunk in enumerate(chunks)}
+    usage = {}
+    for idx, rsp in submit_all(conn, requests, in_flight):
+        if isinstance(rsp, DiskUsage2Response):
+            usage[idx] = (sum(rsp.totalFileCount.values()), sum(rsp.totalBytesUsed.values()))
+        else:
+            print(f"Cannot estimate the space used by chunk {idx}: {rsp}")
+    return usage
 
 
-def create_delete_command(fs_ids, dry_run):
+def delete_chunks(conn, chunks, usage, in_flight):
     """
-    Create the list of input arguments to be passed to the CLI in order to delete
-    filesets on OMERO.
+    Delete the filesets chunk by chunk, with a bounded number of requests running on the server
 
     Parameters
     ----------
-    fs_ids: list of fileset ids
-    dry_run: True to NOT delete file on the server
+    conn: BlitzGateway connection
+    chunks: list of lists of fileset ids
+    usage: dict chunk index -> (number of files, size in bytes)
+    in_flight: number of requests running at the same time on the server
 
     Returns
     -------
-    input_args: List of CLI arguments to delete filesets. Adding --dry-run if specified.
+    rows: generator of report rows, in CHUNK_COLUMNS order, as soon as each chunk is deleted
 
     """
-    input_args = ["delete", "--report"]
-    if dry_run:
-        input_args.append("--dry-run")
-
-    for fs_id in fs_ids:
-        input_args.append(f"Fileset:{fs_id}")
-    return input_args
-
-
-def save_report(report, name):
+    requests = {idx: Delete2(targetObjects={"Fileset": chunk}) for idx, chunk in enumerate(chunks)}
+    for idx, rsp in submit_all(conn, requests, in_flight):
+        chunk = chunks[idx]
+        if isinstance(rsp, ERR):
+            status = f"Failed: {rsp.name} {rsp.parameters}"
+            n_deleted = 0
+        else:
+            status = "Deleted"
+            n_deleted = sum(len(ids) for ids in rsp.deletedObjects.values())
+        print(f"Chunk {idx + 1}/{len(chunks)} (filesets {chunk[0]} to {chunk[-1]}): {status}")
+        yield [idx, chunk[0], chunk[-1], len(chunk), *get_usage_columns(usage, idx), n_deleted, status]
+
+
+def get_usage_columns(usage, idx):
     """
-    Save the output logs of the CLI in the Downloads folder,
-    with the date-time of the current run.
+    Format the usage of one chunk for the report
 
     Parameters
     ----------
-    name: String: Name of the text file
-    report: List of CLI logs
+    usage: dict chunk index -> (number of files, size in bytes)
+    idx: chunk index
 
     Returns
     -------
+    columns: (number of files, size in GB), empty if the usage is unknown
 
     """
-    # Get the current date and time
-    now = datetime.now()
-    format_code = "%Y-%m-%d_%Hh%Mm%Ss"
-    formatted_datetime = now.strftime(format_code)
-    file_name = f"{formatted_datetime}-{name}.txt"
-    
-    # save the logs
-    with open(os.path.join(Path.home(), "Downloads", file_name), "w") as f:
-        f.write("\n".join(report))
+    if idx not in usage:
+        return "", ""
+    n_files, size = usage[idx]
+    return n_files, size / 1000000000
 
 
 if __name__ == "__main__":
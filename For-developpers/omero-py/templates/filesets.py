@@ -0,0 +1,85 @@
+import omero
+import csv
+from pathlib import Path
+import os
+from datetime import datetime
+
+"""
+Shared code to scan the filesets of an OMERO server, used by get_filesets_summary.py and delete_ghost_files.py.
+"""
+
+# header of the fileset reports
+FILESET_COLUMNS = ["Id", "Prefix", "Owner", "Group", "Files", "Images"]
+
+
+def scan_filesets(conn, page_size, without_images=False):
+    """
+    Scan the filesets of the server page by page, ordered by ID.
+    Each page starts after the last ID of the previous one (keyset pagination), so that
+    the whole server can be scanned in bounded memory.
+
+    Parameters
+    ----------
+    conn: BlitzGateway connection
+    page_size: number of filesets retrieved in one query
+    without_images: True to only get the filesets not linked to any Image object
+
+    Returns
+    -------
+    rows: generator of [id, prefix, owner, group, number of files, number of images], in FILESET_COLUMNS order
+
+    """
+    query = ("select fs.id, fs.templatePrefix, o.omeName, g.name, "
+             "(select count(e) from FilesetEntry e where e.fileset.id = fs.id), "
+             "(select count(i) from Image i where i.fileset.id = fs.id) "
+             "from Fileset fs join fs.details.owner o join fs.details.group g "
+             "where fs.id > :last ")
+    if without_images:
+        query += "and not exists (select i from Image i where i.fileset.id = fs.id) "
+    query += "order by fs.id"
+
+    qs = conn.getQueryService()
+    last_id = -1
+    while True:
+        params = omero.sys.ParametersI()
+        params.addLong("last", last_id)
+        params.page(0, page_size)
+        rows = qs.projection(query, params, conn.SERVICE_OPTS)
+        for row in rows:
+            yield [r.val if r is not None else "" for r in row]
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1][0].val
+
+
+def save_report(rows, name, columns=FILESET_COLUMNS):
+    """
+    Stream the report rows into a csv file in the Downloads folder,
+    with the date-time of the current run.
+
+    Parameters
+    ----------
+    rows: iterable of rows, in the order of the columns
+    name: String: name of the csv file
+    columns: list of String: header of the report
+
+    Returns
+    -------
+    path: String: path of the csv file
+
+    """
+    # Get the current date and time
+    now = datetime.now()
+    format_code = "%Y-%m-%d_%Hh%Mm%Ss"
+    formatted_datetime = now.strftime(format_code)
+    file_name = f"{formatted_datetime}-{name}.csv"
+    path = os.path.join(Path.home(), "Downloads", file_name)
+
+    # save the rows as they come, flushing each of them to follow the progress
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            f.flush()
+    return path
@@ -1,14 +1,24 @@
 import omero
 from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
 import traceback
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
     QWidget, QApplication, QHBoxLayout, QFileDialog, QSpinBox
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+import threading
 
 
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server.epfl.ch'
 DEFAULT_LIMIT = 200
+DEFAULT_CHUNK_SIZE_MB = 16
+# number of attachments downloaded at the same time
+ATTACHMENT_WORKERS = 4
+ATTACHMENT_CHUNK_SIZE = DEFAULT_CHUNK_SIZE_MB * 1024 * 1024
+# name of the OMERO checksum algorithm computed by copy_attachment
+SHA1_HASHER = "SHA1-160"
 
 
 class MainWindow(QMainWindow):
@@ -90,6 +100,22 @@ class MainWindow(QMainWindow):
         folder_widget.setLayout(folder_layout)
         widgets.append(folder_widget)
 
+        # chunk size fields
+        chunk_size_layout = QHBoxLayout()
+        chunk_size_label = QLabel("Chunk size (MB)")
+        chunk_size_label.setStyleSheet(FONT_SIZE)
+        self.chunk_size = QSpinBox()
+        self.chunk_size.setStyleSheet(FONT_SIZE)
+        self.chunk_size.setMinimum(1)
+        self.chunk_size.setMaximum(1024)
+        self.chunk_size.setSingleStep(1)
+        self.chunk_size.setValue(DEFAULT_CHUNK_SIZE_MB)
+        chunk_size_widget = QWidget()
+        chunk_size_layout.addWidget(chunk_size_label)
+        chunk_size_layout.addWidget(self.chunk_size)
+        chunk_size_widget.setLayout(chunk_size_layout)
+        widgets.append(chunk_size_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -124,15 +150,16 @@ class MainWindow(QMainWindow):
         host = self.host.text()
         output_path = self.folder.text()
         image_id = self.image_id.value()
+        chunk_size = self.chunk_size.value() * 1024 * 1024
         self.close()
-        run_script(host, username, password, image_id, output_path)
+        run_script(host, username, password, image_id, output_path, chunk_size)
 
     def open_file_chooser(self):
         response = QFileDialog.getExistingDirectory(parent=self, caption="select a folder", directory=os.getcwd())
         self.folder.setText(str(response))
 
 
-def run_script(host, username, password, image_id, output_path):
+def run_script(host, username, password, image_id, output_path, chunk_size=ATTACHMENT_CHUNK_SIZE):
     conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
     conn.connect()
 
@@ -140,7 +167,7 @@ def run_script(host, username, password, image_id, output_path):
         print(f"Connected to {host}")
         try:
             image = conn.getObject("Image", image_id)
-            process_attachment(image, output_path)
+            process_attachment(conn, image, output_path, chunk_size)
         except Exception as e:
             print(e)
             traceback.print_exc()
@@ -149,52 +176,108 @@ def run_script(host, username, password, image_id, output_path):
             print(f"Disconnected from {host}")
 
 
-def copy_attachment(file_path, ann):
+def copy_attachment(conn, store, file_path, file_id, file_hash, chunk_size):
     """
-    Do a hard copy of the current file
+    Do a hard copy of the current file, unless an identical copy already exists.
+    The file is written to a .part file, checked against the SHA1 from OMERO, then renamed.
 
     Parameters
     ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
+    store: omero.api.RawFileStorePrx
+        raw file store used to read the file
     file_path: str
         absolute path of the annotation file to copy
-    ann: omero.model.Annotation
-        file to copy
+    file_id: int
+        ID of the original file to copy
+    file_hash: str
+        SHA1 of the original file, None if OMERO hashed it with another algorithm
+    chunk_size: int
+        number of bytes read at once
 
     Returns
     -------
 
     """
-    with open(str(file_path), 'wb') as f:
-        print("Copying file to", file_path, "...")
-        for chunk in ann.getFileInChunks():
+    if file_hash is not None and os.path.exists(file_path):
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        if sha1.hexdigest() == file_hash:
+            print("Skipping", file_path, ": already downloaded")
+            return
+
+    print("Copying file to", file_path, "...")
+    store.setFileId(file_id, conn.SERVICE_OPTS)
+    size = store.size(conn.SERVICE_OPTS)
+    sha1 = hashlib.sha1()
+    with open(f"{file_path}.part", 'wb') as f:
+        for offset in range(0, size, chunk_size):
+            chunk = store.read(offset, min(chunk_size, size - offset), conn.SERVICE_OPTS)
             f.write(chunk)
+            sha1.update(chunk)
+
+    if file_hash is not None and sha1.hexdigest() != file_hash:
+        os.remove(f"{file_path}.part")
+        raise IOError(f"SHA1 of the downloaded file {file_id} does not match the one on OMERO")
+    os.replace(f"{file_path}.part", file_path)
 
 
-def process_attachment(container, output_path):
+def process_attachment(conn, container, output_path, chunk_size=ATTACHMENT_CHUNK_SIZE):
     """
-    Do a hard copy of all the attachments linked to the current object
+    Do a hard copy of all the attachments linked to the current object,
+    ATTACHMENT_WORKERS at a time, each worker with its own raw file store.
+    Attachments already downloaded with the same SHA1 are skipped.
 
     Parameters
     ----------
+    conn: ``omero.gateway.BlitzGateway`` object
+        OMERO connection.
     container: omero.model.Object
         The object to get attachments from
     output_path: str
         path of the output file
+    chunk_size: int
+        number of bytes read at once
     Returns
     -------
 
     """
-    for ann in container.listAnnotations():
-        # only process attachments, not other types of annotations
-        if ann.OMERO_TYPE == omero.model.FileAnnotationI:
-            file_path = os.path.join(output_path, f"{ann.getFile().getId()}_{ann.getFile().getName()}")
-            if not os.path.exists(file_path):
-                try:
-                    # do a hard copy of the attachment, with right name & extension
-                    # i.e. human-readable
-                    copy_attachment(file_path, ann)
-                except Exception as e:
-                    print(f"ERROR: cannot copy attachment for {container.OMERO_CLASS} {container.getId()}: {e}")
+    # load the hasher of each attachment file with the file itself
+    params = omero.sys.ParametersI()
+    params.addId(container.getId())
+    query = ("select f.id, f.name, f.hash, h.value from FileAnnotation a join a.file f left outer join f.hasher h "
+             f"where a.id in (select l.child.id from {container.OMERO_CLASS}AnnotationLink l where l.parent.id = :id)")
+
+    attachments = []
+    for file_id, file_name, file_hash, hasher in unwrap(
+            conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)):
+        # do a hard copy of the attachment, with right name & extension
+        # i.e. human-readable
+        file_path = os.path.join(output_path, f"{file_id}_{file_name}")
+        # only SHA1 hashes can be checked against the downloaded file
+        attachments.append((file_path, file_id, file_hash if hasher == SHA1_HASHER else None))
+
+    local = threading.local()
+    stores = []
+
+    def download(attachment):
+        if not hasattr(local, "store"):
+            local.store = conn.c.sf.createRawFileStore()
+            stores.append(local.store)
+        try:
+            copy_attachment(conn, local.store, *attachment, chunk_size)
+        except Exception as e:
+            print(f"ERROR: cannot copy attachment for {container.OMERO_CLASS} {container.getId()}: {e}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as executor:
+            list(executor.map(download, attachments))
+    finally:
+        for store in stores:
+            store.close()
 
 
 if __name__ == "__main__":
@@ -2,10 +2,15 @@ from typing import List
 import traceback
 from omero.gateway import BlitzGateway
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
-    QWidget, QApplication, QHBoxLayout, QSpinBox
+    QWidget, QApplication, QHBoxLayout, QSpinBox, QCheckBox
 import omero
-import sys
-from omero.cmd import (DiskUsage2, DiskUsage2Response, HandlePrx)
+import os
+import re
+import time
+import sqlite3
+from datetime import date
+from omero.cmd import (DiskUsage2, DiskUsage2Response)
+from omero_commands import submit_all
 
 """
 Code copied and adapted from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
@@ -14,6 +19,24 @@ Code copied and adapted from https://github.com/ome/omero-demo-cleanup/blob/main
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server-poc.epfl.ch'
 
+FIGURE_NS = 'omero.web.figure.json'
+# column of the summary -> counted OMERO type
+COUNT_TYPES = {
+    "nImages": "Image",
+    "nDatasets": "Dataset",
+    "nProjects": "Project",
+    "nScreens": "Screen",
+    "nPlates": "Plate",
+}
+COUNT_COLUMNS = list(COUNT_TYPES) + ["nTags", "nFigure", "nAttachments"]
+
+# number of DiskUsage2 requests running at the same time on the server
+DEFAULT_IN_FLIGHT = 4
+# local database with the history of the disk usage of each user, in each group; one per server
+USAGE_DB_FILE = os.path.join(os.path.expanduser("~"), "omero_disk_usage_{host}.sqlite")
+# maximum age of a stored disk usage, in s; after it, the usage is computed again even if the user has no new event
+USAGE_CACHE_TTL = 7 * 24 * 3600
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -77,6 +100,32 @@ class MainWindow(QMainWindow):
         user_id_widget.setLayout(user_id_layout)
         widgets.append(user_id_widget)
 
+        # parallel requests fields
+        in_flight_layout = QHBoxLayout()
+        in_flight_label = QLabel("Parallel requests")
+        in_flight_label.setStyleSheet(FONT_SIZE)
+        self.in_flight = QSpinBox()
+        self.in_flight.setStyleSheet(FONT_SIZE)
+        self.in_flight.setMinimum(1)
+        self.in_flight.setMaximum(32)
+        self.in_flight.setValue(DEFAULT_IN_FLIGHT)
+        in_flight_widget = QWidget()
+        in_flight_layout.addWidget(in_flight_label)
+        in_flight_layout.addWidget(self.in_flight)
+        in_flight_widget.setLayout(in_flight_layout)
+        widgets.append(in_flight_widget)
+
+        # cache fields
+        incremental_layout = QHBoxLayout()
+        self.incremental = QCheckBox()
+        self.incremental.setStyleSheet(FONT_SIZE)
+        self.incremental.setText("Only compute the disk usage of users with new data")
+        self.incremental.setChecked(True)
+        incremental_widget = QWidget()
+        incremental_layout.addWidget(self.incremental)
+        incremental_widget.setLayout(incremental_layout)
+        widgets.append(incremental_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -110,11 +159,13 @@ class MainWindow(QMainWindow):
         password = self.password.text()
         host = self.host.text()
         user_id = self.user_id.value()
+        in_flight = self.in_flight.value()
+        incremental = self.incremental.isChecked()
         self.close()
-        run_script(host, username, password, user_id)
+        run_script(host, username, password, user_id, in_flight, incremental)
 
 
-def run_script(host, username, password, user_id):
+def run_script(host, username, password, user_id, in_flight=DEFAULT_IN_FLIGHT, incremental=True):
     conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
     conn.connect()
 
@@ -122,52 +173,26 @@ def run_script(host, username, password, user_id):
         print(f"Connected to {host}")
         try:
             conn.SERVICE_OPTS.setOmeroGroup(-1)
-            qs = conn.getQueryService()
-            print(f'Counting OMERO objects for user #{user_id}')
-
-            # getting nImages
-            query = f"SELECT COUNT(*) FROM Image WHERE owner_id = {user_id}"
-            user_img_count = get_object_count(conn, qs, query)
-
-            # getting nDatasets
-            query = f"SELECT COUNT(*) FROM Dataset WHERE owner_id = {user_id}"
-            user_dataset_count = get_object_count(conn, qs, query)
-
-            # getting nProjects
-            query = f"SELECT COUNT(*) FROM Project WHERE owner_id = {user_id}"
-            user_project_count = get_object_count(conn, qs, query)
-
-            # getting nScreens
-            query = f"SELECT COUNT(*) FROM Screen WHERE owner_id = {user_id}"
-            user_screen_count = get_object_count(conn, qs, query)
-
-            # getting nPlates
-            query = f"SELECT COUNT(*) FROM Plate WHERE owner_id = {user_id}"
-            user_plate_count = get_object_count(conn, qs, query)
-
-            # getting nTags
-            query = f"SELECT COUNT(*) FROM Annotation WHERE owner_id = {user_id} and discriminator = '/basic/text/tag/'"
-            user_tag_count = get_object_count(conn, qs, query)
-
-            # getting nFigures
-            query = f"SELECT COUNT(*) FROM Annotation WHERE owner_id = {user_id} and discriminator='/type/OriginalFile/' and ns = 'omero.web.figure.json'"
-            user_figure_count = get_object_count(conn, qs, query)
-
-            # getting nAttachments
-            query = f"SELECT COUNT(*) FROM Annotation WHERE owner_id = {user_id} and discriminator='/type/OriginalFile/' and ns <> 'omero.web.figure.json'"
-            user_attachment_count = get_object_count(conn, qs, query)
+            if user_id > 0:
+                print(f'Counting OMERO objects for user #{user_id}')
+                object_counts = get_object_counts(conn, [user_id])
+            else:
+                print('Counting OMERO objects for all users')
+                object_counts = get_object_counts(conn)
 
             # getting disk usage for the current user (nTotal files and total size in bytes)
-            user_stats = resource_usage(conn, user_id)
+            db_path = get_usage_db_path(host)
+            user_stats = resource_usage(conn, user_id, in_flight, incremental, db_path)
 
             # create a nice summary
-            file_content = create_file(user_stats, user_img_count, user_dataset_count, user_project_count,
-                                       user_screen_count, user_plate_count, user_tag_count, user_figure_count,
-                                       user_attachment_count)
+            file_content = create_file(user_stats, object_counts)
             print("______________________________________________")
             print(f"Found {len(user_stats)} users")
             print(file_content)
             print("______________________________________________")
+            print(f"Disk usage per user and group, compared to the previous snapshot in {db_path}")
+            print(create_group_file(db_path, date.today().isoformat()))
+            print("______________________________________________")
 
         except Exception as e:
             print(e)
@@ -177,12 +202,25 @@ def run_script(host, username, password, user_id):
             print(f"Disconnected from {host}")
 
 
-def create_file(user_stats, img_count, dst_count, prj_count, scr_count, plt_count, tag_count, fgr_count, att_count):
-    content = ("user_id,username,totalFileSize (GB),nTotalFiles,nImages,nDatasets,nProjects,"
-               "nScreens,nPlates,nTags,nFigure,nAttachments\n")
+def create_file(user_stats, object_counts):
+    content = ("user_id,username,totalFileSize (GB),deltaFileSize (GB),nTotalFiles,"
+               + ",".join(COUNT_COLUMNS) + "\n")
     for user in user_stats:
-        content += (f"{user.id},{user.name},{user.size/1000000000},{user.count},{img_count}"
-                    f",{dst_count},{prj_count},{scr_count},{plt_count},{tag_count},{fgr_count},{att_count}\n")
+        counts = object_counts.get(user.id, {})
+        content += (f"{user.id},{user.name},{user.size/1000000000},{user.size_delta/1000000000},{user.count},"
+                    + ",".join(str(counts.get(column, 0)) for column in COUNT_COLUMNS) + "\n")
+
+    return content
+
+
+def create_group_file(db_path, snapshot_date):
+    content = "user_id,group_id,totalFileSize (GB),deltaFileSize (GB),nTotalFiles,deltaTotalFiles\n"
+    db = open_usage_db(db_path)
+    try:
+        for user_id, group_id, count, size, count_delta, size_delta in get_usage_deltas(db, snapshot_date):
+            content += f"{user_id},{group_id},{size/1000000000},{size_delta/1000000000},{count},{count_delta}\n"
+    finally:
+        db.close()
 
     return content
 
@@ -193,12 +231,13 @@ class UserStats:
     # copied this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
 
     def __init__(
-        self, user_id: int, name: str, count: int, size: int
+        self, user_id: int, name: str, count: int, size: int, size_delta: int = 0
     ) -> None:
         self.id = user_id
         self.name = name
         self.count = count
         self.size = size
+        self.size_delta = size_delta
 
     def is_worse_than(self, other: "UserStats") -> bool:
         if (
@@ -212,19 +251,55 @@ class UserStats:
         )
 
 
-def get_object_count(conn, qs, q):
+def get_object_counts(conn, user_ids=None):
+    # Count the objects of each user with a few grouped queries, instead of one query per user and per type.
+    # Returns a dict {user_id: {column: count}}
+    qs = conn.getQueryService()
+    object_counts = {}
+
+    def add_counts(rows, get_column):
+        for row in rows:
+            values = [r.val if r is not None else None for r in row]
+            owner_id, count = values[0], values[-1]
+            column = get_column(values)
+            user_counts = object_counts.setdefault(owner_id, {})
+            user_counts[column] = user_counts.get(column, 0) + count
+
+    for column, object_type in COUNT_TYPES.items():
+        query, params = get_count_query(f"select o.details.owner.id, count(o) from {object_type} o",
+                                        "group by o.details.owner.id", user_ids)
+        add_counts(qs.projection(query, params, conn.SERVICE_OPTS), lambda values, c=column: c)
+
+    # annotations, split by type (discriminator) and namespace
+    query, params = get_count_query("select o.details.owner.id, count(o) from TagAnnotation o",
+                                    "group by o.details.owner.id", user_ids)
+    add_counts(qs.projection(query, params, conn.SERVICE_OPTS), lambda values: "nTags")
+
+    query, params = get_count_query("select o.details.owner.id, o.ns, count(o) from FileAnnotation o",
+                                    "group by o.details.owner.id, o.ns", user_ids)
+    add_counts(qs.projection(query, params, conn.SERVICE_OPTS),
+               lambda values: "nFigure" if values[1] == FIGURE_NS else "nAttachments")
+
+    return object_counts
+
+
+def get_count_query(select, group_by, user_ids=None):
     params = omero.sys.ParametersI()
-    results = qs.projection(q, params, conn.SERVICE_OPTS)
+    if user_ids:
+        params.addIds(user_ids)
+        return f"{select} where o.details.owner.id in (:ids) {group_by}", params
+    return f"{select} {group_by}", params
 
-    return results[0][0].val
 
+def resource_usage(conn: BlitzGateway, experimenter_id, in_flight=DEFAULT_IN_FLIGHT,
+                   incremental=True, db_path=None) -> List[UserStats]:
+    # Note users' resource usage and append it as today's snapshot to the history database.
+    # DiskUsage2.targetClasses remains too inefficient so iterate, with several requests running at the same time.
+    # In incremental mode, users without any new event since the previous snapshot are not computed again.
+    # adapted this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
 
-def resource_usage(conn: BlitzGateway, experimenter_id) -> List[UserStats]:
-    # Note users' resource usage.
-    # DiskUsage2.targetClasses remains too inefficient so iterate.
-    # copied this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
+    db_path = get_usage_db_path(conn.host) if db_path is None else db_path
 
-    user_stats = []
     user_info = {}
     if experimenter_id > 0:
         user = conn.getObject("Experimenter", experimenter_id)
@@ -236,46 +311,148 @@ def resource_usage(conn: BlitzGateway, experimenter_id) -> List[UserStats]:
             user_id = result[0].val
             user_name = result[1].val
             user_info[user_id] = user_name
-        
-    for user_id, user_name in user_info.items():
-        print(f'Finding disk usage of "{user_name}" (#{user_id}).')
-        user = {"Experimenter": [user_id]}
-        rsp = submit(conn, DiskUsage2(targetObjects=user), DiskUsage2Response)
 
-        file_count = 0
-        file_size = 0
+    snapshot_date = date.today().isoformat()
+    last_events = get_last_events(conn, list(user_info))
+    now = time.time()
 
-        for who, usage in rsp.totalFileCount.items():
-            if who.first == user_id:
-                file_count += usage
-        for who, usage in rsp.totalBytesUsed.items():
-            if who.first == user_id:
-                file_size += usage
+    db = open_usage_db(db_path)
+    try:
+        previous = get_previous_snapshot(db, list(user_info), snapshot_date)
+
+        snapshot = {}
+        requests = {}
+        for user_id, user_name in user_info.items():
+            prev = previous.get(user_id)
+            # reuse only if the user has no new event, and the stored usage is not older than the TTL
+            if incremental and prev is not None and prev["last_event"] == last_events.get(user_id) \
+                    and now - prev["computed"] < USAGE_CACHE_TTL:
+                print(f'Reusing disk usage of "{user_name}" (#{user_id}) from {prev["date"]}.')
+                # keep the event and time of the computation, so that the TTL still counts from it
+                snapshot[user_id] = dict(prev)
+            else:
+                requests[user_id] = DiskUsage2(targetObjects={"Experimenter": [user_id]})
+
+        for user_id, rsp in submit_all(conn, requests, in_flight):
+            if not isinstance(rsp, DiskUsage2Response):
+                print(f"unexpected response for {user_id}: {rsp}")
+                continue
+            print(f'Found disk usage of "{user_info[user_id]}" (#{user_id}).')
+            # usage per group: {group_id: [file count, file size]}
+            groups = {}
+            for who, count in rsp.totalFileCount.items():
+                if who.first == user_id:
+                    groups.setdefault(who.second, [0, 0])[0] += count
+            for who, size in rsp.totalBytesUsed.items():
+                if who.first == user_id:
+                    groups.setdefault(who.second, [0, 0])[1] += size
+
+            snapshot[user_id] = {"last_event": last_events.get(user_id), "computed": now, "groups": groups}
+
+        save_snapshot(db, snapshot_date, user_info, snapshot)
+    finally:
+        db.close()
 
+    user_stats = []
+    for user_id, user_name in user_info.items():
+        if user_id not in snapshot:
+            continue
+        groups = snapshot[user_id]["groups"].values()
+        file_count = sum(count for count, _ in groups)
+        file_size = sum(size for _, size in groups)
+        prev = previous.get(user_id)
+        prev_size = sum(size for _, size in prev["groups"].values()) if prev is not None else 0
         if file_count > 0 or file_size > 0:
             user_stats.append(
-                UserStats(user_id, user_name, file_count, file_size)
+                UserStats(user_id, user_name, file_count, file_size, file_size - prev_size)
             )
     return user_stats
 
 
-def submit(
-    conn: BlitzGateway, request, expected
-) -> HandlePrx:
-    # Submit a request and wait for it to complete.
-    # Returns with the response only if it was of the given type.
-    # copied this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
-
-    cb = conn.c.submit(request, loops=500)
-    try:
-        rsp = cb.getResponse()
-    finally:
-        cb.close(True)
-
-    if not isinstance(rsp, expected):
-        conn._closeSession()
-        sys.exit(f"unexpected response: {rsp}")
-    return rsp
+def get_last_events(conn, user_ids):
+    # Get the ID of the last event of each user, to know whose data may have changed
+    params = omero.sys.ParametersI()
+    params.addIds(user_ids)
+    rows = conn.getQueryService().projection(
+        "select e.experimenter.id, max(e.id) from Event e where e.experimenter.id in (:ids) "
+        "group by e.experimenter.id", params, conn.SERVICE_OPTS)
+    return {row[0].val: row[1].val for row in rows}
+
+
+def get_usage_db_path(host):
+    # Path of the history database of the given server, so that snapshots of different servers are never compared
+    return USAGE_DB_FILE.format(host=re.sub(r"[^\w.-]", "_", host))
+
+
+def open_usage_db(db_path):
+    # Open the history database, creating the tables if needed.
+    # One snapshot per day; a new run on the same day replaces it.
+    db = sqlite3.connect(db_path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS user_snapshot (
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            last_event INTEGER,
+            computed REAL NOT NULL,
+            PRIMARY KEY (date, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS usage_snapshot (
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,
+            file_count INTEGER NOT NULL,
+            file_size INTEGER NOT NULL,
+            PRIMARY KEY (date, user_id, group_id)
+        );
+        CREATE INDEX IF NOT EXISTS usage_snapshot_user_group ON usage_snapshot (user_id, group_id, date);
+    """)
+    return db
+
+
+def get_previous_snapshot(db, user_ids, before_date):
+    # Get the latest snapshot of each user taken before the given date
+    user_ids = set(user_ids)
+    previous = {}
+    for user_id, snapshot_date, last_event, computed in db.execute(
+            "SELECT user_id, MAX(date), last_event, computed FROM user_snapshot "
+            "WHERE date < ? GROUP BY user_id", (before_date,)):
+        if user_id in user_ids:
+            previous[user_id] = {"date": snapshot_date, "last_event": last_event, "computed": computed, "groups": {}}
+
+    for user_id, group_id, file_count, file_size in db.execute(
+            "SELECT u.user_id, u.group_id, u.file_count, u.file_size FROM usage_snapshot u "
+            "JOIN (SELECT user_id, MAX(date) AS date FROM user_snapshot WHERE date < ? GROUP BY user_id) p "
+            "ON u.user_id = p.user_id AND u.date = p.date", (before_date,)):
+        if user_id in previous:
+            previous[user_id]["groups"][group_id] = [file_count, file_size]
+    return previous
+
+
+def save_snapshot(db, snapshot_date, user_info, snapshot):
+    with db:
+        for user_id, entry in snapshot.items():
+            db.execute("DELETE FROM usage_snapshot WHERE date = ? AND user_id = ?", (snapshot_date, user_id))
+            db.execute("INSERT OR REPLACE INTO user_snapshot VALUES (?, ?, ?, ?, ?)",
+                       (snapshot_date, user_id, user_info[user_id], entry["last_event"], entry["computed"]))
+            db.executemany("INSERT INTO usage_snapshot VALUES (?, ?, ?, ?, ?)",
+                           [(snapshot_date, user_id, group_id, count, size)
+                            for group_id, (count, size) in entry["groups"].items()])
+
+
+def get_usage_deltas(db, snapshot_date):
+    # Usage of each user in each group at the given date, with the difference to the user's previous snapshot
+    return db.execute("""
+        SELECT u.user_id, u.group_id, u.file_count, u.file_size,
+               u.file_count - COALESCE(p.file_count, 0), u.file_size - COALESCE(p.file_size, 0)
+        FROM usage_snapshot u
+        LEFT JOIN (SELECT user_id, MAX(date) AS date FROM user_snapshot WHERE date < ? GROUP BY user_id) d
+            ON u.user_id = d.user_id
+        LEFT JOIN usage_snapshot p
+            ON p.user_id = u.user_id AND p.group_id = u.group_id AND p.date = d.date
+        WHERE u.date = ?
+        ORDER BY u.user_id, u.group_id
+    """, (snapshot_date, snapshot_date)).fetchall()
 
 
 if __name__ == "__main__":
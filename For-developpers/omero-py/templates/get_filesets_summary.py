@@ -1,33 +1,13 @@
 from omero.gateway import BlitzGateway
-from omero.cli import cli_login
-from omero.plugins.fs import FsControl
-from omero.plugins.delete import DeleteControl
+from filesets import scan_filesets, save_report
 import traceback
-from io import StringIO
-import sys
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
-    QWidget, QApplication, QHBoxLayout, QSpinBox, QCheckBox
-from pathlib import Path
-import os
-from datetime import datetime
-
-
-# Class to capture the output of the CLI command
-class Capturing(list):
-    def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
-        return self
-
-    def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio    # free up some memory
-        sys.stdout = self._stdout
+    QWidget, QApplication, QHBoxLayout, QSpinBox
 
 
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server.epfl.ch'
-DEFAULT_LIMIT = 200
+DEFAULT_PAGE_SIZE = 500
 
 
 class MainWindow(QMainWindow):
@@ -78,15 +58,15 @@ class MainWindow(QMainWindow):
         password_widget.setLayout(password_layout)
         widgets.append(password_widget)
         
-        # Query limit fields
+        # Page size fields
         query_limit_layout = QHBoxLayout()
-        query_limit_label = QLabel("Limit size of the query")
+        query_limit_label = QLabel("Filesets per query")
         query_limit_label.setStyleSheet(FONT_SIZE)
         self.query_limits = QSpinBox()
         self.query_limits.setStyleSheet(FONT_SIZE)
-        self.query_limits.setMinimum(0)
-        self.query_limits.setMaximum(10000000)
-        self.query_limits.setValue(DEFAULT_LIMIT)
+        self.query_limits.setMinimum(1)
+        self.query_limits.setMaximum(100000)
+        self.query_limits.setValue(DEFAULT_PAGE_SIZE)
         self.query_limits.setSingleStep(1)
         query_limit_widget = QWidget()
         query_limit_layout.addWidget(query_limit_label)
@@ -126,115 +106,49 @@ class MainWindow(QMainWindow):
         username = self.username.text()
         password = self.password.text()
         host = self.host.text()
-        query_limit = self.query_limits.value()
+        page_size = self.query_limits.value()
         self.close()
-        run_script(host, username, password, query_limit)
+        run_script(host, username, password, page_size)
 
 
-def run_script(host, username, password, query_limit):
+def run_script(host, username, password, page_size):
     """
-    Connect to OMERO, list the filesets not linked to any Image object and delete them if specified
+    Connect to OMERO, scan all the filesets of the server and save two reports:
+    the filesets not linked to any Image object and all the filesets
 
     Parameters
     ----------
     host            String: name of the OMERO server
     username        String: username of the OMERO user
     password        String: password of the OMERO user
-    query_limit     Integer: size of the filesets to retrieve from OMERO.
+    page_size       Integer: number of filesets retrieved from OMERO in one query.
                             Should not be too large to not overload the server
 
     Returns
     -------
 
     """
-    with cli_login("-u", username, "-w", password, "-s", host, "-p", "4064") as cli:
-        # connect to OMERO server
-        conn = BlitzGateway(client_obj=cli.get_client())
-
-        if conn.isConnected():
-            print(f"Connected to {host}")
-            try:
-                print("Getting filesets not linked to any images...")
-                cli.register('fs', FsControl, '_')
-
-                import_args = ["fs",
-                               "sets",
-                               "--without-images",
-                               "--limit",
-                               str(query_limit),
-                               "--style=csv"]
-
-                try:
-                    with Capturing() as output:
-                        cli.invoke(import_args, strict=True)
-
-                    print("SUCCESS", f"Got all filesets not linked to any OMERO image object")
-                except PermissionError as err:
-                    print(f"Error during fs reading {err}")
-
-                print("Saving report in the Downloads...")
-                save_report(output, "Ghost filesets")
-                print("SUCCESS", "Report saved !")
-
-                # Prepare Delete command
-                print("Getting all filesets...")
-                import_args = ["fs",
-                               "sets",
-                               "--limit",
-                               str(query_limit),
-                               "--style=csv"
-                               ]
-
-                try:
-                    # Run delete
-                    with Capturing() as output2:
-                        cli.invoke(import_args, strict=True)
-                    print("SUCCESS", f"Got all filesets")
-                except PermissionError as err:
-                    print(f"Error during fs reading {err}")
-
-                print("Saving report in the Downloads...")
-                save_report(output2, "All filesets")
-                print("SUCCESS", "Report saved !")
-
-                # closing CLI session
-                cli.get_client().closeSession()
-
-                # delete variables to free some memory
-                del output
-                del output2
-            except Exception as e:
-                print(e)
-                traceback.print_exc()
-            finally:
-                conn.close()
-                print(f"Disconnected from {host}")
-
-
-
-def save_report(report, name):
-    """
-    Save the output logs of the CLI in the Downloads folder,
-    with the date-time of the current run.
-
-    Parameters
-    ----------
-    name: String: name of the csv file
-    report: List of CLI logs
-
-    Returns
-    -------
-
-    """
-    # Get the current date and time
-    now = datetime.now()
-    format_code = "%Y-%m-%d_%Hh%Mm%Ss"
-    formatted_datetime = now.strftime(format_code)
-    file_name = f"{formatted_datetime}-{name}.csv"
-    
-    # save the logs
-    with open(os.path.join(Path.home(), "Downloads", file_name), "w") as f:
-        f.write("\n".join(report))
+    conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
+    conn.connect()
+
+    if conn.isConnected():
+        print(f"Connected to {host}")
+        try:
+            conn.SERVICE_OPTS.setOmeroGroup(-1)
+
+            print("Getting filesets not linked to any images...")
+            path = save_report(scan_filesets(conn, page_size, without_images=True), "Ghost filesets")
+            print("SUCCESS", f"Report of the filesets not linked to any OMERO image object saved in {path}")
+
+            print("Getting all filesets...")
+            path = save_report(scan_filesets(conn, page_size), "All filesets")
+            print("SUCCESS", f"Report of all filesets saved in {path}")
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+        finally:
+            conn.close()
+            print(f"Disconnected from {host}")
 
 
 if __name__ == "__main__":
@@ -1,10 +1,13 @@
-from typing import Dict
+from typing import Dict, Optional
 import traceback
+from datetime import datetime
 from omero.gateway import BlitzGateway
+from user_activity import UserActivity, get_user_activity, save_activity
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
-    QWidget, QApplication, QHBoxLayout
+    QWidget, QApplication, QHBoxLayout, QSpinBox
 
 """
+List the users who are not members of the 'user' system group anymore, i.e. disabled users
 """
 
 FONT_SIZE = 'font-size: 14px'
@@ -58,6 +61,21 @@ class MainWindow(QMainWindow):
         password_widget.setLayout(password_layout)
         widgets.append(password_widget)
 
+        # activity window fields
+        window_days_layout = QHBoxLayout()
+        window_days_label = QLabel("Only sessions of the last days (0 = all sessions)")
+        window_days_label.setStyleSheet(FONT_SIZE)
+        self.window_days = QSpinBox()
+        self.window_days.setStyleSheet(FONT_SIZE)
+        self.window_days.setMinimum(0)
+        self.window_days.setMaximum(36500)
+        self.window_days.setSingleStep(1)
+        window_days_widget = QWidget()
+        window_days_layout.addWidget(window_days_label)
+        window_days_layout.addWidget(self.window_days)
+        window_days_widget.setLayout(window_days_layout)
+        widgets.append(window_days_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -90,18 +108,19 @@ class MainWindow(QMainWindow):
         username = self.username.text()
         password = self.password.text()
         host = self.host.text()
+        window_days = self.window_days.value() or None
         self.close()
-        run_script(host, username, password)
+        run_script(host, username, password, window_days)
 
 
-def run_script(host, username, password):
+def run_script(host, username, password, window_days=None):
     conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
     conn.connect()
 
     if conn.isConnected():
         print(f"Connected to {host}")
         try:
-            users_dict = find_users(conn)
+            users_dict = find_users(conn, window_days)
             file_content = create_file(users_dict)
             print("______________________________________________")
             print(f"Found {len(users_dict)} users")
@@ -117,22 +136,32 @@ def run_script(host, username, password):
 
 
 def create_file(users):
-    content = "user_id,username\n"
-    for user_id in users.keys():
-        content += f"{user_id},{users[user_id]}\n"
+    content = "user_id,username,last login,last logout\n"
+    for user_id, activity in users.items():
+        if activity.no_activity_in_window():
+            last_login = last_logout = f"none in the last {activity.window_days} days"
+        elif activity.never_logged_in():
+            last_login = last_logout = "never"
+        else:
+            last_login = format_time(activity.last_login)
+            last_logout = format_time(activity.last_logout)
+        content += f"{user_id},{activity.name},{last_login},{last_logout}\n"
 
     return content
 
 
-def find_users(conn: BlitzGateway) -> (Dict[int, str]):
-    all_users = {result[0].val: result[1].val for result in conn.getQueryService().projection("SELECT id, omeName FROM Experimenter", None)}
-    _, active_users = conn.getObject("ExperimenterGroup", 1).groupSummary()
-    active_users = {o.getId(): o.getOmeName() for o in active_users}
-    inactive_users = {}
+def format_time(seconds):
+    return "" if seconds is None else datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
 
-    for user_id in all_users.keys():
-        if user_id not in active_users:
-            inactive_users[user_id] = all_users[user_id]
+def find_users(conn: BlitzGateway, window_days: Optional[int] = None) -> (Dict[int, UserActivity]):
+    activities = get_user_activity(conn, window_days)
+    save_activity(activities)
+
+    inactive_users = {}
+    for user_id, activity in activities.items():
+        if not activity.enabled:
+            inactive_users[user_id] = activity
 
     return inactive_users
 
@@ -1,7 +1,8 @@
-from typing import Dict
+from typing import Dict, Optional, Union
 from time import time
 import traceback
 from omero.gateway import BlitzGateway
+from user_activity import get_user_activity, save_activity
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
     QWidget, QApplication, QHBoxLayout, QSpinBox
 
@@ -76,6 +77,21 @@ class MainWindow(QMainWindow):
         inactive_day_widget.setLayout(inactive_day_layout)
         widgets.append(inactive_day_widget)
 
+        # activity window fields
+        window_days_layout = QHBoxLayout()
+        window_days_label = QLabel("Only sessions of the last days (0 = all sessions)")
+        window_days_label.setStyleSheet(FONT_SIZE)
+        self.window_days = QSpinBox()
+        self.window_days.setStyleSheet(FONT_SIZE)
+        self.window_days.setMinimum(0)
+        self.window_days.setMaximum(36500)
+        self.window_days.setSingleStep(1)
+        window_days_widget = QWidget()
+        window_days_layout.addWidget(window_days_label)
+        window_days_layout.addWidget(self.window_days)
+        window_days_widget.setLayout(window_days_layout)
+        widgets.append(window_days_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -109,18 +125,20 @@ class MainWindow(QMainWindow):
         password = self.password.text()
         host = self.host.text()
         inactive_days = self.inactive_days.value()
+        window_days = self.window_days.value() or None
         self.close()
-        run_script(host, username, password, inactive_days)
+        run_script(host, username, password, inactive_days, window_days)
 
 
-def run_script(host, username, password, min_days):
+def run_script(host, username, password, min_days, window_days=None):
     conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
     conn.connect()
 
     if conn.isConnected():
         print(f"Connected to {host}")
         try:
-            users_dict, logout_dict = find_users(conn, min_days)
+            users_dict, logout_dict = find_users(conn, min_days, window_days)
+            print("Activity of all users saved in the history database")
             file_content = create_file(users_dict, logout_dict)
             print("______________________________________________")
             print(f"Found {len(users_dict)} users")
@@ -137,64 +155,56 @@ def run_script(host, username, password, min_days):
 
 def create_file(users, logouts):
     content = "user_id,username,last logout from (days)\n"
-    sorted_logouts = {k: v for k, v in sorted(logouts.items(), key=lambda item: item[1])}
+    # users who never logged in, or without activity in the window, come last
+    sorted_logouts = {k: v for k, v in sorted(logouts.items(),
+                                              key=lambda item: (isinstance(item[1], str), item[1]))}
     for user_id in sorted_logouts.keys():
         content += f"{user_id},{users[user_id]},{sorted_logouts[user_id]}\n"
 
     return content
 
 
-def find_users(conn: BlitzGateway, minimum_days: int = 0) -> (Dict[int, str], Dict[int, int]):
+def find_users(
+    conn: BlitzGateway, minimum_days: int = 0, window_days: Optional[int] = None
+) -> (Dict[int, str], Dict[int, Union[float, str]]):
     # Determine which users' data to consider deleting.
-    # copied this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
-
-    users = {}
+    # Users without activity are reported as "never", or "none in the last N days" when only
+    # the sessions of the last 'window_days' days are read and the history does not know them.
+    # adapted this code from https://github.com/ome/omero-demo-cleanup/blob/main/src/omero_demo_cleanup/library.py
 
-    for result in conn.getQueryService().projection(
-            "SELECT id, omeName FROM Experimenter", None
-    ):
-        user_id = result[0].val
-        user_name = result[1].val
-        # check for users you DO NOT want to touch
-        if user_name not in ("public", "guest", "root", "prometheus"):
-            users[user_id] = user_name
-
-    for result in conn.getQueryService().projection(
-            "SELECT DISTINCT owner.id FROM Session WHERE closed IS NULL", None
-    ):
-        user_id = result[0].val
-        if user_id in users.keys():
-            print(f'Ignoring "{users[user_id]}" (#{user_id}) who is logged in.')
-            del users[user_id]
-
-    now = time()
+    activities = get_user_activity(conn, window_days)
+    save_activity(activities)
 
+    users = {}
     logouts = {}
+    now = time()
 
-    for result in conn.getQueryService().projection(
-            "SELECT owner.id, MAX(closed) FROM Session GROUP BY owner.id", None
-    ):
-        user_id = result[0].val
-        if user_id not in users:
+    for user_id, activity in activities.items():
+        # check for users you DO NOT want to touch
+        if activity.name in ("public", "guest", "root", "prometheus"):
             continue
 
-        if result[1] is None:
-            # never logged in
-            user_logout = 0
-        else:
-            # note time in seconds since epoch
-            user_logout = result[1].val / 1000
+        if activity.is_logged_in():
+            print(f'Ignoring "{activity.name}" (#{user_id}) who is logged in.')
+            continue
 
-        days = (now - user_logout) / (60 * 60 * 24)
-        if days < minimum_days:
+        # None if the user never logged in, or has no known activity
+        days = activity.days_since_logout(now)
+        if days is not None and days < minimum_days:
             print(
                 'Ignoring "{}" (#{}) who logged in recently.'.format(
-                    users[user_id], user_id
+                    activity.name, user_id
                 )
             )
-            del users[user_id]
+            continue
 
-        logouts[user_id] = days
+        users[user_id] = activity.name
+        if activity.no_activity_in_window():
+            logouts[user_id] = f"none in the last {window_days} days"
+        elif days is None:
+            logouts[user_id] = "never"
+        else:
+            logouts[user_id] = days
 
     return users, logouts
 
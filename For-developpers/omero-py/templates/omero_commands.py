@@ -0,0 +1,45 @@
+from omero.callbacks import CmdCallbackI
+
+"""
+Shared code to run omero.cmd requests on the server, used by get_disk_usage.py and delete_ghost_files.py.
+"""
+
+# time to wait for a request to finish before checking the next one, in ms
+POLL_INTERVAL_MS = 500
+
+
+def submit_all(conn, requests, in_flight):
+    """
+    Submit several requests, with at most 'in_flight' of them running at the same time on the server
+
+    Parameters
+    ----------
+    conn: BlitzGateway connection
+    requests: dict key -> omero.cmd request
+    in_flight: number of requests running at the same time
+
+    Returns
+    -------
+    responses: generator of (key, response) as soon as each request completes
+
+    """
+    pending = list(requests.items())
+    callbacks = {}
+    try:
+        while pending or callbacks:
+            while pending and len(callbacks) < in_flight:
+                key, request = pending.pop(0)
+                handle = conn.c.sf.submit(request, conn.SERVICE_OPTS)
+                callbacks[key] = CmdCallbackI(conn.c, handle)
+
+            for key, cb in list(callbacks.items()):
+                if not cb.block(POLL_INTERVAL_MS // len(callbacks)):
+                    continue
+                del callbacks[key]
+                try:
+                    yield key, cb.getResponse()
+                finally:
+                    cb.close(True)
+    finally:
+        for cb in callbacks.values():
+            cb.close(True)
@@ -6,16 +6,28 @@ URL : https://forum.image.sc/t/how-to-handle-orphaned-annotations-in-omero/96883
 """
 import omero
 from omero.gateway import BlitzGateway
+from omero.cmd import Delete2, Delete2Response
+from omero.callbacks import CmdCallbackI
 import traceback
 
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
-    QWidget, QApplication, QHBoxLayout
+    QWidget, QApplication, QHBoxLayout, QSpinBox, QCheckBox
 
 
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server.epfl.ch'
 DEFAULT_LIMIT = 200
 
+# all the objects that can be annotated; an annotation not linked to any of them is orphaned
+ANNOTATION_LINK_TYPES = [
+    "Project", "Dataset", "Image", "Screen", "Plate", "PlateAcquisition", "Well", "Reagent", "Folder",
+    "Roi", "Shape", "Channel", "PlaneInfo", "Fileset", "OriginalFile", "Annotation",
+    "Instrument", "Detector", "Dichroic", "Filter", "LightPath", "LightSource", "Objective",
+    "Experimenter", "ExperimenterGroup", "Session", "Node", "Namespace",
+]
+# time to wait for the delete request before checking it again, in ms
+POLL_INTERVAL_MS = 1000
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -64,6 +76,32 @@ class MainWindow(QMainWindow):
         password_widget.setLayout(password_layout)
         widgets.append(password_widget)
 
+        # batch size fields
+        batch_size_layout = QHBoxLayout()
+        batch_size_label = QLabel("Annotations per delete request")
+        batch_size_label.setStyleSheet(FONT_SIZE)
+        self.batch_size = QSpinBox()
+        self.batch_size.setStyleSheet(FONT_SIZE)
+        self.batch_size.setMinimum(1)
+        self.batch_size.setMaximum(10000)
+        self.batch_size.setValue(DEFAULT_LIMIT)
+        batch_size_widget = QWidget()
+        batch_size_layout.addWidget(batch_size_label)
+        batch_size_layout.addWidget(self.batch_size)
+        batch_size_widget.setLayout(batch_size_layout)
+        widgets.append(batch_size_widget)
+
+        # Dry run fields
+        dry_run_layout = QHBoxLayout()
+        self.dry_run = QCheckBox()
+        self.dry_run.setStyleSheet(FONT_SIZE)
+        self.dry_run.setText("Dry run")
+        self.dry_run.setChecked(True)
+        dry_run_widget = QWidget()
+        dry_run_layout.addWidget(self.dry_run)
+        dry_run_widget.setLayout(dry_run_layout)
+        widgets.append(dry_run_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -96,12 +134,14 @@ class MainWindow(QMainWindow):
         username = self.username.text()
         password = self.password.text()
         host = self.host.text()
+        batch_size = self.batch_size.value()
+        dry_run = self.dry_run.isChecked()
         self.close()
-        run_script(host, username, password)
+        run_script(host, username, password, batch_size, dry_run)
 
 
 
-def run_script(host, username, password):
+def run_script(host, username, password, batch_size=DEFAULT_LIMIT, dry_run=True):
     conn = BlitzGateway(username, password, host=host, port=4064, secure=True)
     conn.connect()
 
@@ -110,19 +150,22 @@ def run_script(host, username, password):
         try:
             # search in all the user's group
             conn.SERVICE_OPTS.setOmeroGroup('-1')
-            params = omero.sys.ParametersI()
-            query = "select link.child.id from ome.model.IAnnotationLink link"
-
-            svc = conn.getQueryService()
-            results = svc.projection(query, params, conn.SERVICE_OPTS)
-            linked_ids = [result[0].val for result in results]
 
-            query = f"select a from Annotation a where a.ns is Null and a.id not in ({','.join(linked_ids)})"
-            annotations = svc.findAllByQuery(query, params, conn.SERVICE_OPTS)
-            ids_to_delete = [ann.id.val for ann in annotations]
-
-            if ids_to_delete:
-                conn.deleteObjects('Annotation', ids_to_delete)
+            n_orphans = 0
+            n_deleted = 0
+            for ids_to_delete in find_orphaned_annotations(conn, batch_size):
+                n_orphans += len(ids_to_delete)
+                if dry_run:
+                    continue
+                rsp = submit(conn, Delete2(targetObjects={"Annotation": ids_to_delete}), Delete2Response)
+                if rsp is not None:
+                    n_deleted += len(ids_to_delete)
+                print(f"Deleted {n_deleted} of {n_orphans} orphaned annotations found so far")
+
+            if dry_run:
+                print(f"Dry run: {n_orphans} orphaned annotations would be deleted")
+            else:
+                print(f"Deleted {n_deleted} orphaned annotations")
 
         except Exception as e:
             print(e)
@@ -132,6 +175,55 @@ def run_script(host, username, password):
             print(f"Disconnected from {host}")
 
 
+def find_orphaned_annotations(conn, page_size):
+    # Find the annotations without namespace that are not linked to any object, page by page.
+    # The check is done by the server with one 'not exists' clause per link type, and each page
+    # starts after the last ID of the previous one, so that memory stays constant.
+    query = "select a.id from Annotation a where a.ns is null and a.id > :last"
+    for link_type in get_annotation_link_types():
+        query += f" and not exists (select l from {link_type}AnnotationLink l where l.child.id = a.id)"
+    query += " order by a.id"
+
+    svc = conn.getQueryService()
+    last_id = -1
+    while True:
+        params = omero.sys.ParametersI()
+        params.addLong("last", last_id)
+        params.page(0, page_size)
+        ids = [result[0].val for result in svc.projection(query, params, conn.SERVICE_OPTS)]
+        if ids:
+            yield ids
+        if len(ids) < page_size:
+            break
+        last_id = ids[-1]
+
+
+def get_annotation_link_types():
+    # Types of the objects that can be annotated: the known ones, and any other one with
+    # an AnnotationLink class in the model, so that the list cannot fall behind the model
+    link_suffix = "AnnotationLinkI"
+    model_types = {name[:-len(link_suffix)] for name in dir(omero.model) if name.endswith(link_suffix)}
+    return sorted(set(ANNOTATION_LINK_TYPES) | model_types)
+
+
+def submit(conn, request, expected):
+    # Submit a request and wait for it to complete, however long it takes.
+    # Returns with the response only if it was of the given type.
+    handle = conn.c.sf.submit(request, conn.SERVICE_OPTS)
+    cb = CmdCallbackI(conn.c, handle)
+    try:
+        while not cb.block(POLL_INTERVAL_MS):
+            pass
+        rsp = cb.getResponse()
+    finally:
+        cb.close(True)
+
+    if not isinstance(rsp, expected):
+        print(f"unexpected response: {rsp}")
+        return None
+    return rsp
+
+
 if __name__ == "__main__":
     list_argv = []
     app = QApplication(list_argv)
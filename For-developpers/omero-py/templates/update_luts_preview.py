@@ -115,29 +115,78 @@ def run_script(host, username, password):
     Returns
     -------
 
+    """
+    session = login(host, username, password)
+
+    # --- (3) Call the LUTs endpoint ---
+    luts_url = f"{host}/webgateway/luts_png/?cached=false"
+
+    response = session.get(luts_url)
+
+    # --- (4) Logout ---
+    logout(session, host)
+
+
+def login(host, username, password, session=None):
+    """
+    Open a session on omero-web
+
+    Parameters
+    ----------
+    host : String
+        url of omero-web
+    username : String
+        username of the OMERO user
+    password : String
+        password of the OMERO user
+    session : requests.Session
+        session to log in; a new one is created if None
+
+    Returns
+    -------
+    session : requests.Session
+        the logged-in session
+
+    Raises
+    ------
+    RuntimeError
+        if omero-web refuses the login
     """
     api = f"{host}/api/v0"
-    session = requests.Session()
+    session = requests.Session() if session is None else session
 
     # --- (1) Get CSRF token ---
     session.get(f"{api}/login/")
     csrf = session.cookies.get("csrftoken")
 
     # --- (2) Login ---
-    session.post(
+    response = session.post(
         f"{api}/login/",
         json={"username": username, "password": password},
         headers={"X-CSRFToken": csrf, "Referer": f"{api}/login/"}
     )
+    if not response.ok or not response.json().get("success", False):
+        raise RuntimeError(f"Cannot log in to {host} as {username}: {response.status_code} {response.text}")
+    return session
 
-    # --- (3) Call the LUTs endpoint ---
-    luts_url = f"{host}/webgateway/luts_png/?cached=false"
 
-    response = session.get(luts_url)
+def logout(session, host):
+    """
+    Close the omero-web session
 
-    # --- (4) Logout ---
+    Parameters
+    ----------
+    session : requests.Session
+        the logged-in session
+    host : String
+        url of omero-web
+
+    Returns
+    -------
+
+    """
     session.post(
-        f"{api}/logout/"
+        f"{host}/api/v0/logout/"
     )
 
 
@@ -9,11 +9,16 @@ Code copied and adapted from
 Thanks to Will Moore for his job.
 """
 
+import hashlib
 import locale
 import os
 import platform
 import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
 import omero.clients
 from omero.model import ChecksumAlgorithmI
@@ -24,11 +29,21 @@ from omero_version import omero_version
 from omero.callbacks import CmdCallbackI
 from omero.gateway import BlitzGateway
 from PyQt6.QtWidgets import QLineEdit, QLabel, QPushButton, QMainWindow, QVBoxLayout, \
-    QWidget, QApplication, QHBoxLayout
+    QWidget, QApplication, QHBoxLayout, QSpinBox
 
 FONT_SIZE = 'font-size: 14px'
 DEFAULT_HOST = 'omero-server.epfl.ch'
 DEFAULT_LIMIT = 200
+# size of the blocks sent to the server, in bytes
+DEFAULT_BLOCK_SIZE = 1000 * 1000
+# number of files of one fileset uploaded at the same time
+DEFAULT_UPLOAD_WORKERS = 4
+# minimum time between two progress reports, in seconds
+PROGRESS_INTERVAL = 5
+# number of filesets uploaded at the same time
+DEFAULT_MAX_UPLOADS = 1
+# number of filesets being uploaded or imported by the server at the same time
+DEFAULT_MAX_IMPORTS = 3
 
 
 class MainWindow(QMainWindow):
@@ -79,6 +94,66 @@ class MainWindow(QMainWindow):
         password_widget.setLayout(password_layout)
         widgets.append(password_widget)
 
+        # block size fields
+        block_size_layout = QHBoxLayout()
+        block_size_label = QLabel("Upload block size (kB)")
+        block_size_label.setStyleSheet(FONT_SIZE)
+        self.block_size = QSpinBox()
+        self.block_size.setStyleSheet(FONT_SIZE)
+        self.block_size.setMinimum(64)
+        self.block_size.setMaximum(64000)
+        self.block_size.setValue(DEFAULT_BLOCK_SIZE // 1000)
+        block_size_widget = QWidget()
+        block_size_layout.addWidget(block_size_label)
+        block_size_layout.addWidget(self.block_size)
+        block_size_widget.setLayout(block_size_layout)
+        widgets.append(block_size_widget)
+
+        # upload workers fields
+        upload_workers_layout = QHBoxLayout()
+        upload_workers_label = QLabel("Files uploaded in parallel")
+        upload_workers_label.setStyleSheet(FONT_SIZE)
+        self.upload_workers = QSpinBox()
+        self.upload_workers.setStyleSheet(FONT_SIZE)
+        self.upload_workers.setMinimum(1)
+        self.upload_workers.setMaximum(32)
+        self.upload_workers.setValue(DEFAULT_UPLOAD_WORKERS)
+        upload_workers_widget = QWidget()
+        upload_workers_layout.addWidget(upload_workers_label)
+        upload_workers_layout.addWidget(self.upload_workers)
+        upload_workers_widget.setLayout(upload_workers_layout)
+        widgets.append(upload_workers_widget)
+
+        # max uploads fields
+        max_uploads_layout = QHBoxLayout()
+        max_uploads_label = QLabel("Filesets uploaded in parallel")
+        max_uploads_label.setStyleSheet(FONT_SIZE)
+        self.max_uploads = QSpinBox()
+        self.max_uploads.setStyleSheet(FONT_SIZE)
+        self.max_uploads.setMinimum(1)
+        self.max_uploads.setMaximum(16)
+        self.max_uploads.setValue(DEFAULT_MAX_UPLOADS)
+        max_uploads_widget = QWidget()
+        max_uploads_layout.addWidget(max_uploads_label)
+        max_uploads_layout.addWidget(self.max_uploads)
+        max_uploads_widget.setLayout(max_uploads_layout)
+        widgets.append(max_uploads_widget)
+
+        # max imports fields
+        max_imports_layout = QHBoxLayout()
+        max_imports_label = QLabel("Filesets uploaded or imported in parallel")
+        max_imports_label.setStyleSheet(FONT_SIZE)
+        self.max_imports = QSpinBox()
+        self.max_imports.setStyleSheet(FONT_SIZE)
+        self.max_imports.setMinimum(1)
+        self.max_imports.setMaximum(16)
+        self.max_imports.setValue(DEFAULT_MAX_IMPORTS)
+        max_imports_widget = QWidget()
+        max_imports_layout.addWidget(max_imports_label)
+        max_imports_layout.addWidget(self.max_imports)
+        max_imports_widget.setLayout(max_imports_layout)
+        widgets.append(max_imports_widget)
+
         # buttons fields
         button_layout = QHBoxLayout()
         ok_button = QPushButton(text="OK")
@@ -111,8 +186,12 @@ class MainWindow(QMainWindow):
         username = self.username.text()
         password = self.password.text()
         host = self.host.text()
+        block_size = self.block_size.value() * 1000
+        upload_workers = self.upload_workers.value()
+        max_uploads = self.max_uploads.value()
+        max_imports = self.max_imports.value()
         self.close()
-        run_script(host, username, password)
+        run_script(host, username, password, block_size, upload_workers, max_uploads, max_imports)
 
 
 def get_files_for_fileset(fs_path):
@@ -169,34 +248,74 @@ def create_settings():
     return settings
 
 
-def upload_files(proc, files, client):
-    """Upload files to OMERO from local filesystem."""
-    ret_val = []
-    for i, fobj in enumerate(files):
+def print_progress(n_bytes, total_bytes, elapsed):
+    """Default progress callback: print the uploaded size and the throughput."""
+    throughput = n_bytes / elapsed / 1000000 if elapsed > 0 else 0
+    print('Uploaded %.1f / %.1f MB (%.1f MB/s)' % (n_bytes / 1000000, total_bytes / 1000000, throughput))
+
+
+def upload_files(proc, files, client, block_size=DEFAULT_BLOCK_SIZE, n_workers=DEFAULT_UPLOAD_WORKERS,
+                 progress=print_progress):
+    """
+    Upload files to OMERO from local filesystem.
+    The files are uploaded in parallel, each one with its own uploader, and their SHA1 is
+    computed while they are read, so that each file is read only once.
+    progress(n_bytes, total_bytes, elapsed) is called at most every PROGRESS_INTERVAL seconds.
+    """
+    total_bytes = sum(os.path.getsize(fobj) for fobj in files)
+    start = time.time()
+    state = {"bytes": 0, "reported": start}
+    lock = threading.Lock()
+
+    def report(n_bytes, force=False):
+        with lock:
+            state["bytes"] += n_bytes
+            now = time.time()
+            if progress is None or not (force or now - state["reported"] >= PROGRESS_INTERVAL):
+                return
+            state["reported"] = now
+            uploaded = state["bytes"]
+        progress(uploaded, total_bytes, now - start)
+
+    def upload(i):
+        fobj = files[i]
         rfs = proc.getUploader(i)
         try:
             with open(fobj, 'rb') as f:
                 print('Uploading: %s' % fobj)
+                sha1 = hashlib.sha1()
                 offset = 0
                 block = []
                 rfs.write(block, offset, len(block))  # Touch
                 while True:
-                    block = f.read(1000 * 1000)
+                    block = f.read(block_size)
                     if not block:
                         break
+                    sha1.update(block)
                     rfs.write(block, offset, len(block))
                     offset += len(block)
-                ret_val.append(client.sha1(fobj))
+                    report(len(block))
+                return sha1.hexdigest()
         finally:
             rfs.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(files)))) as executor:
+        ret_val = list(executor.map(upload, range(len(files))))
+    report(0, force=True)
     return ret_val
 
 
-def assert_import(client, proc, files, wait):
-    """Wait and check that we imported an image."""
-    hashes = upload_files(proc, files, client)
-    print('Hashes:\n  %s' % '\n  '.join(hashes))
-    handle = proc.verifyUpload(hashes)
+def assert_import(client, proc, files, wait, block_size=DEFAULT_BLOCK_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS,
+                  upload_slots=None):
+    """
+    Wait and check that we imported an image.
+    If given, the upload_slots semaphore is only held during the upload, so that other
+    filesets can be uploaded while the server imports this one.
+    """
+    with upload_slots or nullcontext():
+        hashes = upload_files(proc, files, client, block_size, upload_workers)
+        print('Hashes:\n  %s' % '\n  '.join(hashes))
+        handle = proc.verifyUpload(hashes)
     cb = CmdCallbackI(client, handle)
 
     # https://github.com/openmicroscopy/openmicroscopy/blob/v5.4.9/components/blitz/src/ome/formats/importer/ImportLibrary.java#L631
@@ -217,7 +336,8 @@ def assert_import(client, proc, files, wait):
     return rsp
 
 
-def full_import(client, fs_path, wait=-1):
+def full_import(client, fs_path, wait=-1, block_size=DEFAULT_BLOCK_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS,
+                upload_slots=None):
     """Re-usable method for a basic import."""
     mrepo = client.getManagedRepository()
     files = get_files_for_fileset(fs_path)
@@ -228,12 +348,13 @@ def full_import(client, fs_path, wait=-1):
 
     proc = mrepo.importFileset(fileset, settings)
     try:
-        return assert_import(client, proc, files, wait)
+        return assert_import(client, proc, files, wait, block_size, upload_workers, upload_slots)
     finally:
         proc.close()
 
 
-def run_script(host, username, password):
+def run_script(host, username, password, block_size=DEFAULT_BLOCK_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS,
+               max_uploads=DEFAULT_MAX_UPLOADS, max_imports=DEFAULT_MAX_IMPORTS):
     dataset = 1  # ID of the target dataset
     paths = ["path/to/image1", "path/to/image2"]  # List of files to upload
 
@@ -247,21 +368,17 @@ def run_script(host, username, password):
                 print('Dataset id not found: %s' % dataset)
                 sys.exit(1)
 
-            for fs_path in paths:
-                fs_path = fs_path.replace("\\", "/")
-                print('Importing: %s' % fs_path)
-                rsp = full_import(conn.c, fs_path)
-
-                if rsp:
-                    links = []
-                    for p in rsp.pixels:
-                        print('Imported Image ID: %d' % p.image.id.val)
-                        if dataset:
-                            link = omero.model.DatasetImageLinkI()
-                            link.parent = omero.model.DatasetI(dataset, False)
-                            link.child = omero.model.ImageI(p.image.id.val, False)
-                            links.append(link)
-                    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+            image_ids = import_filesets(conn.c, paths, block_size, upload_workers, max_uploads, max_imports)
+
+            if dataset and image_ids:
+                links = []
+                for image_id in image_ids:
+                    link = omero.model.DatasetImageLinkI()
+                    link.parent = omero.model.DatasetI(dataset, False)
+                    link.child = omero.model.ImageI(image_id, False)
+                    links.append(link)
+                conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+                print('Linked %d images to dataset %d' % (len(links), dataset))
 
         except Exception as e:
             print(e)
@@ -271,6 +388,46 @@ def run_script(host, username, password):
             print(f"Disconnected from {host}")
 
 
+def import_filesets(client, paths, block_size=DEFAULT_BLOCK_SIZE, upload_workers=DEFAULT_UPLOAD_WORKERS,
+                    max_uploads=DEFAULT_MAX_UPLOADS, max_imports=DEFAULT_MAX_IMPORTS):
+    """
+    Import several filesets as a pipeline: the next fileset is uploaded while the server
+    imports the previous ones. At most max_uploads filesets are uploaded and max_imports
+    filesets are in progress (uploading or importing) at the same time.
+    Returns the IDs of the imported images, in the order of the paths.
+    """
+    # an upload is part of an import, so there cannot be more uploads than imports in progress
+    max_uploads = min(max_uploads, max_imports)
+    upload_slots = threading.Semaphore(max_uploads)
+    image_ids = {}
+
+    def start_import(fs_path):
+        print('Importing: %s' % fs_path)
+        return full_import(client, fs_path, block_size=block_size,
+                           upload_workers=upload_workers, upload_slots=upload_slots)
+
+    with ThreadPoolExecutor(max_workers=max_imports) as executor:
+        futures = {}
+        for fs_path in paths:
+            fs_path = fs_path.replace("\\", "/")
+            future = executor.submit(start_import, fs_path)
+            futures[future] = fs_path
+
+        for future in as_completed(futures):
+            fs_path = futures[future]
+            try:
+                rsp = future.result()
+            except Exception as e:
+                print('Import failed for %s: %s' % (fs_path, e))
+                continue
+            if rsp:
+                image_ids[fs_path] = [p.image.id.val for p in rsp.pixels]
+                for image_id in image_ids[fs_path]:
+                    print('Imported Image ID: %d' % image_id)
+
+    return [image_id for fs_path in paths for image_id in image_ids.get(fs_path.replace("\\", "/"), [])]
+
+
 if __name__ == "__main__":
     list_argv = []
     app = QApplication(list_argv)
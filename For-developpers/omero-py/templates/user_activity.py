@@ -0,0 +1,146 @@
+from typing import Dict, Optional
+from time import time
+from datetime import date
+import os
+import sqlite3
+import omero
+from omero.gateway import BlitzGateway
+
+"""
+Shared code to report the activity of OMERO users, used by get_last_logout.py and get_inactive_users.py.
+Sessions are aggregated per user by the server in one query, and each report can be stored
+in a local database to follow the activity over time.
+"""
+
+# local database with the history of the users' activity
+ACTIVITY_DB_FILE = os.path.join(os.path.expanduser("~"), "omero_user_activity.sqlite")
+# id of the system group every enabled user belongs to
+USER_GROUP_ID = 1
+
+
+class UserActivity:
+    # Represents a user and their sessions.
+    # Times are in seconds since epoch, None if the user has no session.
+    # With 'window_days', only the sessions of the last days are counted.
+
+    def __init__(
+        self, user_id: int, name: str, enabled: bool, last_login: Optional[float] = None,
+        last_logout: Optional[float] = None, active_sessions: int = 0, n_sessions: int = 0,
+        window_days: Optional[int] = None
+    ) -> None:
+        self.id = user_id
+        self.name = name
+        self.enabled = enabled
+        self.last_login = last_login
+        self.last_logout = last_logout
+        self.active_sessions = active_sessions
+        self.n_sessions = n_sessions
+        self.window_days = window_days
+
+    def is_logged_in(self) -> bool:
+        return self.active_sessions > 0
+
+    def never_logged_in(self) -> bool:
+        return self.n_sessions == 0 and self.last_login is None and self.window_days is None
+
+    def no_activity_in_window(self) -> bool:
+        # no session within the window, and no older one in the history
+        return self.n_sessions == 0 and self.last_login is None and self.window_days is not None
+
+    def days_since_logout(self, now: Optional[float] = None) -> Optional[float]:
+        # days since the last closed session; a user whose sessions were never closed counts from epoch
+        if self.last_login is None:
+            return None
+        now = time() if now is None else now
+        return (now - (self.last_logout or 0)) / (60 * 60 * 24)
+
+
+def get_user_activity(
+    conn: BlitzGateway, window_days: Optional[int] = None, db_path: str = ACTIVITY_DB_FILE
+) -> Dict[int, UserActivity]:
+    # Get the activity of all users.
+    # The sessions are aggregated per user in one query; with 'window_days', only the sessions
+    # started within the last days are considered, and the users without any of them get
+    # their last known login and logout from the history database.
+    qs = conn.getQueryService()
+
+    enabled_ids = {result[0].val for result in qs.projection(
+        f"SELECT m.child.id FROM GroupExperimenterMap m WHERE m.parent.id = {USER_GROUP_ID}", None
+    )}
+    activities = {}
+    for result in qs.projection("SELECT id, omeName FROM Experimenter", None):
+        user_id = result[0].val
+        activities[user_id] = UserActivity(user_id, result[1].val, user_id in enabled_ids, window_days=window_days)
+
+    params = omero.sys.ParametersI()
+    query = ("SELECT s.owner.id, MAX(s.started), MAX(s.closed), "
+             "SUM(CASE WHEN s.closed IS NULL THEN 1 ELSE 0 END), COUNT(s.id) FROM Session s")
+    if window_days is not None:
+        params.add("since", omero.rtypes.rtime(int((time() - window_days * 24 * 60 * 60) * 1000)))
+        query += " WHERE s.started >= :since"
+    query += " GROUP BY s.owner.id"
+
+    for result in qs.projection(query, params, conn.SERVICE_OPTS):
+        activity = activities.get(result[0].val)
+        if activity is None:
+            continue
+        # note times in seconds since epoch
+        activity.last_login = result[1].val / 1000 if result[1] is not None else None
+        activity.last_logout = result[2].val / 1000 if result[2] is not None else None
+        activity.active_sessions = result[3].val
+        activity.n_sessions = result[4].val
+
+    if window_days is not None:
+        history = load_last_activity(db_path)
+        for user_id, activity in activities.items():
+            if activity.n_sessions == 0 and user_id in history:
+                activity.last_login = history[user_id].last_login
+                activity.last_logout = history[user_id].last_logout
+
+    return activities
+
+
+def open_activity_db(db_path: str = ACTIVITY_DB_FILE):
+    # Open the history database, creating the table if needed.
+    # One snapshot per day; a new run on the same day replaces it.
+    db = sqlite3.connect(db_path)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            enabled INTEGER NOT NULL,
+            last_login REAL,
+            last_logout REAL,
+            active_sessions INTEGER NOT NULL,
+            n_sessions INTEGER NOT NULL,
+            PRIMARY KEY (date, user_id)
+        )
+    """)
+    return db
+
+
+def save_activity(activities: Dict[int, UserActivity], db_path: str = ACTIVITY_DB_FILE) -> None:
+    # Store today's activity of all users in the history database
+    snapshot_date = date.today().isoformat()
+    db = open_activity_db(db_path)
+    try:
+        with db:
+            db.executemany("INSERT OR REPLACE INTO user_activity VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(snapshot_date, a.id, a.name, int(a.enabled), a.last_login, a.last_logout,
+                             a.active_sessions, a.n_sessions) for a in activities.values()])
+    finally:
+        db.close()
+
+
+def load_last_activity(db_path: str = ACTIVITY_DB_FILE) -> Dict[int, UserActivity]:
+    # Read the latest stored activity of each user who had logged in at that time
+    db = open_activity_db(db_path)
+    try:
+        rows = db.execute("SELECT user_id, username, enabled, last_login, last_logout, active_sessions, n_sessions "
+                          "FROM user_activity a WHERE last_login IS NOT NULL AND date = "
+                          "(SELECT MAX(date) FROM user_activity b "
+                          "WHERE b.user_id = a.user_id AND b.last_login IS NOT NULL)").fetchall()
+    finally:
+        db.close()
+    return {row[0]: UserActivity(row[0], row[1], bool(row[2]), *row[3:]) for row in rows}
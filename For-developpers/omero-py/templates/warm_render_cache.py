@@ -0,0 +1,361 @@
+import requests
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from PyQt6.QtWidgets import QHBoxLayout, QLabel, QLineEdit, QWidget, QVBoxLayout, QMainWindow, QPushButton, \
+    QApplication, QSpinBox
+from update_luts_preview import login, logout
+
+
+# Request the thumbnails and bird's eye views of all images within some containers, so that
+# omero-web renders and caches them before users open the images (e.g. after a server upgrade or a cache purge).
+# Uses the same session login as update_luts_preview.py
+
+
+FONT_SIZE = 'font-size: 14px'
+DEFAULT_HOST = 'omero.epfl.ch'
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 20
+
+# number of objects listed in one JSON API call (500 is the omero-web maximum)
+API_PAGE_SIZE = 500
+# rendering endpoints to warm for each image
+RENDER_URLS = [
+    "webgateway/render_thumbnail/{image_id}/",
+    "webgateway/render_birds_eye_view/{image_id}/",
+]
+# JSON API endpoint listing the children of each container type
+CHILDREN_URLS = {
+    "Project": ("m/projects/{id}/datasets/", "Dataset"),
+    "Screen": ("m/screens/{id}/plates/", "Plate"),
+    "Dataset": ("m/datasets/{id}/images/", "Image"),
+    "Plate": ("m/plates/{id}/wells/", "Well"),
+}
+
+
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+
+        # main window settings
+        self.setWindowTitle("Main window title")
+        self.setMinimumSize(400, 100)
+        widgets = []
+        main_layout = QVBoxLayout()
+
+        # host fields
+        host_layout = QHBoxLayout()
+        host_label = QLabel("Host")
+        host_label.setStyleSheet(FONT_SIZE)
+        self.host = QLineEdit()
+        self.host.setStyleSheet(FONT_SIZE)
+        self.host.setText(DEFAULT_HOST)
+        host_widget = QWidget()
+        host_layout.addWidget(host_label)
+        host_layout.addWidget(self.host)
+        host_widget.setLayout(host_layout)
+        widgets.append(host_widget)
+
+        # username fields
+        username_layout = QHBoxLayout()
+        username_label = QLabel("Username")
+        username_label.setStyleSheet(FONT_SIZE)
+        self.username = QLineEdit()
+        self.username.setStyleSheet(FONT_SIZE)
+        username_widget = QWidget()
+        username_layout.addWidget(username_label)
+        username_layout.addWidget(self.username)
+        username_widget.setLayout(username_layout)
+        widgets.append(username_widget)
+
+        # password fields
+        password_layout = QHBoxLayout()
+        password_label = QLabel("Password")
+        password_label.setStyleSheet(FONT_SIZE)
+        self.password = QLineEdit()
+        self.password.setStyleSheet(FONT_SIZE)
+        self.password.setEchoMode(QLineEdit.EchoMode.Password)
+        password_widget = QWidget()
+        password_layout.addWidget(password_label)
+        password_layout.addWidget(self.password)
+        password_widget.setLayout(password_layout)
+        widgets.append(password_widget)
+
+        # containers fields
+        containers_layout = QHBoxLayout()
+        containers_label = QLabel("Containers (e.g. Project:1, Dataset:2, Plate:3)")
+        containers_label.setStyleSheet(FONT_SIZE)
+        self.containers = QLineEdit()
+        self.containers.setStyleSheet(FONT_SIZE)
+        containers_widget = QWidget()
+        containers_layout.addWidget(containers_label)
+        containers_layout.addWidget(self.containers)
+        containers_widget.setLayout(containers_layout)
+        widgets.append(containers_widget)
+
+        # workers fields
+        workers_layout = QHBoxLayout()
+        workers_label = QLabel("Parallel requests")
+        workers_label.setStyleSheet(FONT_SIZE)
+        self.workers = QSpinBox()
+        self.workers.setStyleSheet(FONT_SIZE)
+        self.workers.setMinimum(1)
+        self.workers.setMaximum(32)
+        self.workers.setValue(DEFAULT_WORKERS)
+        workers_widget = QWidget()
+        workers_layout.addWidget(workers_label)
+        workers_layout.addWidget(self.workers)
+        workers_widget.setLayout(workers_layout)
+        widgets.append(workers_widget)
+
+        # rate fields
+        rate_layout = QHBoxLayout()
+        rate_label = QLabel("Maximum requests per second")
+        rate_label.setStyleSheet(FONT_SIZE)
+        self.rate = QSpinBox()
+        self.rate.setStyleSheet(FONT_SIZE)
+        self.rate.setMinimum(1)
+        self.rate.setMaximum(1000)
+        self.rate.setValue(DEFAULT_RATE)
+        rate_widget = QWidget()
+        rate_layout.addWidget(rate_label)
+        rate_layout.addWidget(self.rate)
+        rate_widget.setLayout(rate_layout)
+        widgets.append(rate_widget)
+
+        # buttons fields
+        button_layout = QHBoxLayout()
+        ok_button = QPushButton(text="OK")
+        ok_button.setStyleSheet(FONT_SIZE)
+        ok_button.clicked.connect(self.run_app)
+        cancel_button = QPushButton(text="Cancel")
+        cancel_button.setStyleSheet(FONT_SIZE)
+        cancel_button.clicked.connect(self.close_app)
+        button_widget = QWidget()
+        button_layout.addWidget(ok_button)
+        button_layout.addWidget(cancel_button)
+        button_widget.setLayout(button_layout)
+        widgets.append(button_widget)
+
+        # building the main GUI
+        for w in widgets:
+            main_layout.addWidget(w)
+
+        widget = QWidget()
+        widget.setLayout(main_layout)
+
+        # Set the central widget of the Window. Widget will expand
+        # to take up all the space in the window by default.
+        self.setCentralWidget(widget)
+
+    def close_app(self):
+        self.close()
+
+    def run_app(self):
+        username = self.username.text()
+        password = self.password.text()
+        host = self.host.text()
+        containers = parse_containers(self.containers.text())
+        workers = self.workers.value()
+        rate = self.rate.value()
+        self.close()
+        run_script(host, username, password, containers, workers, rate)
+
+
+def run_script(host, username, password, containers, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+    """
+    Render the thumbnails and bird's eye views of all images within the containers,
+    so that they are cached on omero-web
+
+    Parameters
+    ----------
+    host : String
+        url of omero-web
+    username : String
+        username of the OMERO user
+    password : String
+        password of the OMERO user
+    containers : list
+        (type, id) of the containers; type is Project, Dataset, Screen, Plate or Image
+    workers : int
+        number of requests running at the same time
+    rate : int
+        maximum number of requests per second
+
+    Returns
+    -------
+    n_ok : int
+        number of successful rendering requests
+    """
+    session = requests.Session()
+    # one pooled connection per worker
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    try:
+        login(host, username, password, session)
+    except (requests.RequestException, RuntimeError) as e:
+        print(e)
+        return 0
+
+    try:
+        image_ids = []
+        for container_type, container_id in containers:
+            ids = list_images(session, host, container_type, container_id)
+            print(f"Found {len(ids)} images in {container_type} {container_id}")
+            image_ids.extend(ids)
+        # keep the order, without duplicates
+        image_ids = list(dict.fromkeys(image_ids))
+
+        urls = [f"{host}/{url.format(image_id=image_id)}" for image_id in image_ids for url in RENDER_URLS]
+        n_ok = warm_urls(session, urls, workers, rate)
+        print(f"Rendered {n_ok}/{len(urls)} thumbnails and bird's eye views of {len(image_ids)} images")
+        return n_ok
+    except Exception as e:
+        print(e)
+        traceback.print_exc()
+    finally:
+        logout(session, host)
+
+
+def parse_containers(text):
+    """
+    Read containers written as 'Type:id, Type:id'
+
+    Parameters
+    ----------
+    text : String
+        comma separated containers
+
+    Returns
+    -------
+    containers : list
+        (type, id) of the containers
+    """
+    containers = []
+    for item in text.split(","):
+        if item.strip():
+            container_type, container_id = item.split(":")
+            containers.append((container_type.strip().capitalize(), int(container_id)))
+    return containers
+
+
+def get_all_pages(session, url):
+    """
+    Get all the objects listed by a JSON API endpoint, page by page
+
+    Parameters
+    ----------
+    session : requests.Session
+        the logged-in session
+    url : String
+        JSON API endpoint
+
+    Returns
+    -------
+    data : list
+        the listed objects
+    """
+    data = []
+    offset = 0
+    while True:
+        response = session.get(url, params={"offset": offset, "limit": API_PAGE_SIZE})
+        response.raise_for_status()
+        page = response.json()
+        data.extend(page["data"])
+        offset += len(page["data"])
+        if len(page["data"]) == 0 or offset >= page["meta"]["totalCount"]:
+            return data
+
+
+def list_images(session, host, container_type, container_id):
+    """
+    List the IDs of all images within a container
+
+    Parameters
+    ----------
+    session : requests.Session
+        the logged-in session
+    host : String
+        url of omero-web
+    container_type : String
+        Project, Dataset, Screen, Plate or Image
+    container_id : int
+        ID of the container
+
+    Returns
+    -------
+    image_ids : list
+        IDs of the images
+    """
+    if container_type == "Image":
+        return [container_id]
+
+    url, child_type = CHILDREN_URLS[container_type]
+    children = get_all_pages(session, f"{host}/api/v0/{url.format(id=container_id)}")
+
+    if child_type == "Image":
+        return [child["@id"] for child in children]
+    if child_type == "Well":
+        return [sample["Image"]["@id"] for well in children for sample in well.get("WellSamples", [])]
+
+    image_ids = []
+    for child in children:
+        image_ids.extend(list_images(session, host, child_type, child["@id"]))
+    return image_ids
+
+
+def warm_urls(session, urls, workers, rate):
+    """
+    Request the urls concurrently, with a bounded number of workers and a global rate limit
+
+    Parameters
+    ----------
+    session : requests.Session
+        the logged-in session
+    urls : list
+        rendering urls
+    workers : int
+        number of requests running at the same time
+    rate : int
+        maximum number of requests per second
+
+    Returns
+    -------
+    n_ok : int
+        number of successful requests
+    """
+    # the requests of all workers are spaced by 1/rate s
+    interval = 1.0 / rate
+    next_call = [time.monotonic()]
+    lock = threading.Lock()
+
+    def warm(url):
+        with lock:
+            now = time.monotonic()
+            delay = next_call[0] - now
+            next_call[0] = max(now, next_call[0]) + interval
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            response = session.get(url)
+            if response.ok:
+                return 1
+            print(f"ERROR {response.status_code} for {url}")
+        except requests.RequestException as e:
+            print(f"ERROR for {url}: {e}")
+        return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(warm, urls))
+
+
+if __name__ == "__main__":
+    list_argv = []
+    app = QApplication(list_argv)
+    window = MainWindow()
+    window.show()
+    app.exec()